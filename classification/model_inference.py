@@ -27,7 +27,180 @@ import tensorrt as trt
 # we can import modules from it.
 sys.path.append('../')
 
-from common.trt_utils import convert_onnx_to_tensorrt, setup_tensort_bindings  # noqa: E402
+from common.trt_utils import (  # noqa: E402
+    EntropyCalibrator,
+    TensorRTContextPool,
+    convert_onnx_to_tensorrt,
+    get_optimization_profile_index,
+    setup_tensort_bindings,
+)
+from common.engine_cache import TensorRTEngineCache  # noqa: E402
+from common.cuda_graph_utils import CudaGraphRunner  # noqa: E402
+from common.warmup_utils import run_warmup_batches  # noqa: E402
+from common.onnxruntime_utils import OnnxRuntimeInference  # noqa: E402
+
+
+def export_onnx_model(onnx_file_path, batch_size, image_size, device):
+    """
+    Exports the ResNet50 classification model, followed by a softmax, to an ONNX file with
+    a dynamic batch size. The same file serves the TensorRT and ONNX Runtime backends.
+    :param onnx_file_path: The path of the ONNX file to write.
+    :param batch_size: The batch size of the dummy input used by the export.
+    :param image_size: The (width, height) of the input images.
+    :param device: The torch device to run the export on, e.g. "cuda:0" or "cpu".
+    """
+    # First we use PyTorch to create a classification model.
+    with torch.no_grad():
+
+        class Resnet50_Softmax(torch.nn.Module):
+            def __init__(self, resnet50):
+                super(Resnet50_Softmax, self).__init__()
+                self.resnet50 = resnet50
+
+            def forward(self, x):
+                infer_output = self.resnet50(x)
+                return torch.nn.functional.softmax(infer_output, dim=1)
+
+        resnet_base = torchvision_models.resnet50(
+            weights=torchvision_models.ResNet50_Weights.DEFAULT
+        )
+        resnet_base.eval()
+        pyt_model = Resnet50_Softmax(resnet_base)
+        pyt_model.to(device)
+        pyt_model.eval()
+
+        # Allocate a dummy input to help generate an ONNX model.
+        dummy_x_in = torch.randn(
+            batch_size,
+            3,
+            image_size[1],
+            image_size[0],
+            requires_grad=False,
+        ).to(device)
+
+        # Generate an ONNX model using the PyTorch's onnx export.
+        torch.onnx.export(
+            pyt_model,
+            args=dummy_x_in,
+            f=onnx_file_path,
+            export_params=True,
+            opset_version=15,
+            do_constant_folding=True,
+            input_names=["input"],
+            output_names=["output"],
+            dynamic_axes={
+                "input": {0: "batch_size"},
+                "output": {0: "batch_size"},
+            },
+        )
+
+        # Remove the tensors and model after this.
+        del pyt_model
+        del dummy_x_in
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def get_tensorrt_engine(
+    output_dir,
+    onnx_file_path,
+    batch_size,
+    image_size,
+    device_id,
+    profile_batch_sizes,
+    precision,
+    calibration_batches=None,
+):
+    """
+    Returns the serialized TensorRT engine of the ONNX model, from the engine cache of the
+    output directory, building it first if the cache does not have it yet.
+    :param output_dir: The output directory, which holds the engine cache.
+    :param onnx_file_path: Full path to the ONNX model.
+    :param batch_size: The batch size of the calibration batches.
+    :param image_size: The (width, height) of the input images.
+    :param device_id: The GPU device to build the engine for.
+    :param profile_batch_sizes: The sorted batch sizes the engine gets an optimization
+     profile for. The engine accepts batches up to the largest one.
+    :param precision: The precision of the engine, "int8", "fp16" or "fp32".
+    :param calibration_batches: Optional. The batches to calibrate the engine with, if
+     precision is "int8" and the model has no calibration cache yet.
+    :return: The serialized engine bytes.
+    """
+    engine_cache = TensorRTEngineCache(os.path.join(output_dir, "trt_engine_cache"))
+    engine_key = engine_cache.get_key(
+        onnx_file_path,
+        device_id,
+        precision=precision,
+        profile={
+            "batch_sizes": profile_batch_sizes,
+            "shape": [3, image_size[1], image_size[0]],
+        },
+    )
+    if precision == "int8":
+        # Calibrate on the given batches, unless another engine of the same model
+        # was calibrated before, on this or on another machine.
+        calibrator = EntropyCalibrator(
+            calibration_batches,
+            batch_size,
+            device_id,
+            engine_cache.get_calibration_cache_path(
+                onnx_file_path, [3, image_size[1], image_size[0]]
+            ),
+        )
+    else:
+        calibrator = None
+
+    return engine_cache.get_or_build(
+        engine_key,
+        lambda trt_engine_file_path: convert_onnx_to_tensorrt(
+            onnx_file_path,
+            trt_engine_file_path,
+            max_batch_size=profile_batch_sizes[-1],
+            max_workspace_size=1,
+            precision=precision,
+            profile_batch_sizes=profile_batch_sizes,
+            calibrator=calibrator,
+            timing_cache_path=engine_cache.get_timing_cache_path(device_id),
+        ),
+    )
+
+
+def build_tensorrt_engine(
+    output_dir,
+    device_id,
+    profile_batch_sizes,
+    batch_size,
+    height,
+    width,
+    precision,
+):
+    """
+    Builds the TensorRT engine of a configuration into the engine cache, e.g. in a worker
+    process of `build_engines_in_background`. Only the ONNX export, if needed, and the
+    engine build run: the engine is neither loaded nor given a context. The arguments
+    are the ones of the `ClassificationTensorRT` constructor.
+    """
+    # A new worker process starts on the default device, and TensorRT builds the engine
+    # for the current one.
+    torch.cuda.set_device(device_id)
+
+    image_size = (width, height)
+    onnx_file_path = os.path.join(
+        output_dir, "model.%d.%d.%d.onnx" % (batch_size, image_size[1], image_size[0])
+    )
+    if not os.path.isfile(onnx_file_path):
+        export_onnx_model(onnx_file_path, batch_size, image_size, "cuda:%d" % device_id)
+
+    get_tensorrt_engine(
+        output_dir,
+        onnx_file_path,
+        batch_size,
+        image_size,
+        device_id,
+        sorted(set(profile_batch_sizes or []) | {batch_size}),
+        precision or "fp16",
+    )
+
 
 # docs_tag: begin_init_classificationpytorch
 class ClassificationPyTorch:  # noqa: E302
@@ -38,11 +211,31 @@ class ClassificationPyTorch:  # noqa: E302
         image_size,
         device_id,
         cvcuda_perf,
+        cuda_graphs=False,
+        inference_mode=False,
+        channels_last=False,
+        autocast=None,
+        torch_compile=None,
     ):
+        """
+        Initializes a new instance of the `ClassificationPyTorch` class.
+        :param cuda_graphs: Capture the model of every input shape into a CUDA graph and
+         replay it, instead of running the model eagerly on every call.
+        :param inference_mode: Run the model under `torch.inference_mode` instead of only
+         `torch.no_grad`.
+        :param channels_last: Run the model in the channels_last memory format. Inputs are
+         converted to it, unless they are NHWC cvcuda tensors already.
+        :param autocast: Optional. Run the model under `torch.autocast` in "fp16" or "bf16".
+        :param torch_compile: Optional. Compile the model with `torch.compile` in this mode,
+         e.g. "default", "reduce-overhead" or "max-autotune". The first batch of every
+         input shape warms the compiled model up.
+        """
         self.logger = logging.getLogger(__name__)
         self.output_dir = output_dir
         self.device_id = device_id
         self.cvcuda_perf = cvcuda_perf
+        # Set once the warmup is done.
+        self.is_ready = False
         # The underlying PyTorch model that we use for inference is the ResNet50 model
         # from torchvision.
         torch_model = torchvision_models.resnet50
@@ -69,6 +262,36 @@ class ClassificationPyTorch:  # noqa: E302
         self.model = Resnet50_Softmax(resnet_base).cuda(self.device_id)
         self.model.eval()
 
+        if autocast not in [None, "fp16", "bf16"]:
+            raise ValueError("Unsupported autocast precision: %s" % autocast)
+        self.autocast_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(
+            autocast
+        )
+        self.inference_mode = inference_mode
+        self.channels_last = channels_last
+
+        if self.channels_last:
+            # The convolutions then read NHWC data, which is what the tensor cores use,
+            # without transposing it on every layer.
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+        self.torch_compile = torch_compile
+        # The input shapes the compiled model has been warmed up for.
+        self.warmed_up_shapes = set()
+        if self.torch_compile:
+            self.model = torch.compile(self.model, mode=self.torch_compile)
+            if self.torch_compile in ["reduce-overhead", "max-autotune"]:
+                # These modes replay CUDA graphs, which overwrite their outputs.
+                self.output_buffers = 1
+
+        if cuda_graphs:
+            self.cuda_graphs = CudaGraphRunner(self.model, self.device_id)
+            # A replayed graph writes every batch of the same shape into the same
+            # output tensors.
+            self.output_buffers = 1
+        else:
+            self.cuda_graphs = None
+
         self.logger.info("Using PyTorch as the inference engine.")
         # docs_tag: end_init_classificationpytorch
 
@@ -76,24 +299,84 @@ class ClassificationPyTorch:  # noqa: E302
     def __call__(self, tensor):
         self.cvcuda_perf.push_range("inference.torch")
 
-        with torch.no_grad():
+        with torch.no_grad(), torch.inference_mode(self.inference_mode):
 
             if isinstance(tensor, torch.Tensor):
                 if not tensor.is_cuda:
                     tensor = tensor.to("cuda:%d" % self.device_id)
             else:
                 # Convert CVCUDA tensor to Torch tensor.
+                is_nhwc = tensor.layout == "NHWC"
                 tensor = torch.as_tensor(
                     tensor.cuda(), device="cuda:%d" % self.device_id
                 )
-
-            classification_scores = self.model(tensor)
+                if is_nhwc:
+                    # A NHWC tensor is a channels_last NCHW tensor, without any copy.
+                    tensor = tensor.permute(0, 3, 1, 2)
+
+            if self.channels_last:
+                # Only copies the tensor if it is not channels_last already.
+                tensor = tensor.contiguous(memory_format=torch.channels_last)
+
+            # The autocast cache does not outlive the call anyway, and must be off for
+            # the CUDA graph captures.
+            with torch.autocast(
+                "cuda",
+                dtype=self.autocast_dtype,
+                enabled=self.autocast_dtype is not None,
+                cache_enabled=False,
+            ):
+                if (
+                    self.torch_compile
+                    and tuple(tensor.shape) not in self.warmed_up_shapes
+                ):
+                    self._warmup_compiled_model(tensor)
+
+                if self.cuda_graphs is not None:
+                    classification_scores = self.cuda_graphs(tensor)
+                else:
+                    classification_scores = self.model(tensor)
 
         self.cvcuda_perf.pop_range()
         return classification_scores
 
     # docs_tag: end_call_classificationpytorch
 
+    def warmup(self, batch_sizes, image_size, preprocess=None, postprocess=None):
+        """
+        Runs synthetic batches through the model, so that the cuDNN algorithm selection,
+        the compilation and the CUDA graph captures, if any, are done before the first
+        real batch. Sets `is_ready` once done.
+        :param batch_sizes: The batch sizes to warm up.
+        :param image_size: The (width, height) of the synthetic frames.
+        :param preprocess: Optional. The pre-processor to run the frames through.
+        :param postprocess: Optional. A callable which takes the outputs of the model and
+         of the pre-processing. See `run_warmup_batches`.
+        """
+        run_warmup_batches(
+            self,
+            batch_sizes,
+            image_size,
+            "cuda:%d" % self.device_id,
+            preprocess,
+            postprocess,
+        )
+        self.is_ready = True
+
+    def _warmup_compiled_model(self, tensor, num_runs=3):
+        # torch.compile compiles the model again for every new input shape, and its
+        # CUDA graph modes only record their graphs after a few runs. Get all of that
+        # done on the first batch of every shape, in a range of its own.
+        self.cvcuda_perf.push_range("warmup")
+        for _ in range(num_runs):
+            self.model(tensor)
+        self.cvcuda_perf.pop_range()
+
+        self.warmed_up_shapes.add(tuple(tensor.shape))
+        self.logger.info(
+            "Warmed up the compiled model for input shape %s" % str(tuple(tensor.shape))
+        )
+
 
 # docs_tag: begin_init_classificationtensorrt
 class ClassificationTensorRT:
@@ -104,11 +387,41 @@ class ClassificationTensorRT:
         image_size,
         device_id,
         cvcuda_perf,
+        profile_batch_sizes=None,
+        cuda_graphs=False,
+        precision=None,
+        calibration_batches=None,
+        num_contexts=1,
+        context_policy="round_robin",
     ):
+        """
+        Initializes a new instance of the `ClassificationTensorRT` class.
+        :param profile_batch_sizes: Optional. Additional batch sizes the TensorRT engine
+         gets an optimization profile for. The best one is picked for every batch, so
+         smaller batches, like the last one, run fast as well. The engine accepts batches
+         up to the largest of these and batch_size.
+        :param cuda_graphs: Capture the inference of every input shape into a CUDA graph
+         and replay it, instead of launching the engine normally on every call.
+        :param precision: Optional. The precision of the TensorRT engine, "int8", "fp16"
+         or "fp32". Defaults to "fp16".
+        :param calibration_batches: Optional. An iterable of pre-processed batches used to
+         calibrate the engine in int8 precision, e.g. the one returned by
+         `decode_calibration_batches`. Not needed once the model has a calibration cache.
+        :param num_contexts: The number of TensorRT execution contexts. With more than one,
+         batches given to `submit` run at the same time, each one on a context and a
+         stream of its own.
+        :param context_policy: Either "round_robin" or "least_busy". How the context of a
+         batch is picked, if num_contexts is more than one.
+        """
         self.logger = logging.getLogger(__name__)
         self.output_dir = output_dir
         self.device_id = device_id
+        self.precision = precision or "fp16"
         self.cvcuda_perf = cvcuda_perf
+        # Set once the warmup is done.
+        self.is_ready = False
+        self.profile_batch_sizes = sorted(set(profile_batch_sizes or []) | {batch_size})
+        max_batch_size = self.profile_batch_sizes[-1]
         # For TensorRT, the process is the following:
         # We check if there already exists a TensorRT engine generated
         # previously. If not, we check if there exists an ONNX model generated
@@ -126,19 +439,9 @@ class ClassificationTensorRT:
                 image_size[0],
             ),
         )
-        trt_engine_file_path = os.path.join(
-            self.output_dir,
-            "model.%d.%d.%d.trtmodel"
-            % (
-                batch_size,
-                image_size[1],
-                image_size[0],
-            ),
-        )
 
         with torch.cuda.stream(torch.cuda.ExternalStream(cvcuda.Stream.current.handle)):
 
-            torch_model = torchvision_models.resnet50
             weights = torchvision_models.ResNet50_Weights.DEFAULT
             self.labels = weights.meta["categories"]
             # Save the list of labels so that the C++ sample can read it.
@@ -146,83 +449,90 @@ class ClassificationTensorRT:
                 for line in self.labels:
                     f.write("%s\n" % line)
 
-            # Check if we have a previously generated model.
-            if not os.path.isfile(trt_engine_file_path):
-                if not os.path.isfile(onnx_file_path):
-                    # First we use PyTorch to create a classification model.
-                    with torch.no_grad():
-
-                        class Resnet50_Softmax(torch.nn.Module):
-                            def __init__(self, resnet50):
-                                super(Resnet50_Softmax, self).__init__()
-                                self.resnet50 = resnet50
-
-                            def forward(self, x):
-                                infer_output = self.resnet50(x)
-                                return torch.nn.functional.softmax(infer_output, dim=1)
-
-                        resnet_base = torch_model(weights=weights)
-                        resnet_base.eval()
-                        pyt_model = Resnet50_Softmax(resnet_base)
-                        pyt_model.cuda(self.device_id)
-                        pyt_model.eval()
-
-                        # Allocate a dummy input to help generate an ONNX model.
-                        dummy_x_in = torch.randn(
-                            batch_size,
-                            3,
-                            image_size[1],
-                            image_size[0],
-                            requires_grad=False,
-                        ).cuda(self.device_id)
-
-                        # Generate an ONNX model using the PyTorch's onnx export.
-                        torch.onnx.export(
-                            pyt_model,
-                            args=dummy_x_in,
-                            f=onnx_file_path,
-                            export_params=True,
-                            opset_version=15,
-                            do_constant_folding=True,
-                            input_names=["input"],
-                            output_names=["output"],
-                            dynamic_axes={
-                                "input": {0: "batch_size"},
-                                "output": {0: "batch_size"},
-                            },
-                        )
-
-                        # Remove the tensors and model after this.
-                        del pyt_model
-                        del dummy_x_in
-                        torch.cuda.empty_cache()
-
-                # Now that we have an ONNX model, we will continue generating a
-                # serialized TensorRT engine from it.
-                convert_onnx_to_tensorrt(
+            # Check if we have a previously generated ONNX model.
+            if not os.path.isfile(onnx_file_path):
+                export_onnx_model(
                     onnx_file_path,
-                    trt_engine_file_path,
-                    max_batch_size=batch_size,
-                    max_workspace_size=1,
+                    batch_size,
+                    image_size,
+                    "cuda:%d" % self.device_id,
                 )
 
+            # Now that we have an ONNX model, we will continue generating a
+            # serialized TensorRT engine from it, unless the engine cache already
+            # has one built from the same model for this GPU.
+            serialized_engine = get_tensorrt_engine(
+                self.output_dir,
+                onnx_file_path,
+                batch_size,
+                image_size,
+                self.device_id,
+                self.profile_batch_sizes,
+                self.precision,
+                calibration_batches,
+            )
+
             # Once the TensorRT engine generation is all done, we load it.
             trt_logger = trt.Logger(trt.Logger.ERROR)
-            with open(trt_engine_file_path, "rb") as f, trt.Runtime(
-                trt_logger
-            ) as runtime:
-                trt_model = runtime.deserialize_cuda_engine(f.read())
+            with trt.Runtime(trt_logger) as runtime:
+                trt_model = runtime.deserialize_cuda_engine(serialized_engine)
 
             # Create execution context.
-            self.model = trt_model.create_execution_context()
+            self.trt_model = trt_model
+
+            if num_contexts > 1:
+                # Several batches run at the same time, each one on an execution
+                # context and a stream of its own.
+                self.context_pool = TensorRTContextPool(
+                    trt_model,
+                    "input",
+                    num_contexts,
+                    max_batch_size,
+                    self.device_id,
+                    policy=context_policy,
+                    cuda_graphs=cuda_graphs,
+                )
+                # The batches are written to num_contexts sets of output tensors in turn.
+                self.output_buffers = num_contexts
+            else:
+                self.context_pool = None
+                self.model = trt_model.create_execution_context()
+                self.profile_idx = 0
+                # Every batch is written into the same output tensors.
+                self.output_buffers = 1
+
+                # Allocate the output bindings.
+                self.output_tensors, self.output_layer_names = setup_tensort_bindings(
+                    trt_model,
+                    max_batch_size,
+                    self.device_id,
+                    self.logger,
+                )
 
-            # Allocate the output bindings.
-            self.output_tensors, self.output_layer_names = setup_tensort_bindings(
-                trt_model,
-                batch_size,
-                self.device_id,
-                self.logger,
-            )
+                # The output buffers are allocated once, for the largest batch size.
+                # Smaller batches are written to the beginning of them, so their
+                # addresses never change.
+                for output_tensor, layer_name in zip(
+                    self.output_tensors, self.output_layer_names
+                ):
+                    self.model.set_tensor_address(layer_name, output_tensor.data_ptr())
+                # The input shape is only set again when it changes.
+                self.input_shape = None
+
+                if cuda_graphs:
+                    # The outputs already have fixed addresses, only the input needs a
+                    # tensor of its own per graph.
+                    self.cuda_graphs = CudaGraphRunner(
+                        lambda tensor: self._execute(
+                            tensor, torch.cuda.current_stream().cuda_stream
+                        ),
+                        self.device_id,
+                        prepare_func=lambda tensor: self._prepare(
+                            tensor, torch.cuda.current_stream().cuda_stream
+                        ),
+                    )
+                else:
+                    self.cuda_graphs = None
 
             self.logger.info("Using TensorRT as the inference engine.")
         # docs_tag: end_init_classificationtensorrt
@@ -231,22 +541,198 @@ class ClassificationTensorRT:
     def __call__(self, tensor):
         self.cvcuda_perf.push_range("inference.tensorrt")
 
+        actual_batch_size = tensor.shape[0]
+
+        if self.context_pool is not None:
+            # Run on one of the contexts and wait for it on the current stream.
+            stream_handle = cvcuda.Stream.current.handle
+            outputs, done_event = self.context_pool.submit(tensor, stream_handle)
+            torch.cuda.ExternalStream(stream_handle).wait_event(done_event)
+
+            self.cvcuda_perf.pop_range()
+            return outputs[0]
+
+        if self.cuda_graphs is not None:
+            # Replay the graph of this input shape. The graph is launched on the
+            # current torch stream, so make the CVCUDA stream the current one.
+            with torch.cuda.stream(
+                torch.cuda.ExternalStream(cvcuda.Stream.current.handle)
+            ):
+                self.cuda_graphs(
+                    torch.as_tensor(tensor.cuda(), device="cuda:%d" % self.device_id)
+                )
+        else:
+            self._execute(tensor, cvcuda.Stream.current.handle)
+
+        # Since this model produces only 1 output, we can grab it now.
+        classification_scores = self.output_tensors[0][:actual_batch_size]
+
+        self.cvcuda_perf.pop_range()
+        return classification_scores
+
+    # docs_tag: end_call_classificationtensorrt
+
+    def warmup(self, batch_sizes, image_size, preprocess=None, postprocess=None):
+        """
+        Runs synthetic batches through the engine, on every execution context, so that
+        the lazy allocations, the profile switches and the CUDA graph captures, if any,
+        are done before the first real batch. Sets `is_ready` once done.
+        :param batch_sizes: The batch sizes to warm up, up to the largest profile one.
+        :param image_size: The (width, height) of the synthetic frames.
+        :param preprocess: Optional. The pre-processor to run the frames through.
+        :param postprocess: Optional. A callable which takes the outputs of the engine and
+         of the pre-processing. See `run_warmup_batches`.
+        """
+        num_contexts = len(self.context_pool.slots) if self.context_pool else 1
+        run_warmup_batches(
+            self,
+            batch_sizes,
+            image_size,
+            "cuda:%d" % self.device_id,
+            preprocess,
+            postprocess,
+            num_iterations=max(2, num_contexts),
+        )
+        self.is_ready = True
+
+    def submit(self, tensor):
+        """
+        Runs the inference of a batch without making the current stream wait for it, so
+        that the next batch can start right away.
+        :param tensor: The pre-processed input batch.
+        :return: A tuple of the classification scores and a `torch.cuda.Event` recorded
+         once they are ready.
+        """
+        if self.context_pool is None:
+            classification_scores = self(tensor)
+            done_event = torch.cuda.Event()
+            done_event.record(torch.cuda.ExternalStream(cvcuda.Stream.current.handle))
+            return classification_scores, done_event
+
+        self.cvcuda_perf.push_range("inference.tensorrt")
+        outputs, done_event = self.context_pool.submit(
+            tensor, cvcuda.Stream.current.handle
+        )
+        self.cvcuda_perf.pop_range()
+        return outputs[0], done_event
+
+    def _prepare(self, tensor, stream_handle):
+        # Switches the context to the optimization profile best suited to the batch size
+        # and sets its input shape, unless they did not change since the previous call.
+        # A CUDA graph replay does neither, so it is done before every replay too.
+        # Returns the index of the profile.
+        actual_batch_size = tensor.shape[0]
+
+        # Switch to the optimization profile best suited to the batch size.
+        profile_idx = get_optimization_profile_index(
+            self.trt_model, "input", actual_batch_size
+        )
+        if profile_idx != self.profile_idx:
+            self.model.set_optimization_profile_async(profile_idx, stream_handle)
+            self.profile_idx = profile_idx
+            self.input_shape = None
+
+        # Must call this before inference
+        if tuple(tensor.shape) != self.input_shape:
+            assert self.model.set_input_shape("input", tensor.shape)
+            self.input_shape = tuple(tensor.shape)
+
+        return profile_idx
+
+    def _execute(self, tensor, stream_handle):
+        # Launches the engine on a tensor. Everything but the launch itself is skipped
+        # when nothing changed since the previous call.
+        self._prepare(tensor, stream_handle)
+
         # Grab the data directly from the pre-allocated tensor.
         self.model.set_tensor_address("input", tensor.cuda().__cuda_array_interface__["data"][0])
-        for output_tensor, layer_name in zip(self.output_tensors,self.output_layer_names):
-            self.model.set_tensor_address(layer_name, output_tensor.data_ptr())
 
-        # Must call this before inference
-        assert self.model.set_input_shape("input", tensor.shape)
+        self.model.execute_async_v3(stream_handle=stream_handle)
 
-        self.model.execute_async_v3(
-            stream_handle=cvcuda.Stream.current.handle
+
+# docs_tag: begin_init_classificationonnxruntime
+class ClassificationOnnxRuntime:
+    def __init__(
+        self,
+        output_dir,
+        batch_size,
+        image_size,
+        device_id,
+        cvcuda_perf,
+        intra_op_threads=0,
+        inter_op_threads=0,
+        io_binding=True,
+    ):
+        """
+        Initializes a new instance of the `ClassificationOnnxRuntime` class. It runs the
+        ONNX model exported for `ClassificationTensorRT` on the CPU, exporting it first
+        if needed.
+        :param intra_op_threads: The number of threads ONNX Runtime uses to run an
+         operator. 0 uses one per physical core.
+        :param inter_op_threads: The number of threads ONNX Runtime uses to run independent
+         operators in parallel. 0 or 1 runs them one after the other.
+        :param io_binding: Bind the input and the pre-allocated outputs to the session
+         instead of passing them by name on every call.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.output_dir = output_dir
+        self.device_id = device_id
+        self.cvcuda_perf = cvcuda_perf
+        # Set once the warmup is done.
+        self.is_ready = False
+
+        weights = torchvision_models.ResNet50_Weights.DEFAULT
+        self.labels = weights.meta["categories"]
+
+        # The ONNX model has a dynamic batch size, the one in its name is only the one
+        # it was exported with.
+        onnx_file_path = os.path.join(
+            self.output_dir,
+            "model.%d.%d.%d.onnx" % (batch_size, image_size[1], image_size[0]),
+        )
+        if not os.path.isfile(onnx_file_path):
+            export_onnx_model(onnx_file_path, batch_size, image_size, "cpu")
+
+        self.model = OnnxRuntimeInference(
+            onnx_file_path,
+            batch_size,
+            intra_op_threads,
+            inter_op_threads,
+            io_binding,
         )
 
-        # Since this model produces only 1 output, we can grab it now.
-        classification_scores = self.output_tensors[0]
+        self.logger.info("Using ONNX Runtime as the inference engine.")
+        # docs_tag: end_init_classificationonnxruntime
+
+    # docs_tag: begin_call_classificationonnxruntime
+    def __call__(self, tensor):
+        self.cvcuda_perf.push_range("inference.onnxruntime")
+
+        classification_scores = self.model(tensor)[0]
 
         self.cvcuda_perf.pop_range()
         return classification_scores
 
-    # docs_tag: end_call_classificationtensorrt
+    # docs_tag: end_call_classificationonnxruntime
+
+    def warmup(self, batch_sizes, image_size, preprocess=None, postprocess=None):
+        """
+        Runs synthetic batches through the model, so that ONNX Runtime allocates its
+        buffers before the first real batch. Sets `is_ready` once done.
+        :param batch_sizes: The batch sizes to warm up, up to batch_size.
+        :param image_size: The (width, height) of the synthetic frames.
+        :param preprocess: Optional. The pre-processor to run the frames through.
+        :param postprocess: Optional. A callable which takes the outputs of the model and
+         of the pre-processing. See `run_warmup_batches`.
+        """
+        run_warmup_batches(
+            self,
+            batch_sizes,
+            image_size,
+            # The model runs on the CPU, only the CV-CUDA pre-processing needs the GPU.
+            "cpu" if preprocess is None else "cuda:%d" % self.device_id,
+            preprocess,
+            postprocess,
+            num_iterations=1,
+        )
+        self.is_ready = True
@@ -21,12 +21,20 @@ import torch
 
 class PreprocessorCvcuda:
     # docs_tag: begin_init_preprocessorcvcuda
-    def __init__(self, device_id, cvcuda_perf):
+    def __init__(self, device_id, cvcuda_perf, output_layout="NCHW"):
+        """
+        Initializes a new instance of the `PreprocessorCvcuda` class.
+        :param output_layout: The layout of the normalized tensor, "NCHW" or "NHWC". Models
+         running in the channels_last memory format take the NHWC tensor as is.
+        """
         print("PreprocessorCvcuda")
         print(device_id, cvcuda_perf)
         self.logger = logging.getLogger(__name__)
         self.device_id = device_id
         self.cvcuda_perf = cvcuda_perf
+        if output_layout not in ["NCHW", "NHWC"]:
+            raise ValueError("Unsupported output layout: %s" % output_layout)
+        self.output_layout = output_layout
         self.mean_tensor = torch.Tensor([0.485, 0.456, 0.406])
         self.mean_tensor = self.mean_tensor.reshape(1, 1, 1, 3).cuda(self.device_id)
         self.mean_tensor = cvcuda.as_tensor(self.mean_tensor, "NHWC")
@@ -88,8 +96,9 @@ class PreprocessorCvcuda:
             flags=cvcuda.NormalizeFlags.SCALE_IS_STDDEV,
         )
 
-        # Convert it to NCHW layout and return it.
-        normalized = cvcuda.reformat(normalized, "NCHW")
+        # Convert it to NCHW layout and return it, unless the model takes NHWC tensors.
+        if self.output_layout == "NCHW":
+            normalized = cvcuda.reformat(normalized, "NCHW")
 
         self.cvcuda_perf.pop_range()
 
@@ -0,0 +1,111 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+cuda_graph_utils
+
+This file hosts a helper which replays the inference calls of the samples as CUDA graphs.
+"""
+
+import logging
+import torch
+
+
+class CudaGraphRunner:
+    """
+    Runs a function of a single CUDA tensor through CUDA graphs. One graph is captured
+    per input shape and data type, over an input tensor owned by the runner. Replaying
+    a graph only copies the new input into that tensor and launches the whole graph at
+    once, instead of launching every kernel of the function one by one.
+    The first call with a new shape runs the function normally and captures its graph
+    afterwards, so any lazy initialization is already done when the graph is captured.
+    A replay only launches the captured GPU work, so any state the function keeps
+    outside of the graph, e.g. the optimization profile and the input shape of a
+    TensorRT context, must be restored first. That is what `prepare_func` is for.
+    Shapes which fail to capture, or which come once the maximum number of graphs has
+    been reached, keep running normally.
+    """
+
+    def __init__(self, func, device_id, max_graphs=8, prepare_func=None):
+        """
+        Initializes a new instance of the `CudaGraphRunner` class.
+        :param func: A callable which takes a torch tensor and returns its outputs. It must
+         run all of its GPU work on the current torch stream and must write its outputs to
+         the same tensors on every call with the same input shape, e.g. tensors it
+         allocates or pre-allocated output buffers.
+        :param device_id: The GPU device to use.
+        :param max_graphs: The maximum number of graphs, i.e. input shapes, to capture.
+        :param prepare_func: Optional. A callable which takes the input tensor, is called
+         on the current torch stream before every call, outside of any graph, and puts
+         the state the function depends on in the one of that input. It returns a
+         hashable description of that state, e.g. the optimization profile index, which
+         is part of the graph key.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.func = func
+        self.device_id = device_id
+        self.max_graphs = max_graphs
+        self.prepare_func = prepare_func
+        # The graph, the input tensor and the outputs, per input shape, data type and
+        # state returned by `prepare_func`.
+        self.graphs = {}
+        self.failed_keys = set()
+
+    def __call__(self, tensor):
+        """
+        Runs the function on a tensor, replaying its graph if one was captured already.
+        :param tensor: The input torch tensor.
+        :return: The outputs of the function. Outputs of a replayed graph are overwritten
+         by the next replay of the same graph.
+        """
+        state = self.prepare_func(tensor) if self.prepare_func is not None else None
+        key = (tuple(tensor.shape), tensor.dtype, state)
+
+        graph_info = self.graphs.get(key)
+        if graph_info is not None:
+            graph, static_input, static_outputs = graph_info
+            static_input.copy_(tensor)
+            graph.replay()
+            return static_outputs
+
+        # A new shape: fall back to normal execution and capture it for the next time.
+        outputs = self.func(tensor)
+        if key not in self.failed_keys and len(self.graphs) < self.max_graphs:
+            self._capture(key, tensor)
+
+        return outputs
+
+    def _capture(self, key, tensor):
+        # The input is read from the same memory on every replay.
+        static_input = tensor.clone()
+
+        graph = torch.cuda.CUDAGraph()
+        try:
+            # Capture on a side stream. Only the work of this thread is captured, the
+            # other stages of a threaded pipeline keep running on their own streams.
+            with torch.cuda.device(self.device_id), torch.cuda.graph(
+                graph, capture_error_mode="thread_local"
+            ):
+                static_outputs = self.func(static_input)
+        except RuntimeError as e:
+            self.logger.warning(
+                "Could not capture a CUDA graph for input shape %s, it will run without "
+                "one: %s" % (str(key[0]), str(e))
+            )
+            self.failed_keys.add(key)
+            return
+
+        self.graphs[key] = (graph, static_input, static_outputs)
+        self.logger.info("Captured a CUDA graph for input shape %s" % str(key[0]))
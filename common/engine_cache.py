@@ -0,0 +1,411 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+engine_cache
+
+This file hosts a disk cache of serialized TensorRT engines shared by the samples and
+the helpers to fill it in the background.
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import functools
+import logging
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
+import tensorrt as trt
+
+
+class TensorRTEngineCache:
+    """
+    A directory of serialized TensorRT engines, keyed by everything the engine depends on:
+    the ONNX model, the TensorRT version, the GPU architecture, the precision and the
+    shape profile. An engine built for another combination of those is never reused.
+    Engines are written atomically and a file lock makes sure that processes sharing the
+    cache never build the same engine at the same time. Once the cache grows above its
+    maximum size, the least recently used engines and calibration and timing caches are
+    removed, along with their lock files.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=8):
+        """
+        Initializes a new instance of the `TensorRTEngineCache` class.
+        :param cache_dir: The directory in which the engines are stored. Created if needed.
+        :param max_size_gb: The maximum total size of the files in the cache (in GB.)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 * 1024 * 1024)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, onnx_file_path, device_id, precision, profile):
+        """
+        Computes the cache key of an engine.
+        :param onnx_file_path: Full path to the ONNX file the engine is built from.
+        :param device_id: The GPU device the engine is built for.
+        :param precision: The precision the engine is built with, e.g. "fp16".
+        :param profile: Any JSON serializable description of the shapes the engine is
+         built for, e.g. the input shape.
+        :return: The key, as a hex string.
+        """
+        hasher = self._hash_file(onnx_file_path)
+
+        build_info = {
+            "tensorrt_version": trt.__version__,
+            "compute_capability": list(torch.cuda.get_device_capability(device_id)),
+            "precision": precision,
+            "profile": profile,
+        }
+        hasher.update(json.dumps(build_info, sort_keys=True).encode())
+
+        return hasher.hexdigest()
+
+    def get_engine_path(self, key):
+        return os.path.join(self.cache_dir, "%s.trtmodel" % key)
+
+    def get_timing_cache_path(self, device_id):
+        """
+        Returns the path of the TensorRT timing cache shared by all the engines built in
+        the cache for a GPU architecture, whatever their model.
+        :param device_id: The GPU device the engines are built for.
+        :return: The path of the timing cache file. It may not exist yet.
+        """
+        major, minor = torch.cuda.get_device_capability(device_id)
+        return os.path.join(
+            self.cache_dir,
+            "timing_cache.trt%s.sm%d%d.bin" % (trt.__version__, major, minor),
+        )
+
+    def get_calibration_cache_path(self, onnx_file_path, input_shape):
+        """
+        Returns the path of the int8 calibration cache of a model. Unlike the engines, the
+        calibration cache does not depend on the GPU, hence it is shared by all the engines
+        built from the same model and can be copied over to other machines as is.
+        :param onnx_file_path: Full path to the ONNX file the engines are built from.
+        :param input_shape: The shape of the input images, without the batch size.
+        :return: The path of the calibration cache file. It may not exist yet.
+        """
+        hasher = self._hash_file(onnx_file_path)
+        calibration_info = {
+            "tensorrt_version": trt.__version__,
+            "input_shape": list(input_shape),
+        }
+        hasher.update(json.dumps(calibration_info, sort_keys=True).encode())
+
+        return os.path.join(self.cache_dir, "%s.calib" % hasher.hexdigest())
+
+    def get_or_build(self, key, build_func):
+        """
+        Returns the serialized engine of a key, building it first if it is not cached yet.
+        :param key: The cache key of the engine, as returned by `get_key`.
+        :param build_func: A callable which takes a file path and writes the serialized
+         engine to it, e.g. a call to `convert_onnx_to_tensorrt`.
+        :return: The serialized engine bytes.
+        """
+        engine_path = self.get_engine_path(key)
+        is_built = False
+
+        with self._lock(key):
+            # Another process may have built the engine while we were waiting.
+            if os.path.isfile(engine_path):
+                self.logger.info("Using cached TensorRT engine: %s" % engine_path)
+                # The modification time is what the eviction goes by.
+                os.utime(engine_path)
+            else:
+                self.logger.info("Building TensorRT engine: %s" % engine_path)
+                # Build next to the final file and rename it once complete, so that an
+                # interrupted build never leaves a truncated engine behind.
+                fd, tmp_engine_path = tempfile.mkstemp(
+                    dir=self.cache_dir, prefix="%s." % key, suffix=".trtmodel.tmp"
+                )
+                os.close(fd)
+                try:
+                    build_func(tmp_engine_path)
+                    os.replace(tmp_engine_path, engine_path)
+                finally:
+                    if os.path.exists(tmp_engine_path):
+                        os.remove(tmp_engine_path)
+                is_built = True
+
+            with open(engine_path, "rb") as f:
+                serialized_engine = f.read()
+
+        if is_built:
+            self.evict(keep=[key])
+
+        return serialized_engine
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently used files until the cache fits in its maximum size.
+        Every file of the cache counts towards the size: the engines, the calibration
+        caches, the timing caches and the engines being built. The ones being built, read
+        or written by another process are left alone. The leftovers of interrupted
+        builds are removed like the engines.
+        :param keep: The keys of the engines which must not be removed.
+        """
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.cache_dir):
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                continue  # Removed by another process.
+            total_size += stat.st_size
+
+            lock_name = self._get_lock_name(file_name)
+            if lock_name is not None and lock_name not in keep:
+                entries.append((stat.st_mtime, stat.st_size, file_name, lock_name))
+
+        for _, size, file_name, lock_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            with self._lock(lock_name, blocking=False) as is_locked:
+                if not is_locked:
+                    continue
+                try:
+                    os.remove(os.path.join(self.cache_dir, file_name))
+                except FileNotFoundError:
+                    pass
+                # Processes waiting on the lock file open a new one, see `file_lock`.
+                os.remove(self._get_lock_path(lock_name))
+                self.logger.info("Evicted %s from the cache" % file_name)
+                total_size -= size
+
+    def _hash_file(self, file_path):
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        return hasher
+
+    def _get_lock_name(self, file_name):
+        # The name of the lock guarding a file of the cache, or None if the file can not
+        # be evicted. The timing caches share the lock `_write_timing_cache` takes.
+        if file_name.endswith(".trtmodel.tmp"):
+            # An engine being built, or left over by an interrupted build if its key is
+            # not locked, see `get_or_build`.
+            return file_name.split(".")[0]
+        key, ext = os.path.splitext(file_name)
+        if ext == ".trtmodel":
+            return key
+        if ext == ".calib" or (ext == ".bin" and file_name.startswith("timing_cache.")):
+            return file_name
+        return None
+
+    def _get_lock_path(self, lock_name):
+        return os.path.join(self.cache_dir, "%s.lock" % lock_name)
+
+    def _lock(self, lock_name, blocking=True):
+        return file_lock(self._get_lock_path(lock_name), blocking)
+
+
+@contextlib.contextmanager
+def file_lock(lock_path, blocking=True):
+    """
+    An exclusive lock on a lock file, held across processes. The holder of the lock may
+    remove the lock file, in which case the processes which were waiting on it open the
+    new one instead.
+    :param lock_path: Full path to the lock file. Created if needed.
+    :param blocking: Whether to wait until the lock is available.
+    :return: Yields True once the lock is held, or False if it is not available and
+     `blocking` is False.
+    """
+    while True:
+        with open(lock_path, "w") as lock_file:
+            try:
+                fcntl.flock(
+                    lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+            except BlockingIOError:
+                yield False
+                return
+
+            # The lock is only valid if the file was not removed while we waited for it.
+            try:
+                is_current = (
+                    os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino
+                )
+            except FileNotFoundError:
+                is_current = False
+            if not is_current:
+                continue
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return
+
+
+class EngineBuildExecutor(ProcessPoolExecutor):
+    """
+    The process pool of `build_engines_in_background`. Unlike a plain one, it can stop
+    the builds which are still running, and not only the pending ones. Without that, the
+    process would not exit before all the builds are done, even if the engines are not
+    needed anymore.
+    """
+
+    def __init__(self, max_workers):
+        # CUDA can not be used in a forked process, hence the workers start from scratch.
+        super().__init__(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.is_stopped = False
+
+    def stop(self):
+        """
+        Cancels the pending builds, terminates the worker processes and waits for them to
+        exit. An interrupted build leaves a temporary file in the engine cache, which its
+        eviction removes later.
+        """
+        self.is_stopped = True
+        # A process pool only terminates its workers once they are idle.
+        processes = list((self._processes or {}).values())
+        self.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+def build_engines_in_background(build_func, configs, max_workers=None):
+    """
+    Builds the TensorRT engines of several configurations at the same time, each one in
+    a worker process of its own, while the caller goes on with something else. The
+    errors of the builds are logged as soon as they fail.
+    :param build_func: A callable which takes the batch size, the height, the width and
+     the precision of an engine and builds it into the engine cache, e.g. a
+     `functools.partial` of the `build_tensorrt_engine` function of a sample. It must
+     be picklable.
+    :param configs: A list of (batch_size, height, width, precision) tuples.
+    :param max_workers: The maximum number of engines built at the same time. Defaults to
+     one per configuration.
+    :return: A tuple of the `EngineBuildExecutor` running the builds and a list of
+     `concurrent.futures.Future`, one per configuration, done once its engine is in the
+     cache. The executor must be stopped or shut down once the engines are not needed
+     anymore. `DeferredTensorRTInference` does it.
+    """
+    logger = logging.getLogger(__name__)
+    executor = EngineBuildExecutor(max_workers or len(configs))
+
+    def log_error(config, future):
+        # The builds interrupted on purpose are not errors.
+        if executor.is_stopped or future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error(
+                "Building the TensorRT engine of %s failed: %s"
+                % (str(config), str(future.exception()))
+            )
+
+    futures = []
+    for config in configs:
+        future = executor.submit(build_func, *config)
+        future.add_done_callback(functools.partial(log_error, config))
+        futures.append(future)
+
+    return executor, futures
+
+
+class DeferredTensorRTInference:
+    """
+    Runs the inference with a fallback backend, e.g. PyTorch, while the TensorRT engine is
+    being built in the background, and switches to TensorRT as soon as it is ready. The
+    TensorRT wrapper is only created then, and loads the engine from the cache.
+    Attributes like the labels are looked up on whichever backend is in use.
+    """
+
+    def __init__(
+        self, fallback, engine_future, create_func, output_buffers=1, executor=None
+    ):
+        """
+        Initializes a new instance of the `DeferredTensorRTInference` class.
+        :param fallback: The inference object to use until the engine is ready.
+        :param engine_future: A `concurrent.futures.Future` done once the engine is in the
+         cache, as returned by `build_engines_in_background`.
+        :param create_func: A callable without arguments which returns the TensorRT
+         inference object.
+        :param output_buffers: The `output_buffers` of the TensorRT inference object, see
+         `PipelineStage`. Used for both backends.
+        :param executor: Optional. The executor returned by `build_engines_in_background`.
+         It is shut down once the engine is ready, or stopped by `close`.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.fallback = fallback
+        self.engine_future = engine_future
+        self.create_func = create_func
+        self.output_buffers = output_buffers
+        self.executor = executor
+        self.inference = fallback
+        # The arguments of the last warmup, repeated on the TensorRT backend.
+        self.warmup_args = None
+
+    def __call__(self, tensor):
+        if self.engine_future is not None and self.engine_future.done():
+            self._switch()
+        return self.inference(tensor)
+
+    def warmup(self, batch_sizes, image_size, preprocess=None, postprocess=None):
+        """
+        Warms up the backend in use, see the `warmup` of the inference wrappers. The
+        TensorRT backend is warmed up the same way before it takes over.
+        """
+        self.warmup_args = (batch_sizes, image_size, preprocess, postprocess)
+        self.inference.warmup(*self.warmup_args)
+
+    def close(self):
+        """
+        Stops the engine build if it is still running, e.g. when the sample is done before
+        the engine is ready. See `EngineBuildExecutor.stop`.
+        """
+        if self.executor is not None:
+            self.executor.stop()
+            self.executor = None
+        self.engine_future = None
+
+    def __getattr__(self, name):
+        if name == "inference":
+            raise AttributeError(name)
+        return getattr(self.inference, name)
+
+    def _switch(self):
+        engine_future = self.engine_future
+        self.engine_future = None
+
+        # The workers have nothing left to build.
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        # The error itself is logged by `build_engines_in_background`.
+        if engine_future.exception() is not None:
+            self.logger.error(
+                "The TensorRT engine could not be built, staying on the fallback backend."
+            )
+            return
+
+        self.logger.info("The TensorRT engine is ready, switching to TensorRT.")
+        inference = self.create_func()
+        if self.warmup_args is not None:
+            inference.warmup(*self.warmup_args)
+        self.inference = inference
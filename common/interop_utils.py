@@ -16,6 +16,8 @@
 import numpy as np
 import torch
 import copy
+import threading
+import weakref
 
 
 class CudaBuffer:
@@ -23,6 +25,124 @@ class CudaBuffer:
     obj = None
 
 
+class PinnedHostBuffer:
+    """The owner of the memory of a numpy array handed out by a `PinnedBufferPool`.
+
+    Numpy arrays built from this object, and all the views of them, keep it as their
+    base. Hence it is only garbage collected, and its buffer given back to the pool,
+    once none of them is in use anymore.
+    """
+
+    def __init__(self, buffer, host_tensor):
+        """
+        Args:
+            buffer (torch.Tensor): The pinned uint8 buffer obtained from the pool.
+            host_tensor (torch.Tensor): The view of the buffer to expose to numpy.
+        """
+        self.obj = buffer  # make sure it holds a reference to the pinned buffer
+        self.__array_interface__ = host_tensor.numpy().__array_interface__
+
+
+class PinnedBufferPool:
+    """A pool of reusable page-locked (pinned) host buffers, keyed by their size.
+
+    Device to host copies into pinned memory can run asynchronously and at the full
+    PCIe bandwidth, unlike copies into freshly allocated pageable numpy arrays. The
+    numpy arrays handed out by the pool give their buffer back to it once they, and
+    all the views of them, are garbage collected, see `PinnedHostBuffer`. Like the
+    caching host allocator of PyTorch, a buffer given back along with the event of
+    the last copy into it is only re-used once that event has completed.
+    """
+
+    def __init__(self, max_free_buffers_per_size=8):
+        """
+        Args:
+            max_free_buffers_per_size (int): The number of unused buffers of any given
+                size which are kept around for re-use. Others are freed.
+        """
+        self.max_free_buffers_per_size = max_free_buffers_per_size
+        # size in bytes -> list of (pinned uint8 torch tensor, torch.cuda.Event or None)
+        self.free_buffers = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        """Get a pinned host buffer
+
+        Args:
+            nbytes (int): The size of the buffer, in bytes.
+
+        Returns:
+            torch.Tensor: A pinned uint8 CPU tensor of nbytes elements.
+        """
+        with self.lock:
+            buffers = self.free_buffers.get(nbytes, [])
+            for idx, (buffer, ready_event) in enumerate(buffers):
+                # Skip the buffers a copy may still be writing into.
+                if ready_event is None or ready_event.query():
+                    del buffers[idx]
+                    return buffer
+
+        return torch.empty((nbytes,), dtype=torch.uint8, pin_memory=True)
+
+    def release(self, buffer, ready_event=None):
+        """Give a buffer obtained from `acquire` back to the pool
+
+        Args:
+            buffer (torch.Tensor): The buffer to give back.
+            ready_event (torch.cuda.Event): Optional. The event of the last asynchronous
+                copy into the buffer. The buffer is not handed out again before it has
+                completed.
+        """
+        with self.lock:
+            buffers = self.free_buffers.setdefault(buffer.numel(), [])
+            if len(buffers) < self.max_free_buffers_per_size:
+                buffers.append((buffer, ready_event))
+
+    def copy_to_host_async(self, device_tensor):
+        """Start copying a CUDA tensor to a pinned host numpy array
+
+        The copy is queued on the current torch CUDA stream. The returned array must
+        not be read before the returned event has completed.
+
+        Args:
+            device_tensor (torch.Tensor): The CUDA tensor to copy.
+
+        Returns:
+            tuple: The host numpy array and a torch.cuda.Event signalling that its data is ready.
+        """
+        nbytes = device_tensor.numel() * device_tensor.element_size()
+        buffer = self.acquire(nbytes)
+        host_tensor = buffer.view(device_tensor.dtype).view(device_tensor.shape)
+        host_tensor.copy_(device_tensor, non_blocking=True)
+
+        ready_event = torch.cuda.Event()
+        ready_event.record(torch.cuda.current_stream())
+
+        owner = PinnedHostBuffer(buffer, host_tensor)
+        weakref.finalize(owner, self.release, buffer, ready_event)
+        host_array = np.asarray(owner)
+
+        return host_array, ready_event
+
+    def copy_to_host(self, device_tensor):
+        """Copy a CUDA tensor to a pinned host numpy array
+
+        Args:
+            device_tensor (torch.Tensor): The CUDA tensor to copy.
+
+        Returns:
+            numpy array: The copied data.
+        """
+        host_array, ready_event = self.copy_to_host_async(device_tensor)
+        ready_event.synchronize()
+
+        return host_array
+
+
+# The pool shared by all the device to host copies of the samples.
+pinned_buffer_pool = PinnedBufferPool()
+
+
 def to_torch_dtype(data_type):
     """Convert a data type into one supported by torch
 
@@ -59,7 +179,7 @@ def to_cpu_numpy_buffer(cuda_buffer):
     buf.__cuda_array_interface__ = cuda_buffer.__cuda_array_interface__
     buf.__cuda_array_interface__["typestr"] = torch_dtype.str
 
-    return torch.as_tensor(buf).cpu().numpy()
+    return pinned_buffer_pool.copy_to_host(torch.as_tensor(buf))
 
 
 def to_cuda_buffer(host_data):
@@ -31,6 +31,10 @@ import nvcv
 import cvcuda
 from fractions import Fraction
 import itertools
+import collections
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import PyNvVideoCodec as nvvc
 from nvidia import nvimgcodec
 
@@ -48,6 +52,16 @@ pixel_format_to_cvcuda_code = {
 }
 
 
+def as_buffer(encoded_bytes):
+    """
+    Returns the encoded bytes as an object supporting the buffer protocol, without
+    copying them unless they are in a plain python list.
+    """
+    if isinstance(encoded_bytes, (bytes, bytearray, memoryview, np.ndarray)):
+        return encoded_bytes
+    return bytes(encoded_bytes)
+
+
 class AppCAI:
     def __init__(self, shape, stride, typestr, gpualloc):
         self.__cuda_array_interface__ = {
@@ -69,7 +83,14 @@ class VideoBatchDecoder:
         cuda_ctx,
         cuda_stream,
         cvcuda_perf,
+        output_buffers=1,
     ):
+        """
+        Initializes a new instance of the `VideoBatchDecoder` class.
+        :param output_buffers: The number of pre-allocated RGB batch tensors the decoder
+         cycles through. With more than one, the decoder can run ahead of the stages
+         consuming its batches without overwriting the frames they are still using.
+        """
         # docs_tag: begin_init_videobatchdecoder_pyvideocodec
         self.logger = logging.getLogger(__name__)
         self.input_path = input_path
@@ -81,7 +102,12 @@ class VideoBatchDecoder:
         self.total_decoded = 0
         self.batch_idx = 0
         self.decoder = None
-        self.cvcuda_RGBtensor_batch = None
+        if output_buffers <= 0:
+            raise ValueError("output_buffers must be a value >=1.")
+        # Batch number i is converted into the RGB tensor i % output_buffers. Callers
+        # must be done with batch i before asking for batch i + output_buffers.
+        self.output_buffers = output_buffers
+        self.cvcuda_RGBtensor_ring = [None] * self.output_buffers
         nvDemux = nvvc.PyNvDemuxer(self.input_path)
         self.fps = nvDemux.FrameRate()
         self.logger.info("Using PyNvVideoCodec decoder version: %s" % nvvc.__version__)
@@ -123,17 +149,20 @@ class VideoBatchDecoder:
         # docs_tag: end_decode_videobatchdecoder_pyvideocodec
 
         # docs_tag: begin_convert_videobatchdecoder_pyvideocodec
-        # Create a CVCUDA tensor for color conversion YUV->RGB
+        # Pick the CVCUDA tensor for color conversion YUV->RGB from the ring.
         # Allocate only for the first time or for the last batch.
-        if not self.cvcuda_RGBtensor_batch or actual_batch_size != self.batch_size:
-            self.cvcuda_RGBtensor_batch = cvcuda.Tensor(
+        slot = self.batch_idx % self.output_buffers
+        cvcuda_RGBtensor_batch = self.cvcuda_RGBtensor_ring[slot]
+        if not cvcuda_RGBtensor_batch or actual_batch_size != self.batch_size:
+            cvcuda_RGBtensor_batch = cvcuda.Tensor(
                 (actual_batch_size, self.decoder.h, self.decoder.w, 3),
                 nvcv.Type.U8,
                 nvcv.TensorLayout.NHWC,
             )
+            self.cvcuda_RGBtensor_ring[slot] = cvcuda_RGBtensor_batch
 
         # Convert from YUV to RGB. Conversion code is based on the pixel format.
-        cvcuda.cvtcolor_into(self.cvcuda_RGBtensor_batch, cvcuda_YUVtensor, cvcuda_code)
+        cvcuda.cvtcolor_into(cvcuda_RGBtensor_batch, cvcuda_YUVtensor, cvcuda_code)
 
         self.total_decoded += actual_batch_size
         # docs_tag: end_convert_videobatchdecoder_pyvideocodec
@@ -142,7 +171,7 @@ class VideoBatchDecoder:
         # Create a batch instance and set its properties.
         batch = Batch(
             batch_idx=self.batch_idx,
-            data=self.cvcuda_RGBtensor_batch,
+            data=cvcuda_RGBtensor_batch,
             fileinfo=self.input_path,
         )
         self.batch_idx += 1
@@ -160,6 +189,172 @@ class VideoBatchDecoder:
 
 # docs_tag: end_videobatchdecoder_pyvideocodec
 
+# docs_tag: begin_multivideobatchdecoder_pyvideocodec
+class MultiVideoBatchDecoder:
+    def __init__(
+        self,
+        input_paths,
+        batch_size,
+        device_id,
+        cuda_ctx,
+        cuda_stream,
+        cvcuda_perf,
+        output_buffers=1,
+    ):
+        """
+        Initializes a new instance of the `MultiVideoBatchDecoder` class. It decodes
+        several videos at once, one `nvVideoDecoder` per video, and fills every batch with
+        frames from all the videos which still have frames left. This allows many
+        low frame-rate streams to share full size batches.
+        :param input_paths: A list of MP4 files or a directory containing MP4 files.
+         All the videos must have the same resolution.
+        :param output_buffers: The number of pre-allocated RGB batch tensors the decoder
+         cycles through. See `VideoBatchDecoder`.
+        """
+        self.logger = logging.getLogger(__name__)
+        if isinstance(input_paths, str):
+            if os.path.isdir(input_paths):
+                input_paths = sorted(glob.glob(os.path.join(input_paths, "*.mp4")))
+            else:
+                input_paths = [input_paths]
+        if not input_paths:
+            raise ValueError("No MP4 videos were found to decode.")
+
+        self.input_paths = input_paths
+        self.batch_size = batch_size
+        self.device_id = device_id
+        self.cuda_ctx = cuda_ctx
+        self.cuda_stream = cuda_stream
+        self.cvcuda_perf = cvcuda_perf
+        self.total_decoded = 0
+        self.batch_idx = 0
+        self.decoders = None
+        # The number of frames returned so far for every video.
+        self.frame_counts = [0] * len(self.input_paths)
+        # The videos which still have frames to decode.
+        self.active_sources = list(range(len(self.input_paths)))
+        if output_buffers <= 0:
+            raise ValueError("output_buffers must be a value >=1.")
+        self.output_buffers = output_buffers
+        self.torch_RGBtensor_ring = [None] * self.output_buffers
+        self.fps = [
+            nvvc.PyNvDemuxer(input_path).FrameRate() for input_path in self.input_paths
+        ]
+        self.logger.info(
+            "Decoding %d videos together using PyNvVideoCodec decoder version: %s"
+            % (len(self.input_paths), nvvc.__version__)
+        )
+
+    def __call__(self):
+        self.cvcuda_perf.push_range("decoder.pyVideoCodec")
+
+        # Check if we need to allocate the decoders for their first use.
+        if self.decoders is None:
+            self.decoders = [
+                nvVideoDecoder(input_path, self.device_id, self.cuda_ctx, self.cuda_stream)
+                for input_path in self.input_paths
+            ]
+            for input_path, decoder in zip(self.input_paths, self.decoders):
+                if (decoder.h, decoder.w) != (self.decoders[0].h, self.decoders[0].w):
+                    raise ValueError(
+                        "All the videos must have the same resolution. %s is %dx%d, "
+                        "expected %dx%d."
+                        % (
+                            input_path,
+                            decoder.w,
+                            decoder.h,
+                            self.decoders[0].w,
+                            self.decoders[0].h,
+                        )
+                    )
+        height, width = self.decoders[0].h, self.decoders[0].w
+
+        # Get the RGB tensor of this batch from the ring.
+        slot = self.batch_idx % self.output_buffers
+        torch_RGBtensor_batch = self.torch_RGBtensor_ring[slot]
+        if torch_RGBtensor_batch is None:
+            torch_RGBtensor_batch = torch.empty(
+                (self.batch_size, height, width, 3),
+                dtype=torch.uint8,
+                device="cuda:%d" % self.device_id,
+            )
+            self.torch_RGBtensor_ring[slot] = torch_RGBtensor_batch
+
+        # Always serve the video with the fewest frames decoded so far, asking it for an
+        # equal share of what is left to fill, until the batch is full or all the videos
+        # are done. This keeps the videos in step with each other.
+        source_ids = []
+        frame_indices = []
+        while len(source_ids) < self.batch_size and self.active_sources:
+            source_id = min(self.active_sources, key=lambda i: self.frame_counts[i])
+            decoder = self.decoders[source_id]
+            num_frames = -(
+                -(self.batch_size - len(source_ids)) // len(self.active_sources)
+            )
+
+            # Get the NHWC YUV tensor from the decoder
+            cvcuda_YUVtensor = decoder.get_next_frames(num_frames)
+            actual_num_frames = 0 if cvcuda_YUVtensor is None else cvcuda_YUVtensor.shape[0]
+            if actual_num_frames < num_frames:
+                # This video has no frames left after these ones.
+                self.active_sources.remove(source_id)
+            if actual_num_frames == 0:
+                continue
+
+            cvcuda_code = pixel_format_to_cvcuda_code.get(decoder.pixelFormat)
+            if cvcuda_code is None:
+                raise ValueError(f"Unsupported pixel format: {decoder.pixelFormat}")
+
+            # Convert from YUV to RGB straight into the rows of the batch.
+            start = len(source_ids)
+            cvcuda.cvtcolor_into(
+                cvcuda.as_tensor(
+                    torch_RGBtensor_batch[start : start + actual_num_frames],  # noqa: E203
+                    "NHWC",
+                ),
+                cvcuda_YUVtensor,
+                cvcuda_code,
+            )
+
+            source_ids.extend([source_id] * actual_num_frames)
+            frame_indices.extend(
+                range(
+                    self.frame_counts[source_id],
+                    self.frame_counts[source_id] + actual_num_frames,
+                )
+            )
+            self.frame_counts[source_id] += actual_num_frames
+
+        # Check if we are done decoding
+        if not source_ids:
+            self.cvcuda_perf.pop_range()
+            return None
+
+        self.total_decoded += len(source_ids)
+
+        # Create a batch instance and set its properties. Every frame of the batch
+        # remembers which video it came from and its index in that video.
+        batch = Batch(
+            batch_idx=self.batch_idx,
+            data=cvcuda.as_tensor(torch_RGBtensor_batch[: len(source_ids)], "NHWC"),
+            fileinfo=[self.input_paths[source_id] for source_id in source_ids],
+        )
+        batch.source_ids = source_ids
+        batch.frame_indices = frame_indices
+        self.batch_idx += 1
+
+        self.cvcuda_perf.pop_range()
+        return batch
+
+    def start(self):
+        pass
+
+    def join(self):
+        pass
+
+
+# docs_tag: end_multivideobatchdecoder_pyvideocodec
+
 # docs_tag: begin_imp_nvvideodecoder
 class nvVideoDecoder:
     def __init__(self, enc_file, device_id, cuda_ctx, stream):
@@ -191,6 +386,12 @@ class nvVideoDecoder:
         sar = 8.0 / 9.0
         self.fixed_h = self.h
         self.fixed_w = int(self.w * sar)
+        # A single frame iterator is used for the whole file so that frames decoded
+        # from a packet but not needed by the current batch are kept for the next one.
+        self.frame_iter = None
+        # The decoded frames of every batch are written into this NHWC tensor. It is sized
+        # for the largest batch asked for so far and smaller batches are views of it.
+        self.torch_YUVtensor_batch = None
 
     # frame iterator
     def generate_decoded_frames(self):
@@ -200,23 +401,47 @@ class nvVideoDecoder:
                     nvcv.as_image(decodedFrame.nvcv_image(), nvcv.Format.U8)
                 )
                 if nvcvTensor.layout == "NCHW":
-                    # This will re-format the NCHW tensor to a NHWC tensor which will create
-                    # a copy in the CUDA device decoded frame will go out of scope and the
-                    # backing memory will be available by the decoder.
-                    yield cvcuda.reformat(nvcvTensor, "NHWC")
+                    yield nvcvTensor
                 else:
                     raise ValueError("Unexpected tensor layout, NCHW expected.")
 
     def get_next_frames(self, N):
-        decoded_frames = list(itertools.islice(self.generate_decoded_frames(), N))
-        if len(decoded_frames) == 0:
+        if self.frame_iter is None:
+            self.frame_iter = self.generate_decoded_frames()
+
+        num_frames = 0
+        for nvcvTensor in itertools.islice(self.frame_iter, N):
+            _, c, h, w = nvcvTensor.shape
+            # Allocate only for the first time, for a larger batch size than so far or if
+            # the frame size changes. Smaller batches are written into the first N frames.
+            if (
+                self.torch_YUVtensor_batch is None
+                or self.torch_YUVtensor_batch.shape[0] < N
+                or tuple(self.torch_YUVtensor_batch.shape[1:]) != (h, w, c)
+            ):
+                self.torch_YUVtensor_batch = torch.empty(
+                    (N, h, w, c),
+                    dtype=torch.uint8,
+                    device="cuda:%d" % self.device_id,
+                )
+
+            # This will re-format the NCHW frame straight into its NHWC slot of the batch.
+            # It is the only copy of the frame and once done, the backing memory of the
+            # decoded frame is available to the decoder again.
+            cvcuda.reformat_into(
+                cvcuda.as_tensor(
+                    self.torch_YUVtensor_batch[num_frames : num_frames + 1],  # noqa: E203
+                    "NHWC",
+                ),
+                nvcvTensor,
+                stream=self.stream,
+            )
+            num_frames += 1
+
+        if num_frames == 0:
             return None
-        elif len(decoded_frames) == 1:  # this case we dont need stack the tensor
-            return decoded_frames[0]
-        else:
-            # convert from list of tensors to a single tensor (NHWC)
-            tensorNHWC = cvcuda.stack(decoded_frames)
-            return tensorNHWC
+
+        return cvcuda.as_tensor(self.torch_YUVtensor_batch[:num_frames], "NHWC")
 
 
 # docs_tag: end_imp_nvvideodecoder
@@ -231,7 +456,18 @@ class VideoBatchEncoder:
         cuda_ctx,
         cuda_stream,
         cvcuda_perf,
+        async_encode=False,
+        max_pending_batches=2,
+        raw_output=False,
     ):
+        """
+        Initializes a new instance of the `VideoBatchEncoder` class.
+        :param async_encode: Hand the converted NV12 batches over to an encoder thread, and
+         the encoded packets to a writer thread, instead of encoding and writing them inline.
+        :param max_pending_batches: The number of converted batches which may wait for the
+         encoder thread. Only used if async_encode is True.
+        :param raw_output: Write a raw H.264 elementary stream (.h264) instead of a MP4 file.
+        """
         self.logger = logging.getLogger(__name__)
         self.output_path = output_path
         self.fps = fps
@@ -247,6 +483,23 @@ class VideoBatchEncoder:
         self.input_layout = "NCHW"
         self.gpu_input = True
         self.output_file_name = None
+        self.raw_output = raw_output
+
+        # Setup the encoder and writer threads, if requested.
+        self.async_encode = async_encode
+        self.encode_queue = None
+        self.write_queue = None
+        # Pool of NV12 batch tensors. One is taken for every batch and given back once
+        # the encoder thread is done with it.
+        self.free_YUVtensors = None
+        self.threads = []
+        self.errors = []
+        if self.async_encode:
+            self.encode_queue = queue.Queue()
+            self.write_queue = queue.Queue()
+            self.free_YUVtensors = queue.Queue()
+            for _ in range(max_pending_batches + 1):
+                self.free_YUVtensors.put(None)
 
         self.logger.info("Using PyNvVideoCodec encoder version: %s" % nvvc.__version__)
         # docs_tag: end_init_videobatchencoder_pyvideocodec
@@ -258,7 +511,10 @@ class VideoBatchEncoder:
         # Get the name of the original video file read by the decoder. We would use
         # the same filename to save the output video.
         file_name = os.path.splitext(os.path.basename(batch.fileinfo))[0]
-        self.output_file_name = os.path.join(self.output_path, "out_%s.mp4" % file_name)
+        self.output_file_name = os.path.join(
+            self.output_path,
+            "out_%s.%s" % (file_name, "h264" if self.raw_output else "mp4"),
+        )
 
         assert isinstance(batch.data, torch.Tensor)
 
@@ -274,6 +530,7 @@ class VideoBatchEncoder:
                 self.cuda_ctx,
                 self.cuda_stream,
                 "NV12",
+                self.raw_output,
             )
         # docs_tag: end_alloc_cvcuda_videobatchencoder_pyvideocodec
 
@@ -293,6 +550,17 @@ class VideoBatchEncoder:
                 nvcv.Type.U8,
                 nvcv.TensorLayout.NHWC,
             )
+            self.cvcuda_YUVtensor_batch = None
+
+        # In the async mode, wait for a NV12 tensor to be given back by the encoder thread.
+        if self.async_encode:
+            self._raise_thread_errors()
+            self.cvcuda_YUVtensor_batch = self.free_YUVtensors.get()
+
+        if (
+            not self.cvcuda_YUVtensor_batch
+            or current_batch_size != self.cvcuda_YUVtensor_batch.shape[0]
+        ):
             self.cvcuda_YUVtensor_batch = cvcuda.Tensor(
                 (current_batch_size, (height // 2) * 3, width, 1),
                 nvcv.Type.U8,
@@ -318,25 +586,184 @@ class VideoBatchEncoder:
         # docs_tag: end_convert_videobatchencoder_pyvideocodec
 
         # docs_tag: begin_encode_videobatchencoder_pyvideocodec
-        # Encode frames from the batch one by one using pyVideoCodec.
-        for img_idx in range(tensor.shape[0]):
-            img = tensor[img_idx]
+        if self.async_encode:
+            # The encoder thread waits on this event instead of this thread waiting
+            # for the conversion to finish.
+            ready_event = torch.cuda.Event()
+            ready_event.record(torch.cuda.current_stream())
+            self.encode_queue.put((self.cvcuda_YUVtensor_batch, tensor, ready_event))
+        else:
             #WAR sync the cvcuda active stream since encoder is on default
             cvcuda.Stream.current.sync() #WAR
-            self.encoder.encode_from_tensor(img)
+
+            # Encode frames from the batch one by one using pyVideoCodec and write
+            # them all at once.
+            self.encoder.write_frames(
+                [self.encoder.encode(tensor[img_idx]) for img_idx in range(tensor.shape[0])]
+            )
 
         self.cvcuda_perf.pop_range()
 
+    def _encode_worker(self):
+        self.cuda_ctx.push()
+        try:
+            while True:
+                item = self.encode_queue.get()
+                if item is None:
+                    break
+                cvcuda_YUVtensor_batch, tensor, ready_event = item
+
+                # Wait once for the whole batch to be converted.
+                ready_event.synchronize()
+                self.write_queue.put(
+                    [
+                        self.encoder.encode(tensor[img_idx])
+                        for img_idx in range(tensor.shape[0])
+                    ]
+                )
+
+                # The encoder has consumed the frames, the tensor can be re-used.
+                self.free_YUVtensors.put(cvcuda_YUVtensor_batch)
+
+            if self.encoder is not None:
+                encoded_bytes, pts_time = self.encoder.end_encode()
+                if encoded_bytes:
+                    self.write_queue.put([(encoded_bytes, pts_time)])
+        except Exception as e:
+            self.logger.error("Video encoder thread failed: %s" % str(e))
+            self.errors.append(e)
+            # Unblock the conversion of the next batch, if any.
+            self.free_YUVtensors.put(None)
+        finally:
+            self.write_queue.put(None)
+            self.cuda_ctx.pop()
+
+    def _write_worker(self):
+        try:
+            while True:
+                encoded_frames = self.write_queue.get()
+                if encoded_frames is None:
+                    break
+                self.encoder.write_frames(encoded_frames)
+        except Exception as e:
+            self.logger.error("Video writer thread failed: %s" % str(e))
+            self.errors.append(e)
+            # Keep draining the packets so that the encoder thread never blocks.
+            while self.write_queue.get() is not None:
+                pass
+
+    def _raise_thread_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
     def start(self):
-        pass
+        if self.async_encode and not self.threads:
+            self.threads = [
+                threading.Thread(
+                    target=self._encode_worker, name="encoder.encode", daemon=True
+                ),
+                threading.Thread(
+                    target=self._write_worker, name="encoder.write", daemon=True
+                ),
+            ]
+            for thread in self.threads:
+                thread.start()
 
     def join(self):
-        self.encoder.flush()
+        if self.async_encode:
+            # Let the encoder and writer threads drain their queues.
+            self.encode_queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+            self._raise_thread_errors()
+            if self.encoder is not None:
+                self.encoder.close()
+        else:
+            self.encoder.flush()
         self.logger.info("Wrote: %s" % self.output_file_name)
 
 
 # docs_tag: end_init_videobatchencoder_pyvideocodec
 
+# docs_tag: begin_multivideobatchencoder_pyvideocodec
+class MultiVideoBatchEncoder:
+    def __init__(
+        self,
+        output_path,
+        fps,
+        device_id,
+        cuda_ctx,
+        cuda_stream,
+        cvcuda_perf,
+        async_encode=False,
+        raw_output=False,
+    ):
+        """
+        Initializes a new instance of the `MultiVideoBatchEncoder` class. It splits the
+        batches of a `MultiVideoBatchDecoder` by video and sends the frames of every video
+        to a `VideoBatchEncoder` of its own.
+        :param fps: A list with the frame rate of every video.
+        :param async_encode: Passed on to every `VideoBatchEncoder`.
+        :param raw_output: Passed on to every `VideoBatchEncoder`.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.output_path = output_path
+        self.fps = fps
+        self.device_id = device_id
+        self.cuda_ctx = cuda_ctx
+        self.cuda_stream = cuda_stream
+        self.cvcuda_perf = cvcuda_perf
+        self.async_encode = async_encode
+        self.raw_output = raw_output
+        self.encoders = {}
+        self.input_layout = "NCHW"
+        self.gpu_input = True
+
+    def __call__(self, batch):
+        assert isinstance(batch.data, torch.Tensor)
+
+        # Split the batch into runs of consecutive rows from the same video. Every run is
+        # a contiguous slice, a view of the batch, and goes to the encoder of its video.
+        start = 0
+        while start < len(batch.source_ids):
+            source_id = batch.source_ids[start]
+            end = start + 1
+            while end < len(batch.source_ids) and batch.source_ids[end] == source_id:
+                end += 1
+
+            if source_id not in self.encoders:
+                self.encoders[source_id] = VideoBatchEncoder(
+                    self.output_path,
+                    self.fps[source_id],
+                    self.device_id,
+                    self.cuda_ctx,
+                    self.cuda_stream,
+                    self.cvcuda_perf,
+                    self.async_encode,
+                    raw_output=self.raw_output,
+                )
+                self.encoders[source_id].start()
+
+            self.encoders[source_id](
+                Batch(
+                    batch_idx=batch.batch_idx,
+                    data=batch.data[start:end],
+                    fileinfo=batch.fileinfo[start],
+                )
+            )
+            start = end
+
+    def start(self):
+        pass
+
+    def join(self):
+        for encoder in self.encoders.values():
+            encoder.join()
+
+
+# docs_tag: end_multivideobatchencoder_pyvideocodec
+
 # docs_tag: begin_imp_nvvideoencoder
 class nvVideoEncoder:
     def __init__(
@@ -349,6 +776,7 @@ class nvVideoEncoder:
         cuda_ctx,
         cuda_stream,
         format,
+        raw_output=False,
     ):
         """
         Create instance of HW-accelerated video encoder.
@@ -360,6 +788,8 @@ class nvVideoEncoder:
         :param cuda_ctx: A cuda context object
         :param format: The format of the encoded video file.
                 (e.g. "NV12", "YUV444" see NvPyVideoEncoder docs for more info)
+        :param raw_output: Write the encoded packets as they are, i.e. as a raw H.264
+                Annex-B elementary stream, instead of muxing them into a container with PyAV.
         """
         self.device_id = device_id
         self.fps = round(Fraction(fps), 6)
@@ -370,8 +800,7 @@ class nvVideoEncoder:
         self.pts_time = 0
         self.delta_t = 1  # Increment the packets' timestamp by this much.
         self.encoded_frame = np.ndarray(shape=(0), dtype=np.uint8)
-        self.container = av.open(enc_file, "w")
-        self.avstream = self.container.add_stream("h264", rate=self.fps)
+        self.raw_output = raw_output
 
         aligned_value = 0
         if width % 16 != 0:
@@ -379,10 +808,18 @@ class nvVideoEncoder:
         aligned_width = width + aligned_value
         width = aligned_width
 
-        self.avstream.width = width
-        self.avstream.height = height
+        if self.raw_output:
+            self.container = None
+            self.avstream = None
+            self.raw_file = open(enc_file, "wb")
+        else:
+            self.container = av.open(enc_file, "w")
+            self.avstream = self.container.add_stream("h264", rate=self.fps)
+            self.avstream.width = width
+            self.avstream.height = height
+            self.avstream.time_base = 1 / Fraction(self.fps)
+            self.raw_file = None
 
-        self.avstream.time_base = 1 / Fraction(self.fps)
         self.surface = None
         self.surf_plane = None
 
@@ -390,8 +827,8 @@ class nvVideoEncoder:
 
         config = {"preset":"P4", "codec":"h264","cudastream":cuda_stream.handle}
         self.nvEnc = nvvc.CreateEncoder(
-            self.avstream.width,
-            self.avstream.height,
+            width,
+            height,
             format,
             False,
             **config
@@ -412,45 +849,81 @@ class nvVideoEncoder:
     # docs_tag: begin_imp_nvvideoencoder
 
     def encode_from_tensor(self, tensor):
+        encoded_frame, pts_time = self.encode(tensor)
+
+        self.write_frames([(encoded_frame, pts_time)])
 
+    def encode(self, tensor):
+        """
+        Encodes a frame without muxing it.
+        :param tensor: The NV12 frame to encode.
+        :return: The encoded bytes and their timestamp, to be passed to `write_frame`.
+        """
         # Encode the frame takes tensor as input
         self.encoded_frame = self.nvEnc.Encode(tensor)
-
-        self.write_frame(
-            self.encoded_frame,
-            self.pts_time,
-            self.fps,
-            self.avstream,
-            self.container,
-        )
+        pts_time = self.pts_time
         self.pts_time += self.delta_t
 
+        return self.encoded_frame, pts_time
+
     # docs_tag: end_imp_nvvideoencoder
 
     # docs_tag: begin_writeframe_nvvideoencoder
-    def write_frame(self, encoded_frame, pts_time, fps, stream, container):
-        encoded_bytes = bytearray(encoded_frame)
-        pkt = av.packet.Packet(encoded_bytes)
+    def write_frame(self, encoded_frame, pts_time, stream, container):
+        # The packet copies the encoded bytes straight out of the encoder's buffer.
+        pkt = av.packet.Packet(as_buffer(encoded_frame))
         pkt.pts = pts_time
         pkt.dts = pts_time
         pkt.stream = stream
-        pkt.time_base = 1 / Fraction(fps)
+        pkt.time_base = stream.time_base
         container.mux(pkt)
 
+    def write_frames(self, encoded_frames):
+        """
+        Writes several encoded frames at once.
+        :param encoded_frames: A list of (encoded bytes, timestamp) as returned by `encode`.
+        """
+        if self.raw_output:
+            # An Annex-B elementary stream is just the encoded packets back to back.
+            self.raw_file.writelines(
+                [as_buffer(encoded_frame) for encoded_frame, _ in encoded_frames]
+            )
+            return
+
+        packets = []
+        for encoded_frame, pts_time in encoded_frames:
+            pkt = av.packet.Packet(as_buffer(encoded_frame))
+            pkt.pts = pts_time
+            pkt.dts = pts_time
+            pkt.stream = self.avstream
+            pkt.time_base = self.avstream.time_base
+            packets.append(pkt)
+        self.container.mux(packets)
+
     # docs_tag: end_writeframe_nvvideoencoder
 
     def flush(self):
-        encoded_bytes = self.nvEnc.EndEncode()
+        encoded_bytes, pts_time = self.end_encode()
         if encoded_bytes:
-            self.write_frame(
-                encoded_bytes,
-                self.pts_time,
-                self.fps,
-                self.avstream,
-                self.container,
-            )
+            self.write_frames([(encoded_bytes, pts_time)])
+        self.close()
+
+    def end_encode(self):
+        """
+        Flushes the encoder without muxing the remaining bytes.
+        :return: The remaining encoded bytes and their timestamp.
+        """
+        encoded_bytes = self.nvEnc.EndEncode()
+        pts_time = self.pts_time
         self.pts_time += self.delta_t
-        self.container.close()
+
+        return encoded_bytes, pts_time
+
+    def close(self):
+        if self.raw_output:
+            self.raw_file.close()
+        else:
+            self.container.close()
 
 
 
@@ -466,7 +939,18 @@ class ImageBatchDecoder:
         cuda_ctx,
         cuda_stream,
         cvcuda_perf,
+        prefetch_batches=0,
+        decode_ahead=False,
+        read_workers=8,
     ):
+        """
+        Initializes a new instance of the `ImageBatchDecoder` class.
+        :param prefetch_batches: The number of upcoming batches whose files are read
+         on a thread pool while the current batch is being processed. 0 disables it.
+        :param decode_ahead: Also decode the prefetched batches in the background as soon
+         as their files have been read. Only used if prefetch_batches is > 0.
+        :param read_workers: The number of threads reading the files when prefetching.
+        """
 
         # docs_tag: begin_init_imagebatchdecoder_nvimagecodec
         self.logger = logging.getLogger(__name__)
@@ -514,6 +998,33 @@ class ImageBatchDecoder:
 
         self.max_image_size = 1024 * 1024 * 3  # Maximum possible image size.
 
+        # Setup the prefetching of the upcoming batches, if requested.
+        self.prefetch_batches = prefetch_batches
+        self.decode_ahead = decode_ahead and prefetch_batches > 0
+        self.read_pool = None
+        self.decode_pool = None
+        self.prefetched = collections.deque()  # One entry per batch, in order.
+        self.next_prefetch_idx = 0
+        if self.prefetch_batches > 0:
+            self.read_pool = ThreadPoolExecutor(
+                max_workers=read_workers,
+                thread_name_prefix="decoder.read",
+            )
+            if self.decode_ahead:
+                # A single thread keeps the batches decoded in order.
+                self.decode_pool = ThreadPoolExecutor(
+                    max_workers=1,
+                    thread_name_prefix="decoder.decode",
+                )
+            self.logger.info(
+                "Prefetching %d batches using %d reader threads%s."
+                % (
+                    self.prefetch_batches,
+                    read_workers,
+                    " and decoding them ahead" if self.decode_ahead else "",
+                )
+            )
+
         self.logger.info(
             "Using nvImageCodec decoder version: %s" % nvimgcodec.__version__
         )
@@ -529,21 +1040,22 @@ class ImageBatchDecoder:
 
         file_name_batch = self.file_name_batches[self.batch_idx]
 
-        data_batch = [open(path, "rb").read() for path in file_name_batch]
-
-        # docs_tag: begin_decode_imagebatchdecoder_nvimagecodec
+        if self.prefetch_batches > 0:
+            # Keep the next prefetch_batches batches in flight and take the current one.
+            self._prefetch()
+            pending = self.prefetched.popleft()
+            self._prefetch()
 
-        tensor_list = []
-        image_list = self.decoder.decode(data_batch, cuda_stream=self.cuda_stream)
-
-        # Convert the decoded images to nvcv tensors in a list.
-        for i in range(len(image_list)):
-            tensor_list.append(cvcuda.as_tensor(image_list[i], "HWC"))
+            if self.decode_ahead:
+                cvcuda_decoded_tensor = pending.result()
+            else:
+                data_batch = [future.result() for future in pending]
+                cvcuda_decoded_tensor = self._decode(data_batch)
+        else:
+            data_batch = [self._read_file(path) for path in file_name_batch]
+            cvcuda_decoded_tensor = self._decode(data_batch)
 
-        # Stack the list of tensors to a single NHWC tensor.
-        cvcuda_decoded_tensor = cvcuda.stack(tensor_list)
-        self.total_decoded += len(tensor_list)
-        # docs_tag: end_decode_imagebatchdecoder_nvimagecodec
+        self.total_decoded += cvcuda_decoded_tensor.shape[0]
 
         # docs_tag: begin_return_imagebatchdecoder_nvimagecodec
         batch = Batch(
@@ -557,15 +1069,67 @@ class ImageBatchDecoder:
 
         self.cvcuda_perf.pop_range()
         # docs_tag: end_call_imagebatchdecoder_nvimagecodec
+        return batch
+
+    def _read_file(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _decode(self, data_batch):
+        # docs_tag: begin_decode_imagebatchdecoder_nvimagecodec
+
+        tensor_list = []
+        image_list = self.decoder.decode(data_batch, cuda_stream=self.cuda_stream)
+
+        # Convert the decoded images to nvcv tensors in a list.
+        for i in range(len(image_list)):
+            tensor_list.append(cvcuda.as_tensor(image_list[i], "HWC"))
+
+        # Stack the list of tensors to a single NHWC tensor.
+        cvcuda_decoded_tensor = cvcuda.stack(tensor_list)
+        # docs_tag: end_decode_imagebatchdecoder_nvimagecodec
+
         #WAR sync the default stream, since processing is on the active cvcuda stream
         self.cuda_stream.sync() #WAR
-        return batch
+        return cvcuda_decoded_tensor
+
+    def _decode_ahead(self, read_futures):
+        # Runs on the decode thread, which needs the CUDA context of the decoder.
+        self.cuda_ctx.push()
+        try:
+            data_batch = [future.result() for future in read_futures]
+            with self.cuda_stream:
+                return self._decode(data_batch)
+        finally:
+            self.cuda_ctx.pop()
+
+    def _prefetch(self):
+        # Submit the reads (and decodes) of the batches which are not in flight yet.
+        while (
+            len(self.prefetched) < self.prefetch_batches
+            and self.next_prefetch_idx < len(self.file_name_batches)
+        ):
+            read_futures = [
+                self.read_pool.submit(self._read_file, path)
+                for path in self.file_name_batches[self.next_prefetch_idx]
+            ]
+            if self.decode_ahead:
+                self.prefetched.append(
+                    self.decode_pool.submit(self._decode_ahead, read_futures)
+                )
+            else:
+                self.prefetched.append(read_futures)
+            self.next_prefetch_idx += 1
 
     def start(self):
-        pass
+        if self.prefetch_batches > 0:
+            self._prefetch()
 
     def join(self):
-        pass
+        if self.read_pool is not None:
+            self.read_pool.shutdown(wait=True, cancel_futures=True)
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown(wait=True, cancel_futures=True)
 
 
 # docs_tag: end_imagebatchdecoder_nvimagecodec
@@ -0,0 +1,201 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+onnxruntime_utils
+
+This file hosts the helper which runs the ONNX models of the samples on the CPU with
+ONNX Runtime.
+"""
+
+import sys
+import logging
+import numpy as np
+import torch
+import onnxruntime as ort
+
+# Bring the commons folder from the samples directory into our path so that
+# we can import modules from it.
+sys.path.append('../')
+
+from common.interop_utils import pinned_buffer_pool  # noqa: E402
+
+# The numpy data types of the ONNX tensor types used by the samples.
+ONNX_TO_NUMPY_DTYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(int32)": np.int32,
+    "tensor(int64)": np.int64,
+}
+
+
+class OnnxRuntimeInference:
+    """
+    Runs an ONNX model with a single input on the CPU with ONNX Runtime.
+    With IO binding, the outputs are written straight into tensors allocated once at
+    the largest batch size, instead of new arrays on every call. Smaller batches are
+    written to the beginning of them.
+    Inputs on the GPU are copied to pinned host memory first, and the outputs are copied
+    back to the GPU, so that the CV-CUDA pre and post-processing of the samples can be
+    kept as is. Inputs on the CPU get their outputs on the CPU.
+    """
+
+    def __init__(
+        self,
+        onnx_file_path,
+        max_batch_size,
+        intra_op_threads=0,
+        inter_op_threads=0,
+        io_binding=True,
+    ):
+        """
+        Initializes a new instance of the `OnnxRuntimeInference` class.
+        :param onnx_file_path: Full path to the ONNX file.
+        :param max_batch_size: The largest batch size the outputs are allocated for.
+        :param intra_op_threads: The number of threads used to run an operator. 0 lets
+         ONNX Runtime use one per physical core.
+        :param inter_op_threads: The number of threads used to run independent operators
+         in parallel. 0 or 1 runs the operators one after the other.
+        :param io_binding: Bind the input and the pre-allocated outputs to the session
+         instead of passing them by name on every call.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.max_batch_size = max_batch_size
+
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        session_options.intra_op_num_threads = intra_op_threads
+        session_options.inter_op_num_threads = inter_op_threads
+        session_options.execution_mode = (
+            ort.ExecutionMode.ORT_PARALLEL
+            if inter_op_threads > 1
+            else ort.ExecutionMode.ORT_SEQUENTIAL
+        )
+
+        self.session = ort.InferenceSession(
+            onnx_file_path,
+            sess_options=session_options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_dtype = ONNX_TO_NUMPY_DTYPES[self.session.get_inputs()[0].type]
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+        self.io_binding = None
+        self.output_tensors = None
+        if io_binding:
+            self.io_binding = self.session.io_binding()
+            # Only outputs whose shape is known but for the batch size can be
+            # allocated up front. Others are allocated by ONNX Runtime.
+            output_shapes = [output.shape[1:] for output in self.session.get_outputs()]
+            if all(isinstance(dim, int) for shape in output_shapes for dim in shape):
+                self.output_tensors = [
+                    torch.from_numpy(
+                        np.empty(
+                            [max_batch_size] + list(shape),
+                            dtype=ONNX_TO_NUMPY_DTYPES[output.type],
+                        )
+                    )
+                    for shape, output in zip(output_shapes, self.session.get_outputs())
+                ]
+
+        self.logger.info(
+            "Created the ONNX Runtime session of %s with %d intra-op and %d inter-op "
+            "threads, IO binding %s."
+            % (
+                onnx_file_path,
+                intra_op_threads,
+                inter_op_threads,
+                "on" if io_binding else "off",
+            )
+        )
+
+    def __call__(self, tensor):
+        """
+        Runs the model on a batch.
+        :param tensor: The input batch, either a torch tensor, a numpy array or a
+         cvcuda tensor.
+        :return: A list of torch tensors, one per output of the model, on the device of
+         the input. Outputs on the CPU are overwritten by the next call.
+        """
+        device = None
+        if isinstance(tensor, np.ndarray):
+            host_array = tensor
+        else:
+            if not isinstance(tensor, torch.Tensor):
+                # Convert CVCUDA tensor to Torch tensor.
+                tensor = torch.as_tensor(tensor.cuda())
+            if tensor.is_cuda:
+                device = tensor.device
+                host_array = pinned_buffer_pool.copy_to_host(tensor.contiguous())
+            else:
+                host_array = tensor.numpy()
+        host_array = np.ascontiguousarray(host_array, dtype=self.input_dtype)
+
+        actual_batch_size = host_array.shape[0]
+        if actual_batch_size > self.max_batch_size:
+            raise ValueError(
+                "Batch size %d is larger than the maximum batch size %d."
+                % (actual_batch_size, self.max_batch_size)
+            )
+
+        if self.io_binding is None:
+            outputs = [
+                torch.from_numpy(output)
+                for output in self.session.run(
+                    self.output_names, {self.input_name: host_array}
+                )
+            ]
+        else:
+            self.io_binding.bind_input(
+                self.input_name,
+                "cpu",
+                0,
+                self.input_dtype,
+                list(host_array.shape),
+                host_array.ctypes.data,
+            )
+            if self.output_tensors is not None:
+                outputs = [
+                    output_tensor[:actual_batch_size]
+                    for output_tensor in self.output_tensors
+                ]
+                for name, output in zip(self.output_names, outputs):
+                    self.io_binding.bind_output(
+                        name,
+                        "cpu",
+                        0,
+                        output.numpy().dtype,
+                        list(output.shape),
+                        output.data_ptr(),
+                    )
+            else:
+                for name in self.output_names:
+                    self.io_binding.bind_output(name, "cpu")
+
+            self.session.run_with_iobinding(self.io_binding)
+
+            if self.output_tensors is None:
+                outputs = [
+                    torch.from_numpy(output)
+                    for output in self.io_binding.copy_outputs_to_cpu()
+                ]
+
+        if device is not None:
+            outputs = [output.to(device) for output in outputs]
+
+        return outputs
@@ -24,6 +24,7 @@ import logging
 from datetime import datetime
 import argparse
 import subprocess
+import threading
 from collections import deque
 import cvcuda
 import torch
@@ -76,9 +77,11 @@ class CvCudaPerf:
             raise ValueError("output_dir must be provided in the default_args.")
 
         self.logger = logging.getLogger(__name__)
-        # We will use a stack to record the push/pop range operations.
-        self.stack = deque()
-        self.stack_path = self.obj_name
+        # We will use a stack to record the push/pop range operations. NVTX ranges
+        # are nested per thread, so the stack, its path and the batch nesting level
+        # are kept per thread as well. See the properties below.
+        self.thread_state = threading.local()
+        self.lock = threading.Lock()
         # We will maintain 3 different dictionaries to store the data.
         # 1. timing_info: to store CPU and GPU timings of NVTX ranges.
         # 2. batch_info: to store batch size and batch index of NVTX ranges.
@@ -87,7 +90,6 @@ class CvCudaPerf:
         self.batch_info = {}
         self.inside_batch_info = []
         self.deleted_range_info = []
-        self.is_inside_batch = 0
         self.total_batches_processed = {}
         # Check if the benchmark.py script was used to run this. We do so
         # by checking whether an environment variable only set by that script is
@@ -103,6 +105,42 @@ class CvCudaPerf:
             )
         # self.logger.info("Using CV-CUDA version: %s" % cvcuda.__version__)
 
+    def _get_thread_state(self):
+        if not hasattr(self.thread_state, "stack"):
+            self.thread_state.stack = deque()
+            self.thread_state.stack_path = self.obj_name
+            self.thread_state.is_inside_batch = 0
+        return self.thread_state
+
+    @property
+    def stack(self):
+        return self._get_thread_state().stack
+
+    @property
+    def stack_path(self):
+        return self._get_thread_state().stack_path
+
+    @stack_path.setter
+    def stack_path(self, value):
+        self._get_thread_state().stack_path = value
+
+    @property
+    def is_inside_batch(self):
+        return self._get_thread_state().is_inside_batch
+
+    @is_inside_batch.setter
+    def is_inside_batch(self, value):
+        self._get_thread_state().is_inside_batch = value
+
+    def attach_thread(self, root_path):
+        """
+        Sets the path under which the ranges pushed by the calling thread are recorded.
+        Must be called from a worker thread before it pushes its first range.
+        :param root_path: The range path, usually the stack_path of the parent thread at the
+         time the worker was created, under which this thread's ranges should be nested.
+        """
+        self._get_thread_state().stack_path = root_path
+
     def push_range(
         self, message=None, color="blue", domain=None, category=None, batch_idx=None
     ):
@@ -138,54 +176,56 @@ class CvCudaPerf:
          remove its range in that case.
         """
         if self.should_benchmark:
-            # Grab the message and optional batch index from the stack.
-            message, batch_idx = self.stack.pop()
-
-            if not delete_range:
-                # Add only if this range was not meant for deletion.
-                self.timing_info[self.stack_path] = (
-                    0,
-                    0,
-                )  # Placeholders for CPU and GPU times respectively.
-                # Actual timing information will be recorded and pulled from NSYS by a
-                # script like benchmark.py.
-            else:
-                # This range was meant for deletion. We did not add it to the timing_info
-                # but all the previously added children of this range must also be deleted.
-                # We will do that later in the finalize to avoid costing us time here.
-                # For that, we will save this stack path so that we can remove all the
-                # orphan nodes later.
-                self.deleted_range_info.append(self.stack_path)
-
-            if self.is_inside_batch > 0 and not delete_range:
-                self.inside_batch_info.append(self.stack_path)
-
-            # Record the batch information if it was present.
-            if total_items is not None:
-                if self.is_inside_batch <= 0:
-                    raise ValueError(
-                        "Non zero value for total_items in pop_range can only be "
-                        "passed once inside a batch. No known batch was pushed previously. Please "
-                        "push a batch first by using the batch_idx in the push_range()."
-                    )
-
-                self.is_inside_batch -= 1  # Decrement this by one.
+            # The dictionaries below are shared by all the threads.
+            with self.lock:
+                # Grab the message and optional batch index from the stack.
+                message, batch_idx = self.stack.pop()
 
                 if not delete_range:
-                    # Add to batch info only if this range was not meant for deletion.
-                    self.batch_info[self.stack_path] = (batch_idx, total_items)
-
-                    # Maintain a count of the number of items processed in various batches.
-                    if total_items > 0:
-                        batch_level_prefix = os.path.dirname(self.stack_path)
-
-                        if batch_level_prefix not in self.total_batches_processed:
-                            self.total_batches_processed[batch_level_prefix] = 0
-                        self.total_batches_processed[batch_level_prefix] += 1
-
-            # Unwind the stack to point to the previous path(i.e. directory like expression)
-            # e.g. one level above.
-            self.stack_path = os.path.dirname(self.stack_path)
+                    # Add only if this range was not meant for deletion.
+                    self.timing_info[self.stack_path] = (
+                        0,
+                        0,
+                    )  # Placeholders for CPU and GPU times respectively.
+                    # Actual timing information will be recorded and pulled from NSYS by a
+                    # script like benchmark.py.
+                else:
+                    # This range was meant for deletion. We did not add it to the timing_info
+                    # but all the previously added children of this range must also be deleted.
+                    # We will do that later in the finalize to avoid costing us time here.
+                    # For that, we will save this stack path so that we can remove all the
+                    # orphan nodes later.
+                    self.deleted_range_info.append(self.stack_path)
+
+                if self.is_inside_batch > 0 and not delete_range:
+                    self.inside_batch_info.append(self.stack_path)
+
+                # Record the batch information if it was present.
+                if total_items is not None:
+                    if self.is_inside_batch <= 0:
+                        raise ValueError(
+                            "Non zero value for total_items in pop_range can only be "
+                            "passed once inside a batch. No known batch was pushed previously. Please "
+                            "push a batch first by using the batch_idx in the push_range()."
+                        )
+
+                    self.is_inside_batch -= 1  # Decrement this by one.
+
+                    if not delete_range:
+                        # Add to batch info only if this range was not meant for deletion.
+                        self.batch_info[self.stack_path] = (batch_idx, total_items)
+
+                        # Maintain a count of the number of items processed in various batches.
+                        if total_items > 0:
+                            batch_level_prefix = os.path.dirname(self.stack_path)
+
+                            if batch_level_prefix not in self.total_batches_processed:
+                                self.total_batches_processed[batch_level_prefix] = 0
+                            self.total_batches_processed[batch_level_prefix] += 1
+
+                # Unwind the stack to point to the previous path(i.e. directory like expression)
+                # e.g. one level above.
+                self.stack_path = os.path.dirname(self.stack_path)
 
         nvtx.pop_range(domain)
 
@@ -587,12 +627,21 @@ def get_default_arg_parser(
     backend="tensorrt",
     log_level="info",
     parser_type="vision",
+    features=[],
 ):
     """
     Prepares and returns an argparse command line argument parser for the scripts
     that supports auto-benchmarking. This parser guarantees that all the scripts which can be
     benchmarked supports a basic set of command line arguments which allows us to run
     them in a uniform and consistent fashion.
+    The optional features of a vision sample add their own group of arguments:
+        pipeline: The threaded pipeline.
+        video_output: The multi-video mode and the output video encoding options.
+        tensorrt: The TensorRT engine options, and its background build if the sample
+            also supports the PyTorch backend.
+        pytorch: The PyTorch model options.
+        tensorflow: The TensorFlow model options.
+        onnxruntime: The ONNX Runtime session options.
     """
 
     # Check what kind of parser the user needs.
@@ -605,6 +654,23 @@ def get_default_arg_parser(
     if parser_type not in ["vision", "minimal"]:
         raise ValueError("parser_type must either be 'vision' or 'minimal.")
 
+    all_features = [
+        "pipeline",
+        "video_output",
+        "tensorrt",
+        "pytorch",
+        "tensorflow",
+        "onnxruntime",
+    ]
+    for feature in features:
+        if feature not in all_features:
+            raise ValueError(
+                "Unknown feature: %s. Must be one of %s."
+                % (feature, ", ".join(all_features))
+            )
+    if parser_type != "vision":
+        features = []
+
     assets_dir = os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
         "assets",
@@ -694,6 +760,222 @@ def get_default_arg_parser(
             % ", ".join(supported_backends),
         )
 
+    if parser_type == "vision":
+        parser.add_argument(
+            "-pb",
+            "--prefetch_batches",
+            default=0,
+            type=int,
+            help="The number of upcoming batches of images whose files are read in the "
+            "background while the current batch is being processed. 0 disables prefetching. "
+            "Only used with image inputs.",
+        )
+
+        parser.add_argument(
+            "-da",
+            "--decode_ahead",
+            action="store_true",
+            help="Also decode the prefetched batches of images in the background. Only used "
+            "if --prefetch_batches is > 0.",
+        )
+
+    if "video_output" in features and supports_video:
+        parser.add_argument(
+            "-mv",
+            "--multi_video",
+            action="store_true",
+            help="Treat input_path as a directory of MP4 videos which are decoded together. "
+            "Every batch is filled with frames from all the videos and the results of every "
+            "video are written to a video of its own.",
+        )
+
+        parser.add_argument(
+            "-ae",
+            "--async_encode",
+            action="store_true",
+            help="Encode and write the output videos on background threads instead of "
+            "in the pipeline itself.",
+        )
+
+        parser.add_argument(
+            "-rv",
+            "--raw_video_output",
+            action="store_true",
+            help="Write the output videos as raw H.264 elementary streams (.h264) instead "
+            "of MP4 files.",
+        )
+
+    if "tensorrt" in features:
+        parser.add_argument(
+            "-tpb",
+            "--trt_profile_batch_sizes",
+            nargs="+",
+            type=int,
+            default=None,
+            help="Additional batch sizes the TensorRT engine gets an optimization profile "
+            "for, e.g. 1 4 8 32. Every batch runs with the profile best suited to its size "
+            "and the same engine can serve any batch size up to the largest of these and "
+            "batch_size. Only used with the TensorRT backend.",
+        )
+
+        parser.add_argument(
+            "-tpr",
+            "--trt_precision",
+            type=str,
+            choices=["int8", "fp16", "fp32"],
+            default=None,
+            help="The precision of the TensorRT engine. int8 engines are calibrated on the "
+            "images of --calibration_dir the first time they are built, later builds reuse "
+            "the calibration cache stored next to the engines. Defaults to the precision "
+            "the sample's model is meant for. Only used with the TensorRT backend.",
+        )
+
+        parser.add_argument(
+            "-cd",
+            "--calibration_dir",
+            default=os.path.join(assets_dir, "images"),
+            type=str,
+            help="A directory of JPEG images to calibrate int8 TensorRT engines with. Only "
+            "used if --trt_precision is int8.",
+        )
+
+        parser.add_argument(
+            "-tc",
+            "--trt_contexts",
+            default=1,
+            type=int,
+            help="The number of TensorRT execution contexts, each one with a CUDA stream "
+            "of its own. With more than one, the threaded pipeline keeps several batches "
+            "in inference at the same time. Only used with the TensorRT backend.",
+        )
+
+        parser.add_argument(
+            "-tcp",
+            "--trt_context_policy",
+            type=str,
+            choices=["round_robin", "least_busy"],
+            default="round_robin",
+            help="How the TensorRT execution context of a batch is picked. Only used if "
+            "--trt_contexts is > 1.",
+        )
+
+    if "tensorrt" in features and "pytorch" in supported_backends:
+        parser.add_argument(
+            "-tbb",
+            "--trt_background_build",
+            action="store_true",
+            help="Build the TensorRT engine in a worker process and run on the PyTorch "
+            "backend until it is ready, instead of waiting for the build before starting. "
+            "Only used with the TensorRT backend. Not supported with int8 precision.",
+        )
+
+    if "tensorrt" in features or "pytorch" in features:
+        parser.add_argument(
+            "-cg",
+            "--cuda_graphs",
+            action="store_true",
+            help="Capture the inference of every input shape into a CUDA graph and replay "
+            "it for the following batches of the same shape. Lowers the CPU launch overhead "
+            "of the inference, which matters most at small batch sizes.",
+        )
+
+    if "pytorch" in features:
+        parser.add_argument(
+            "-tim",
+            "--torch_inference_mode",
+            action="store_true",
+            help="Run the PyTorch model under torch.inference_mode instead of only "
+            "torch.no_grad. Only used with the PyTorch backend.",
+        )
+
+        parser.add_argument(
+            "-tcl",
+            "--torch_channels_last",
+            action="store_true",
+            help="Run the PyTorch model in the channels_last memory format. The "
+            "pre-processing then hands over NHWC tensors as they are, without converting "
+            "them to NCHW. Only used with the PyTorch backend.",
+        )
+
+        parser.add_argument(
+            "-tac",
+            "--torch_autocast",
+            type=str,
+            choices=["fp16", "bf16"],
+            default=None,
+            help="Run the PyTorch model under torch.autocast in this precision. Only used "
+            "with the PyTorch backend.",
+        )
+
+        parser.add_argument(
+            "-tco",
+            "--torch_compile",
+            type=str,
+            choices=["default", "reduce-overhead", "max-autotune"],
+            default=None,
+            help="Compile the PyTorch model with torch.compile in this mode. The first "
+            "batch of every shape warms the compiled model up and takes longer. Only used "
+            "with the PyTorch backend.",
+        )
+
+    if "tensorflow" in features:
+        parser.add_argument(
+            "-tfj",
+            "--tf_jit_compile",
+            action="store_true",
+            help="Run the TensorFlow model through a tf.function compiled with XLA, traced "
+            "once per batch size, instead of running it eagerly. The first batch of every "
+            "size takes longer. Only used with the TensorFlow backend.",
+        )
+
+    if "onnxruntime" in features:
+        parser.add_argument(
+            "-oia",
+            "--ort_intra_op_threads",
+            default=0,
+            type=int,
+            help="The number of threads ONNX Runtime uses to run an operator. 0 uses one "
+            "per physical core. Only used with the ONNX Runtime backend.",
+        )
+
+        parser.add_argument(
+            "-oie",
+            "--ort_inter_op_threads",
+            default=0,
+            type=int,
+            help="The number of threads ONNX Runtime uses to run independent operators in "
+            "parallel. 0 or 1 runs them one after the other. Only used with the ONNX "
+            "Runtime backend.",
+        )
+
+        parser.add_argument(
+            "-onb",
+            "--ort_no_io_binding",
+            action="store_true",
+            help="Pass the input and the outputs to ONNX Runtime by name on every call, "
+            "instead of binding them to the session. Only used with the ONNX Runtime "
+            "backend.",
+        )
+
+    if "pipeline" in features:
+        parser.add_argument(
+            "-tp",
+            "--threaded_pipeline",
+            action="store_true",
+            help="Run every stage of the pipeline in its own thread and CUDA stream so that "
+            "decoding, pre-processing, inference, post-processing and encoding of different "
+            "batches can overlap.",
+        )
+
+        parser.add_argument(
+            "-qd",
+            "--queue_depth",
+            default=2,
+            type=int,
+            help="The maximum number of batches waiting in between two stages of the "
+            "threaded pipeline.",
+        )
+
     if parser_type in ["vision", "minimal"]:
         parser.add_argument(
             "-ll",
@@ -739,6 +1021,39 @@ def parse_validate_default_args(parser):
                     % (torch.cuda.device_count() - 1)
                 )
 
+    if getattr(args, "trt_profile_batch_sizes", None):
+        if min(args.trt_profile_batch_sizes) <= 0:
+            raise ValueError("trt_profile_batch_sizes must only contain values >=1.")
+
+    if getattr(args, "trt_precision", None) == "int8":
+        if not os.path.isdir(args.calibration_dir):
+            raise ValueError(
+                "calibration_dir is not a valid directory: %s" % args.calibration_dir
+            )
+        # The worker process has no calibration batches to build an int8 engine with.
+        if getattr(args, "trt_background_build", False):
+            raise ValueError(
+                "trt_background_build is not supported with trt_precision int8."
+            )
+
+    if hasattr(args, "trt_contexts"):
+        if args.trt_contexts <= 0:
+            raise ValueError("trt_contexts must be a value >=1.")
+
+    if hasattr(args, "ort_intra_op_threads"):
+        if args.ort_intra_op_threads < 0 or args.ort_inter_op_threads < 0:
+            raise ValueError(
+                "ort_intra_op_threads and ort_inter_op_threads must be values >=0."
+            )
+
+    if hasattr(args, "prefetch_batches"):
+        if args.prefetch_batches < 0:
+            raise ValueError("prefetch_batches must be a value >=0.")
+
+    if hasattr(args, "queue_depth"):
+        if args.queue_depth <= 0:
+            raise ValueError("queue_depth must be a value >=1.")
+
     if hasattr(args, "target_img_height"):
         if args.target_img_height < 10:
             raise ValueError("target_img_height must be a value >=10.")
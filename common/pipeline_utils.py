@@ -0,0 +1,353 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+pipeline_utils
+
+This file hosts a threaded executor for the decode -> pre-process -> inference ->
+post-process -> encode pipelines of the samples.
+"""
+
+import os
+import queue
+import logging
+import threading
+import cvcuda
+import torch
+
+
+# Marks the end of the stream in the queues between the stages.
+_END_OF_STREAM = object()
+
+
+def get_pipeline_output_buffers(num_stages, queue_depth):
+    """
+    Returns the number of output buffers a stage of a `PipelineExecutor`, typically the
+    decoder, needs so that every stage can work on a different batch at the same time,
+    with queue_depth more batches of slack before it waits for the last stage.
+    :param num_stages: The number of stages of the pipeline, decoder and encoder included.
+    :param queue_depth: The queue_depth of the pipeline.
+    :return: The number of output buffers.
+    """
+    return num_stages + queue_depth
+
+
+class PipelineStage:
+    """
+    A single stage of a `PipelineExecutor`.
+    """
+
+    def __init__(
+        self,
+        name,
+        func,
+        output_buffers=None,
+        returns_ready_event=False,
+        host_input=False,
+    ):
+        """
+        Initializes a new instance of the `PipelineStage` class.
+        :param name: The name of the stage. Used for the thread and the NVTX ranges.
+        :param func: A callable which takes a `Batch` and returns the `Batch` for the next stage.
+        :param output_buffers: The number of pre-allocated output buffers the stage cycles
+         through, e.g. 1 if it writes every batch into the same tensor. The stage will not
+         start a batch until the batch which last used the same buffer has left the pipeline.
+         Use None if the stage allocates new outputs on every call.
+        :param returns_ready_event: Whether func returns a tuple of the `Batch` and a
+         `torch.cuda.Event` recorded once the batch is ready, e.g. because the stage runs
+         its work on streams of its own. The next stage waits for that event instead of
+         the stage's stream, which is free to start the next batch right away.
+        :param host_input: Whether func reads its batch on the host, e.g. numpy arrays the
+         previous stage copies asynchronously from the GPU. The stage then waits for the
+         batch to be ready on the host instead of on its stream.
+        """
+        self.name = name
+        self.func = func
+        self.output_buffers = output_buffers
+        self.returns_ready_event = returns_ready_event
+        self.host_input = host_input
+
+
+class PipelineExecutor:
+    """
+    Runs the stages of a sample pipeline concurrently, each one in its own thread and on
+    its own CUDA stream, so that NVDEC, the CV-CUDA kernels, the inference engine and NVENC
+    can work on different batches at the same time.
+    Stages are connected by bounded FIFO queues and each stage processes its batches one
+    by one, hence the batch order is preserved from the decoder all the way to the encoder.
+    Work is handed over from one stage to the next with CUDA events, the streams are
+    never synchronized with the host. The host side waits are done by a stage which
+    re-uses its output buffers, once it runs that many batches ahead of the last stage,
+    and by a stage reading its batches on the host, e.g. an encoder taking CPU input.
+    Give it at least `get_pipeline_output_buffers` buffers so that all the stages can
+    work on a batch of their own at the same time.
+    """
+
+    def __init__(
+        self,
+        decoder,
+        stages,
+        encoder,
+        device_id,
+        cuda_ctx,
+        cuda_stream,
+        cvcuda_perf,
+        queue_depth=2,
+    ):
+        """
+        Initializes a new instance of the `PipelineExecutor` class.
+        :param decoder: The decoder object. Called without arguments, it must return
+         a `Batch` or None once all the data has been decoded.
+        :param stages: A list of `PipelineStage` to run on every batch, in order.
+        :param encoder: Optional. The encoder object which consumes the `Batch` returned
+         by the last stage.
+        :param device_id: The GPU device to use.
+        :param cuda_ctx: A cuda context object. It is made current in every worker thread.
+        :param cuda_stream: The CVCUDA stream the decoder was created with. It is used to run
+         the decoder. All the other stages get a stream of their own.
+        :param cvcuda_perf: The `CvCudaPerf` object used for the NVTX ranges.
+        :param queue_depth: The maximum number of batches waiting in between two stages.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.decoder = decoder
+        self.encoder = encoder
+        self.device_id = device_id
+        self.cuda_ctx = cuda_ctx
+        self.cvcuda_perf = cvcuda_perf
+        self.queue_depth = queue_depth
+
+        self.stages = [
+            PipelineStage(
+                "decode",
+                lambda _: self.decoder(),
+                getattr(self.decoder, "output_buffers", None),
+            )
+        ]
+        self.stages.extend(stages)
+        if self.encoder is not None:
+            self.stages.append(
+                PipelineStage(
+                    "encode",
+                    self.encoder,
+                    host_input=not getattr(self.encoder, "gpu_input", True),
+                )
+            )
+
+        self.streams = [cuda_stream] + [cvcuda.Stream() for _ in self.stages[1:]]
+        self.queues = [
+            queue.Queue(maxsize=self.queue_depth) for _ in self.stages[1:]
+        ]
+
+        # CUDA events recorded once a batch has left the last stage, keyed by batch index.
+        # Stages re-using their output buffers wait on these before overwriting them.
+        self.done_events = {}
+        self.done_events_cond = threading.Condition()
+        self.max_output_buffers = max(
+            [stage.output_buffers or 0 for stage in self.stages]
+        )
+
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.total_batches = 0
+        self.threads = []
+
+        self.logger.info(
+            "Using a threaded pipeline with stages: %s"
+            % ", ".join([stage.name for stage in self.stages])
+        )
+
+    def start(self):
+        """
+        Starts the decoder, the encoder and one worker thread per stage.
+        """
+        self.decoder.start()
+        if self.encoder is not None:
+            self.encoder.start()
+
+        root_path = self.cvcuda_perf.stack_path
+        for stage_idx, stage in enumerate(self.stages):
+            thread = threading.Thread(
+                target=self._worker,
+                args=(stage_idx, os.path.join(root_path, stage.name)),
+                name="pipeline.%s" % stage.name,
+                daemon=True,
+            )
+            self.threads.append(thread)
+            thread.start()
+
+    def join(self):
+        """
+        Waits for all the batches to go through the pipeline and then joins the decoder
+        and the encoder. Re-raises the first error raised by any of the stages.
+        :return: The number of batches which went through all the stages.
+        """
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        if self.errors:
+            raise self.errors[0]
+
+        self.decoder.join()
+        if self.encoder is not None:
+            self.encoder.join()
+
+        return self.total_batches
+
+    def run(self):
+        """
+        Runs the full pipeline until the decoder runs out of data.
+        :return: The number of batches which went through all the stages.
+        """
+        self.start()
+        return self.join()
+
+    def _put(self, out_queue, item):
+        # Do not block forever on a full queue if a downstream stage has failed.
+        while not self.stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, in_queue):
+        while not self.stop_event.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END_OF_STREAM
+
+    def _wait_buffer_release(self, stage, batch_idx, torch_stream):
+        # The batch which used the same output buffer before this one must have
+        # left the pipeline before the stage can write into the buffer again.
+        release_idx = batch_idx - stage.output_buffers
+        if release_idx < 0:
+            return True
+
+        with self.done_events_cond:
+            while release_idx not in self.done_events:
+                if self.stop_event.is_set():
+                    return False
+                self.done_events_cond.wait(timeout=0.1)
+            release_event = self.done_events[release_idx]
+
+        torch_stream.wait_event(release_event)
+        return True
+
+    def _record_batch_tensors(self, batch, torch_stream):
+        # Torch tensors allocated by an upstream stage are now used on this stream as well.
+        # Let the PyTorch caching allocator know so that it does not hand their memory out
+        # again before this stream is done with them.
+        for value in vars(batch).values():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for tensor in values:
+                if isinstance(tensor, torch.Tensor) and tensor.is_cuda:
+                    tensor.record_stream(torch_stream)
+
+    def _mark_done(self, batch_idx, torch_stream):
+        done_event = torch.cuda.Event()
+        done_event.record(torch_stream)
+
+        with self.done_events_cond:
+            self.done_events[batch_idx] = done_event
+            # Nobody waits on events older than the largest number of buffers.
+            self.done_events.pop(batch_idx - self.max_output_buffers - 1, None)
+            self.done_events_cond.notify_all()
+
+        self.total_batches += 1
+
+    def _worker(self, stage_idx, perf_root_path):
+        stage = self.stages[stage_idx]
+        is_source = stage_idx == 0
+        is_sink = stage_idx == len(self.stages) - 1
+        in_queue = None if is_source else self.queues[stage_idx - 1]
+        out_queue = None if is_sink else self.queues[stage_idx]
+
+        cvcuda_stream = self.streams[stage_idx]
+
+        self.cuda_ctx.push()
+        self.cvcuda_perf.attach_thread(perf_root_path)
+
+        batch_idx = 0
+        try:
+            torch_stream = torch.cuda.ExternalStream(cvcuda_stream.handle)
+            with cvcuda_stream, torch.cuda.stream(torch_stream):
+                while not self.stop_event.is_set():
+                    if is_source:
+                        ready_event = None
+                        total_items = None
+                    else:
+                        item = self._get(in_queue)
+                        if item is _END_OF_STREAM:
+                            break
+                        batch, ready_event, total_items = item
+                        assert batch_idx == batch.batch_idx
+
+                    if stage.output_buffers and not self._wait_buffer_release(
+                        stage, batch_idx, torch_stream
+                    ):
+                        break
+
+                    # Wait, on the GPU, for the previous stage to finish this batch.
+                    # Stages reading the batch on the host wait for it on the host.
+                    if ready_event is not None:
+                        if stage.host_input:
+                            ready_event.synchronize()
+                        else:
+                            torch_stream.wait_event(ready_event)
+                        self._record_batch_tensors(batch, torch_stream)
+
+                    self.cvcuda_perf.push_range("batch", batch_idx=batch_idx)
+
+                    batch = stage.func(None if is_source else batch)
+                    if stage.returns_ready_event:
+                        batch, ready_event = batch
+                    else:
+                        ready_event = None
+                    if is_source:
+                        if batch is None:
+                            self.cvcuda_perf.pop_range(total_items=0)  # for batch
+                            break  # No more frames to decode
+                        assert batch_idx == batch.batch_idx
+                        total_items = batch.data.shape[0]
+                        self.logger.info("Processing batch %d" % batch_idx)
+
+                    self.cvcuda_perf.pop_range(total_items=total_items)  # for batch
+
+                    if is_sink:
+                        if ready_event is not None:
+                            torch_stream.wait_event(ready_event)
+                        self._mark_done(batch_idx, torch_stream)
+                    else:
+                        if ready_event is None:
+                            ready_event = torch.cuda.Event()
+                            ready_event.record(torch_stream)
+                        if not self._put(out_queue, (batch, ready_event, total_items)):
+                            break
+
+                    batch_idx += 1
+
+        except Exception as e:
+            self.logger.error("Pipeline stage %s failed: %s" % (stage.name, str(e)))
+            self.errors.append(e)
+            self.stop_event.set()
+
+        finally:
+            if out_queue is not None:
+                self._put(out_queue, _END_OF_STREAM)
+            self.cuda_ctx.pop()
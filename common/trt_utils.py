@@ -19,17 +19,31 @@ trt_utils
 This file hosts various TensorRT related utilities.
 """
 
+import os
+import sys
 import logging
+import collections
 import torch
 import numpy as np
 import tensorrt as trt
 
+# Bring the commons folder from the samples directory into our path so that
+# we can import modules from it.
+sys.path.append('../')
+
+from common.cuda_graph_utils import CudaGraphRunner  # noqa: E402
+from common.engine_cache import file_lock  # noqa: E402
+
 
 def convert_onnx_to_tensorrt(
     onnx_file_path,
     trt_engine_file_path,
     max_batch_size,
     max_workspace_size=5,
+    precision="fp16",
+    profile_batch_sizes=None,
+    calibrator=None,
+    timing_cache_path=None,
 ):
     """
     Converts an ONNX engine to a serialized TensorRT engine.
@@ -37,8 +51,29 @@ def convert_onnx_to_tensorrt(
     :param trt_engine_file_path: Full path to save the generated TensorRT Engine file.
     :param max_batch_size: The maximum batch size to use in the TensorRT engine.
     :param max_workspace_size: The maximum GPU memory that TensorRT can use (in GB.)
+    :param precision: Either "int8", "fp16" or "fp32". int8 and float16 are only used if
+     the GPU has fast support for them. Layers without an int8 implementation run in
+     float16 if possible.
+    :param profile_batch_sizes: Optional. A list of batch sizes, e.g. [1, 4, 8, 32], for
+     which the engine gets an optimization profile of its own. The profile of a batch size
+     is tuned for it and covers all the batch sizes above the previous one. Use
+     `get_optimization_profile_index` to pick the profile of a batch at runtime.
+     Only max_batch_size is used by default.
+    :param calibrator: An `EntropyCalibrator`. Required if precision is "int8".
+    :param timing_cache_path: Optional. Full path to a TensorRT timing cache file. The
+     kernel timings it holds are reused instead of being measured again and the new
+     ones are added to it once the engine is built. Created if needed.
     :return: True if engine was generated. False otherwise.
     """
+    if precision not in ["int8", "fp16", "fp32"]:
+        raise ValueError("Unknown precision: %s" % precision)
+    if precision == "int8" and calibrator is None:
+        raise ValueError("A calibrator is required to use the int8 precision.")
+
+    profile_batch_sizes = sorted(set(profile_batch_sizes or []) | {max_batch_size})
+    if profile_batch_sizes[0] <= 0:
+        raise ValueError("profile_batch_sizes must only contain values >=1.")
+
     current_log_level = logging.root.level
     if current_log_level == logging.INFO:
         trt_log_level = trt.Logger.INFO
@@ -62,12 +97,25 @@ def convert_onnx_to_tensorrt(
         config.set_memory_pool_limit(
             trt.MemoryPoolType.WORKSPACE, 1024 * 1024 * 1024 * max_workspace_size
         )  # Sets workspace size in GB.
-        if builder.platform_has_fast_fp16:
+        use_int8 = precision == "int8" and builder.platform_has_fast_int8
+        if use_int8:
+            config.set_flag(trt.BuilderFlag.INT8)
+            config.int8_calibrator = calibrator
+            if builder.platform_has_fast_fp16:
+                config.set_flag(trt.BuilderFlag.FP16)
+            trt_logger.log(trt.Logger.INFO, "Using precision : int8")
+        elif precision in ["int8", "fp16"] and builder.platform_has_fast_fp16:
             config.set_flag(trt.BuilderFlag.FP16)
             trt_logger.log(trt.Logger.INFO, "Using precision : float16")
         else:
             trt_logger.log(trt.Logger.INFO, "Using precision : float32")
 
+        if timing_cache_path:
+            timing_cache = config.create_timing_cache(
+                _read_timing_cache(timing_cache_path)
+            )
+            config.set_timing_cache(timing_cache, ignore_mismatch=False)
+
         # Parse model file
         trt_logger.log(
             trt.Logger.INFO, "Loading ONNX file from path %s " % onnx_file_path
@@ -77,23 +125,56 @@ def convert_onnx_to_tensorrt(
                 raise ValueError("Failed to parse the ONNX engine.")
 
         inputs = [network.get_input(i) for i in range(network.num_inputs)]
-        profile = builder.create_optimization_profile()
-        dynamic_inputs = False
-        for input_tensor in inputs:
-            if input_tensor.shape[0] == -1:
-                dynamic_inputs = True
-                min_shape = [1] + list(input_tensor.shape[1:])
-                opt_shape = [max_batch_size] + list(input_tensor.shape[1:])
-                max_shape = [max_batch_size] + list(input_tensor.shape[1:])
-                profile.set_shape(input_tensor.name, min_shape, opt_shape, max_shape)
+        dynamic_inputs = [
+            input_tensor for input_tensor in inputs if input_tensor.shape[0] == -1
+        ]
         if dynamic_inputs:
-            config.add_optimization_profile(profile)
+            # One profile per batch size, covering the batch sizes in between it and
+            # the previous one.
+            min_batch_size = 1
+            for batch_size in profile_batch_sizes:
+                profile = builder.create_optimization_profile()
+                for input_tensor in dynamic_inputs:
+                    min_shape = [min_batch_size] + list(input_tensor.shape[1:])
+                    opt_shape = [batch_size] + list(input_tensor.shape[1:])
+                    max_shape = [batch_size] + list(input_tensor.shape[1:])
+                    profile.set_shape(
+                        input_tensor.name, min_shape, opt_shape, max_shape
+                    )
+                config.add_optimization_profile(profile)
+                min_batch_size = batch_size + 1
+            trt_logger.log(
+                trt.Logger.INFO,
+                "Using optimization profiles for batch sizes: %s"
+                % ", ".join([str(b) for b in profile_batch_sizes]),
+            )
+
+            if use_int8:
+                # The calibration batches all have the batch size of the calibrator.
+                calibration_profile = builder.create_optimization_profile()
+                for input_tensor in dynamic_inputs:
+                    calibration_shape = [calibrator.get_batch_size()] + list(
+                        input_tensor.shape[1:]
+                    )
+                    calibration_profile.set_shape(
+                        input_tensor.name,
+                        calibration_shape,
+                        calibration_shape,
+                        calibration_shape,
+                    )
+                config.set_calibration_profile(calibration_profile)
 
         engine = builder.build_serialized_network(network, config)
 
         if not engine:
             raise ValueError("Failed to generate the TensorRT engine.")
 
+        if timing_cache_path:
+            _write_timing_cache(config, timing_cache, timing_cache_path)
+            trt_logger.log(
+                trt.Logger.INFO, "Updated TensorRT timing cache: %s" % timing_cache_path
+            )
+
         with open(trt_engine_file_path, "wb") as f:
             f.write(engine)
             trt_logger.log(
@@ -101,6 +182,162 @@ def convert_onnx_to_tensorrt(
             )
 
 
+def _read_timing_cache(timing_cache_path):
+    if not os.path.isfile(timing_cache_path):
+        return b""
+    with open(timing_cache_path, "rb") as f:
+        return f.read()
+
+
+def _write_timing_cache(config, timing_cache, timing_cache_path):
+    # Several engines may be built at the same time, e.g. by
+    # `build_engines_in_background`. Merge the timings other builds wrote since this one
+    # read the cache, under an exclusive lock, and rename the new file into place.
+    # The engine cache takes the same lock to evict the timing cache.
+    with file_lock("%s.lock" % timing_cache_path):
+        saved_timing_cache = _read_timing_cache(timing_cache_path)
+        if saved_timing_cache:
+            timing_cache.combine(
+                config.create_timing_cache(saved_timing_cache),
+                ignore_mismatch=False,
+            )
+
+        tmp_timing_cache_path = "%s.%d.tmp" % (timing_cache_path, os.getpid())
+        with open(tmp_timing_cache_path, "wb") as f:
+            f.write(timing_cache.serialize())
+        os.replace(tmp_timing_cache_path, timing_cache_path)
+
+
+class EntropyCalibrator(trt.IInt8EntropyCalibrator2):
+    """
+    Calibrates the int8 ranges of a TensorRT engine on batches of pre-processed images.
+    The resulting calibration cache is written to a file. Later builds of the same model
+    read it back and skip the calibration, on any GPU.
+    """
+
+    def __init__(self, batches, batch_size, device_id, cache_file_path):
+        """
+        Initializes a new instance of the `EntropyCalibrator` class.
+        :param batches: An iterable of pre-processed NCHW float32 batches, as torch or
+         CVCUDA tensors, e.g. the one returned by `decode_calibration_batches`. It is only
+         iterated if there is no calibration cache yet. May be None if there is one.
+        :param batch_size: The batch size of the calibration batches. Smaller batches, like
+         the last one, are padded by repeating their images.
+        :param device_id: The GPU device the batches are on.
+        :param cache_file_path: Full path to the calibration cache file.
+        """
+        trt.IInt8EntropyCalibrator2.__init__(self)
+        self.logger = logging.getLogger(__name__)
+        self.batches = batches
+        self.batch_size = batch_size
+        self.device_id = device_id
+        self.cache_file_path = cache_file_path
+        self.batch_iter = None
+        # TensorRT reads the current batch after get_batch has returned.
+        self.current_batch = None
+        self.total_batches = 0
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def get_batch(self, names):
+        if self.batches is None:
+            return None
+        if self.batch_iter is None:
+            self.batch_iter = iter(self.batches)
+
+        batch = next(self.batch_iter, None)
+        if batch is None:
+            self.logger.info(
+                "Calibrated on a total of %d batches." % self.total_batches
+            )
+            return None
+
+        if not isinstance(batch, torch.Tensor):
+            # Convert CVCUDA tensor to Torch tensor.
+            batch = torch.as_tensor(batch.cuda(), device="cuda:%d" % self.device_id)
+        if batch.shape[0] < self.batch_size:
+            repeats = -(-self.batch_size // batch.shape[0])
+            batch = torch.cat([batch] * repeats)[: self.batch_size]
+
+        self.current_batch = batch.float().contiguous()
+        # The batch must be ready by the time TensorRT reads it, on a stream of its own.
+        torch.cuda.synchronize(self.device_id)
+        self.total_batches += 1
+
+        return [self.current_batch.data_ptr()] * len(names)
+
+    def read_calibration_cache(self):
+        if not os.path.isfile(self.cache_file_path):
+            return None
+
+        self.logger.info("Using calibration cache: %s" % self.cache_file_path)
+        with open(self.cache_file_path, "rb") as f:
+            return f.read()
+
+    def write_calibration_cache(self, cache):
+        # Write next to the final file and rename it once complete, the cache may be
+        # read by another process at the same time.
+        tmp_cache_file_path = "%s.%d.tmp" % (self.cache_file_path, os.getpid())
+        with open(tmp_cache_file_path, "wb") as f:
+            f.write(cache)
+        os.replace(tmp_cache_file_path, self.cache_file_path)
+        self.logger.info("Wrote calibration cache: %s" % self.cache_file_path)
+
+
+def decode_calibration_batches(decoder, preprocess):
+    """
+    Yields the pre-processed batches of a decoder, to calibrate an engine with. Nothing
+    is decoded until the first batch is requested.
+    :param decoder: A decoder object, e.g. an `ImageBatchDecoder` reading a directory of
+     calibration images.
+    :param preprocess: A callable which takes the decoded frames of a batch and returns
+     the pre-processed NCHW tensor the network takes as input.
+    """
+    decoder.start()
+    try:
+        while True:
+            batch = decoder()
+            if batch is None:
+                break
+            yield preprocess(batch.data)
+    finally:
+        decoder.join()
+
+
+def get_optimization_profile_index(trt_model, input_name, batch_size):
+    """
+    Returns the index of the optimization profile of an engine best suited to a batch
+    size, i.e. the one with the smallest maximum batch size which can run it.
+    :param trt_model: A deserialized TensorRT engine.
+    :param input_name: The name of the input tensor whose first dimension is the batch.
+    :param batch_size: The actual batch size.
+    :return: The index of the optimization profile.
+    """
+    if trt_model.num_optimization_profiles <= 1:
+        return 0
+
+    best_profile_idx = None
+    best_max_batch_size = None
+    for profile_idx in range(trt_model.num_optimization_profiles):
+        min_shape, _, max_shape = trt_model.get_tensor_profile_shape(
+            input_name, profile_idx
+        )
+        if min_shape[0] <= batch_size <= max_shape[0] and (
+            best_max_batch_size is None or max_shape[0] < best_max_batch_size
+        ):
+            best_profile_idx = profile_idx
+            best_max_batch_size = max_shape[0]
+
+    if best_profile_idx is None:
+        raise ValueError(
+            "No optimization profile of the TensorRT engine supports a batch size of %d."
+            % batch_size
+        )
+
+    return best_profile_idx
+
+
 def setup_tensort_bindings(trt_model, batch_size, device_id, logger):
     """
     Setups the I/O bindings for a TensorRT engine for the first time.
@@ -142,7 +379,8 @@ def setup_tensort_bindings(trt_model, batch_size, device_id, logger):
                 # add it.
                 b_shape.insert(0, batch_size)
 
-            output = torch.zeros(
+            # Every output is written by TensorRT before it is read, no need to zero it.
+            output = torch.empty(
                 size=b_shape,
                 dtype=getattr(torch, b_dtype),
                 device="cuda:%d" % device_id,
@@ -153,3 +391,199 @@ def setup_tensort_bindings(trt_model, batch_size, device_id, logger):
             output_layer_names.append(b_name)
 
     return output_tensors, output_layer_names
+
+
+class _ExecutionSlot:
+    # One execution context of a `TensorRTContextPool` and the stream it runs on.
+    def __init__(self, context, device_id):
+        self.context = context
+        self.stream = torch.cuda.Stream(device=device_id)
+        self.profile_idx = 0
+        self.input_shape = None
+        # The index of the set of output tensors the context writes to.
+        self.output_set_idx = None
+        # The done events of the batches submitted to the context and their inputs,
+        # which must stay alive until the context is done reading them.
+        self.in_flight = collections.deque()
+        # The CUDA graphs of the context, per set of output tensors.
+        self.cuda_graphs = {}
+
+    def num_in_flight(self):
+        while self.in_flight and self.in_flight[0][0].query():
+            self.in_flight.popleft()
+        return len(self.in_flight)
+
+
+class TensorRTContextPool:
+    """
+    Runs several batches through the same TensorRT engine at the same time. Every
+    execution context of the pool has a stream of its own and the batches are handed
+    to them in turn, or to the one with the fewest batches in flight. Small batches,
+    which cannot keep the whole GPU busy on their own, can then overlap.
+    The outputs are written to one set of output tensors per context. The sets are used
+    in the order of the batches, no matter which context runs them, hence the outputs of
+    a batch are valid until as many batches as there are contexts have been submitted
+    after it.
+    """
+
+    def __init__(
+        self,
+        trt_model,
+        input_name,
+        num_contexts,
+        max_batch_size,
+        device_id,
+        policy="round_robin",
+        cuda_graphs=False,
+    ):
+        """
+        Initializes a new instance of the `TensorRTContextPool` class.
+        :param trt_model: A deserialized TensorRT engine.
+        :param input_name: The name of the input tensor of the engine.
+        :param num_contexts: The number of execution contexts. Every context takes its own
+         share of activation memory on the GPU.
+        :param max_batch_size: The largest batch size the engine supports.
+        :param device_id: The GPU device to use.
+        :param policy: Either "round_robin" or "least_busy". How the context of a batch is
+         picked.
+        :param cuda_graphs: Capture the inference of every input shape into a CUDA graph,
+         per context, and replay it.
+        """
+        if policy not in ["round_robin", "least_busy"]:
+            raise ValueError("Unknown context policy: %s" % policy)
+
+        self.logger = logging.getLogger(__name__)
+        self.trt_model = trt_model
+        self.input_name = input_name
+        self.device_id = device_id
+        self.policy = policy
+        self.use_cuda_graphs = cuda_graphs
+        self.total_submitted = 0
+
+        self.slots = [
+            _ExecutionSlot(trt_model.create_execution_context(), device_id)
+            for _ in range(num_contexts)
+        ]
+
+        self.output_tensor_sets = []
+        for _ in range(num_contexts):
+            output_tensors, self.output_layer_names = setup_tensort_bindings(
+                trt_model,
+                max_batch_size,
+                self.device_id,
+                self.logger,
+            )
+            self.output_tensor_sets.append(output_tensors)
+
+        self.logger.info(
+            "Using %d TensorRT execution contexts, picked %s."
+            % (num_contexts, self.policy.replace("_", " "))
+        )
+
+    def submit(self, tensor, stream_handle):
+        """
+        Runs a batch on one of the execution contexts. The batch starts once the work
+        already submitted to the given stream is done, without blocking that stream.
+        :param tensor: The input tensor, either a torch or a CVCUDA tensor.
+        :param stream_handle: The handle of the CUDA stream the input was produced on.
+        :return: A tuple of the list of output tensors, in the order of
+         `output_layer_names` and sliced to the batch size, and a `torch.cuda.Event`
+         recorded once they are ready.
+        """
+        actual_batch_size = tensor.shape[0]
+
+        # This also releases the inputs of the batches which are done.
+        num_in_flight = [slot.num_in_flight() for slot in self.slots]
+        if self.policy == "round_robin":
+            slot_idx = self.total_submitted % len(self.slots)
+        else:
+            # Ties go to the context which comes next in round robin order.
+            slot_idx = min(
+                range(len(self.slots)),
+                key=lambda i: (
+                    num_in_flight[i],
+                    (i - self.total_submitted) % len(self.slots),
+                ),
+            )
+        slot = self.slots[slot_idx]
+        output_set_idx = self.total_submitted % len(self.output_tensor_sets)
+        self.total_submitted += 1
+
+        # The context's stream waits, on the GPU, for the input to be ready.
+        ready_event = torch.cuda.Event()
+        ready_event.record(torch.cuda.ExternalStream(stream_handle))
+        slot.stream.wait_event(ready_event)
+
+        with torch.cuda.stream(slot.stream):
+            if self.use_cuda_graphs:
+                cuda_graphs = slot.cuda_graphs.get(output_set_idx)
+                if cuda_graphs is None:
+                    # A graph has the addresses of its output tensors baked in.
+                    cuda_graphs = CudaGraphRunner(
+                        lambda t: self._execute(
+                            slot,
+                            t,
+                            output_set_idx,
+                            torch.cuda.current_stream().cuda_stream,
+                        ),
+                        self.device_id,
+                        prepare_func=lambda t: self._prepare(
+                            slot, t, torch.cuda.current_stream().cuda_stream
+                        ),
+                    )
+                    slot.cuda_graphs[output_set_idx] = cuda_graphs
+                cuda_graphs(
+                    torch.as_tensor(tensor.cuda(), device="cuda:%d" % self.device_id)
+                )
+            else:
+                self._execute(slot, tensor, output_set_idx, slot.stream.cuda_stream)
+
+            done_event = torch.cuda.Event()
+            done_event.record(slot.stream)
+
+        slot.in_flight.append((done_event, tensor))
+
+        outputs = [
+            output_tensor[:actual_batch_size]
+            for output_tensor in self.output_tensor_sets[output_set_idx]
+        ]
+        return outputs, done_event
+
+    def _prepare(self, slot, tensor, stream_handle):
+        # Switches a context to the optimization profile best suited to the batch size
+        # and sets its input shape, unless they did not change since its previous batch.
+        # A CUDA graph replay does neither, so it is done before every replay too.
+        # Returns the index of the profile.
+        actual_batch_size = tensor.shape[0]
+
+        # Switch to the optimization profile best suited to the batch size.
+        profile_idx = get_optimization_profile_index(
+            self.trt_model, self.input_name, actual_batch_size
+        )
+        if profile_idx != slot.profile_idx:
+            slot.context.set_optimization_profile_async(profile_idx, stream_handle)
+            slot.profile_idx = profile_idx
+            slot.input_shape = None
+
+        if tuple(tensor.shape) != slot.input_shape:
+            assert slot.context.set_input_shape(self.input_name, tensor.shape)
+            slot.input_shape = tuple(tensor.shape)
+
+        return profile_idx
+
+    def _execute(self, slot, tensor, output_set_idx, stream_handle):
+        self._prepare(slot, tensor, stream_handle)
+
+        # With the round robin policy, a context always writes to the same outputs.
+        if output_set_idx != slot.output_set_idx:
+            for output_tensor, layer_name in zip(
+                self.output_tensor_sets[output_set_idx], self.output_layer_names
+            ):
+                slot.context.set_tensor_address(layer_name, output_tensor.data_ptr())
+            slot.output_set_idx = output_set_idx
+
+        slot.context.set_tensor_address(
+            self.input_name, tensor.cuda().__cuda_array_interface__["data"][0]
+        )
+
+        slot.context.execute_async_v3(stream_handle=stream_handle)
@@ -125,6 +125,32 @@ class VideoBatchStreamingEncoderVPF:
         self.encoder.container.close()
 
 
+class SurfacePlaneCAI:
+    """
+    Exposes the memory of a VPF surface plane through the CUDA array interface, so that
+    PyTorch can use it without any copies.
+    The plane belongs to the decoder: it is written on the decoder's stream and is only
+    valid until the next decode or flush call, which may recycle it for another frame.
+    Consumers must be ordered after `stream` and must be done with the plane before
+    the decoder's stream runs its next decode.
+    """
+
+    def __init__(self, surf_plane, stream):
+        """
+        :param surf_plane: The VPF surface plane.
+        :param stream: The handle of the CUDA stream the decoder wrote the plane on.
+        """
+        self.__cuda_array_interface__ = {
+            "shape": (surf_plane.Height(), surf_plane.Width()),
+            "strides": (surf_plane.Pitch(), surf_plane.ElemSize()),
+            "data": (int(surf_plane.GpuMem()), False),
+            "typestr": "|u1",
+            "version": 3,
+            # 0 is not allowed here, the legacy default stream is spelled 1.
+            "stream": int(stream) or 1,
+        }
+
+
 class nvstreamingdecoder:
     def __init__(self, side, logger):
         """
@@ -181,15 +207,31 @@ class nvstreamingdecoder:
         self.model_name = model_name
         self.model_version = model_version
 
-    def client_send(self, client, grpc_class, video_id, batch_size):
+    def client_send(self, client, grpc_class, video_id, batch_size, packets_per_request=1):
+        """
+        Demux the video and stream its packets to the server.
+        :param packets_per_request: The number of packets sent together in a single request.
+         With more than one, the packets are concatenated in one byte buffer and their start
+         offsets are sent along with it, which saves most of the per-message overhead on
+         low bitrate streams.
+        """
+        if packets_per_request <= 0:
+            raise ValueError("packets_per_request must be a value >=1.")
+
         # raw bytes of packet to set over Triton network
         packet = np.ndarray(shape=(0), dtype=np.uint8)
         # metadata of packet (timestamp, pos, bsl, etc.)
         packet_data = nvc.PacketData()
 
+        # packets, and their metadata, waiting to be sent in the next request
+        pending_packets = []
+        pending_meta_part1 = []
+        pending_meta_part2 = []
+
         is_first_packet = True
         is_last_packet = False
         packet_count = 0
+        request_count = 0
         packet_size = 0
         while True:
             # Demuxer has SYNC design, it guarantees to return a packet every time it's called.
@@ -208,48 +250,79 @@ class nvstreamingdecoder:
             # pos: byte offset (?)
             # bsl: bitstream length
             # duration: ?
-            meta_part0 = np.array(
-                [
-                    batch_size,
-                    self.w,
-                    self.h,
-                    self.fps,
-                    self.total_frames,
-                    self.pix_fmt.value,
-                    self.codec.value,
-                    self.cspace.value,
-                    self.crange.value,
-                ],
-                dtype=np.int32,
-            )  # get value for enums
-            meta_part1 = np.array(
-                [packet_data.key, packet_data.pts, packet_data.dts], dtype=np.int64
+            pending_meta_part1.append(
+                [packet_data.key, packet_data.pts, packet_data.dts]
+            )
+            pending_meta_part2.append(
+                [packet_data.pos, packet_data.bsl, packet_data.duration]
             )
-            meta_part2 = np.array(
-                [packet_data.pos, packet_data.bsl, packet_data.duration],
-                dtype=np.uint64,
+            # the demuxer writes every packet into the same array, keep a copy
+            # if it has to wait for the next ones.
+            pending_packets.append(
+                packet if packets_per_request == 1 else packet.copy()
             )
 
+            packet_count += 1
+            packet_size += len(packet)
+            self.logger.debug(
+                f"packet No. {packet_count}, size {packet.size}, pos {packet_data.pos} async sent to server"
+            ) if packet_count % 50 == 0 else None
+
+            if len(pending_packets) < packets_per_request and not is_last_packet:
+                continue
+
+            meta_part1 = np.array(pending_meta_part1, dtype=np.int64).reshape(-1)
+            meta_part2 = np.array(pending_meta_part2, dtype=np.uint64).reshape(-1)
+
             inputs = []
+            if len(pending_packets) == 1:
+                request_packet = pending_packets[0]
+            else:
+                request_packet = np.concatenate(pending_packets)
+                # start offset of each packet in the concatenated buffer
+                packet_offsets = np.cumsum(
+                    [0] + [len(p) for p in pending_packets[:-1]], dtype=np.uint64
+                )
+                inputs.append(
+                    grpc_class.InferInput(
+                        "PACKET_OFFSETS", packet_offsets.shape, "UINT64"
+                    )
+                )
+                inputs[-1].set_data_from_numpy(packet_offsets)
+
             inputs.append(
-                grpc_class.InferInput("PACKET_IN", packet.shape, "UINT8")
+                grpc_class.InferInput("PACKET_IN", request_packet.shape, "UINT8")
             )  # variable shape
+            inputs[-1].set_data_from_numpy(request_packet)
             inputs.append(grpc_class.InferInput("META1", meta_part1.shape, "INT64"))
+            inputs[-1].set_data_from_numpy(meta_part1)
             inputs.append(grpc_class.InferInput("META2", meta_part2.shape, "UINT64"))
+            inputs[-1].set_data_from_numpy(meta_part2)
             inputs.append(grpc_class.InferInput("FIRST_PACKET", [1], "BOOL"))
+            inputs[-1].set_data_from_numpy(np.array([is_first_packet], dtype=bool))
             inputs.append(grpc_class.InferInput("LAST_PACKET", [1], "BOOL"))
-            inputs[0].set_data_from_numpy(packet)
-            inputs[1].set_data_from_numpy(meta_part1)
-            inputs[2].set_data_from_numpy(meta_part2)
-            inputs[3].set_data_from_numpy(np.array([is_first_packet], dtype=bool))
-            inputs[4].set_data_from_numpy(np.array([is_last_packet], dtype=bool))
+            inputs[-1].set_data_from_numpy(np.array([is_last_packet], dtype=bool))
             if is_first_packet:  # optional, only send once for first packet
+                meta_part0 = np.array(
+                    [
+                        batch_size,
+                        self.w,
+                        self.h,
+                        self.fps,
+                        self.total_frames,
+                        self.pix_fmt.value,
+                        self.codec.value,
+                        self.cspace.value,
+                        self.crange.value,
+                    ],
+                    dtype=np.int32,
+                )  # get value for enums
                 inputs.append(grpc_class.InferInput("META0", meta_part0.shape, "INT32"))
-                inputs[5].set_data_from_numpy(meta_part0)
+                inputs[-1].set_data_from_numpy(meta_part0)
 
-            # IMPORTANT: streaming mode must process one video at a time for now.
-            # For advanced support of multi-video streaming, request_id may be used to represent the client ID
-            # and use sequence batcher (w/ multi-threading support) on server side to handle the response.
+            # The video id in the request_id tells the server which video the packet belongs to.
+            # Server keeps one session per video id and batches the frames of all the videos
+            # streaming at the same time together for inference.
             if is_first_packet:
                 is_first_packet = False
 
@@ -266,14 +339,13 @@ class nvstreamingdecoder:
                 model_version=self.model_version,
                 inputs=inputs,
                 outputs=outputs,
-                request_id=str(video_id) + "_" + str(packet_count),
+                request_id=str(video_id) + "_" + str(request_count),
             )
 
-            packet_count += 1
-            packet_size += len(packet)
-            self.logger.debug(
-                f"packet No. {packet_count}, size {packet.size}, pos {packet_data.pos} async sent to server"
-            ) if packet_count % 50 == 0 else None
+            request_count += 1
+            pending_packets = []
+            pending_meta_part1 = []
+            pending_meta_part2 = []
 
             if is_last_packet:
                 self.logger.debug(
@@ -285,22 +357,30 @@ class nvstreamingdecoder:
             f"video {str(video_id)} is async sent to server via packet bytestream."
             f"[width={self.w}, height={self.h}, total frames={self.total_frames}, "
             f"total packets={packet_count} (including one EOF packet), "
+            f"total requests={request_count}, "
             f"total bytes={packet_size // 1024 // 1024}(MB)]"
         )
 
-    def server_setup(self, device_id, cuda_ctx, cuda_str, metadata):
+    def server_setup(self, device_id, cuda_ctx, cuda_str, metadata, output_buffers=1):
         """
         Server-side initialization of HW-accelerated video decoder and streaming utilities.
         :param device_id: id of video card which will be used for decoding & processing.
         :param cuda_ctx: A cuda context object.
         :param cuda_str: A cuda stream object.
         :param metadata: video demux info.
+        :param output_buffers: The number of pre-allocated RGB batch tensors the decoder
+         cycles through. With more than one, a batch can still be in use while the next
+         one is decoded.
         Ref: https://github.com/NVIDIA/VideoProcessingFramework/blob/master/samples/SampleDemuxDecode.py
         """
         if self.side != "server":
             raise ValueError("server_setup must be called from server side")
 
         self.device_id, self.cuda_ctx, self.cuda_str = device_id, cuda_ctx, cuda_str
+        # The stream the decoder writes its surfaces on, as seen by PyTorch.
+        self.torch_decoder_stream = torch.cuda.ExternalStream(
+            self.cuda_str.handle, device="cuda:%d" % self.device_id
+        )
         (
             self.frame_batch_size,
             self.w,
@@ -368,16 +448,31 @@ class nvstreamingdecoder:
         # 1 height is Y luma that is full resolution
         # 1/2 height is UV chroma that is 2x2 down-scaled
         # Hence you would see YUV or NV12's H dimension 1.5 times the RGB's H dimension.
-        self.cvcuda_RGBtensor_batch = cvcuda.Tensor(
-            (self.frame_batch_size, self.h, self.w, 3),
-            nvcv.Type.U8,
-            nvcv.TensorLayout.NHWC,
-        )
+        if output_buffers <= 0:
+            raise ValueError("output_buffers must be a value >=1.")
+        # Batch number i is converted into the RGB tensor i % output_buffers.
+        self.cvcuda_RGBtensor_ring = [
+            cvcuda.Tensor(
+                (self.frame_batch_size, self.h, self.w, 3),
+                nvcv.Type.U8,
+                nvcv.TensorLayout.NHWC,
+            )
+            for _ in range(output_buffers)
+        ]
 
         # client send packets to server where Triton cannot do any effective batching on frame, therefore
         # server has to handle batching explicitly. Meanwhile, server recv call can't be blocking because
-        # it's the call is invoked per client request -- need to cache the frames and batch them
-        self.frame_batch = []
+        # it's the call is invoked per client request -- need to cache the frames and batch them.
+        # Each decoded surface is copied once, straight into its slot of this NV12 batch tensor.
+        self.torch_NV12tensor_batch = torch.empty(
+            (self.frame_batch_size, (self.h // 2) * 3, self.w, 1),
+            dtype=torch.uint8,
+            device="cuda:%d" % self.device_id,
+        )
+        self.cvcuda_NV12tensor_batch = cvcuda.as_tensor(
+            self.torch_NV12tensor_batch, nvcv.TensorLayout.NHWC
+        )
+        self.frame_batch_len = 0
         self.frame_batch_idx = 0
 
     def server_recv(self, packet, packet_data1, packet_data2, is_last_packet):
@@ -411,7 +506,7 @@ class nvstreamingdecoder:
         if not surface_nv12.Empty():
             # valid surface is decoded
             self.total_decoded += 1
-            self.frame_batch.append(self.surface_to_tensor(surface_nv12))
+            self.surface_to_tensor(surface_nv12)
 
             # edge case: valid surface is decoded, but it's also the at last packet
             # need to flush and use irregular batch instead of entering batch size check
@@ -420,51 +515,78 @@ class nvstreamingdecoder:
                 ret = self.flush()
                 return ret
 
-            if len(self.frame_batch) == self.frame_batch_size:
+            if self.frame_batch_len == self.frame_batch_size:
                 self.logger.log_info(
                     f"[Decoder] Batch {self.frame_batch_idx} of size {self.frame_batch_size} is decoded"
                 ) if self.frame_batch_idx % 50 == 0 else None
 
-                # [N,H,W]
-                image_tensor_nhwc = torch.stack(self.frame_batch)
-                # [N,H,W] to [N,H,W,1] 4D torch tensor
-                image_tensor_nhwc = torch.unsqueeze(image_tensor_nhwc, -1)
-                # Make it a CVCUDA Tensor, C will be 1.
-                cvcuda_NV12tensor = cvcuda.as_tensor(
-                    image_tensor_nhwc, nvcv.TensorLayout.NHWC
-                )
                 # Convert from NV12 to RGB. This will be NHWC.
+                cvcuda_RGBtensor_batch = self.cvcuda_RGBtensor_ring[
+                    self.frame_batch_idx % len(self.cvcuda_RGBtensor_ring)
+                ]
                 cvcuda.cvtcolor_into(
-                    self.cvcuda_RGBtensor_batch, cvcuda_NV12tensor, self.cvcuda_code
+                    cvcuda_RGBtensor_batch,
+                    self.cvcuda_NV12tensor_batch,
+                    self.cvcuda_code,
                 )
 
                 # reset
-                self.frame_batch = []
+                self.frame_batch_len = 0
                 self.frame_batch_idx += 1
 
-                return self.cvcuda_RGBtensor_batch
+                return cvcuda_RGBtensor_batch
         else:
             # no valid surface available. Two cases:
             # (1) async, accumulated packets are not sufficient yet. Need to keep going
             # (2) reach the end of packet stream. Need to flush.
-            # Note: there could be some unbatched frame remained
-            # in frame_batch list that we need to concatenate. So the last batch has arbitrary length
+            # Note: there could be some unbatched frames remained
+            # in the batch tensor that we need to convert too. So the last batch has arbitrary length
             if is_last_packet:
                 ret = self.flush()
                 return ret
             else:
                 return None
 
+    def server_recv_packets(
+        self, packets, packet_data1, packet_data2, packet_offsets, is_last_packet
+    ):
+        """
+        Decode all the packets of a request, which the client may have coalesced into
+        one buffer, and yield every batch of frames as soon as it is complete.
+        The batches are decoded lazily so that each one can be consumed before the
+        next one is written into the output tensors.
+        :param packets: The raw bytes of the packets, concatenated.
+        :param packet_data1: key,pts,dts of every packet, flattened.
+        :param packet_data2: pos,bsl,duration of every packet, flattened.
+        :param packet_offsets: The start offset of every packet in `packets`, or None if
+         the request holds a single packet.
+        :param is_last_packet: Whether the last packet of the request is the last one
+         of the video.
+        """
+        if packet_offsets is None:
+            packet_offsets = [0]
+        packet_data1 = np.reshape(packet_data1, (-1, 3))
+        packet_data2 = np.reshape(packet_data2, (-1, 3))
+        num_packets = len(packet_offsets)
+
+        for packet_idx in range(num_packets):
+            start = int(packet_offsets[packet_idx])
+            end = (
+                int(packet_offsets[packet_idx + 1])
+                if packet_idx + 1 < num_packets
+                else len(packets)
+            )
+            ret = self.server_recv(
+                packets[start:end],
+                packet_data1[packet_idx],
+                packet_data2[packet_idx],
+                is_last_packet and packet_idx == num_packets - 1,
+            )
+            if ret is not None:
+                yield ret
+
     def flush(self):
         self.logger.log_info("[Decoder] Received EOF packet. Start flushing surfaces")
-        last_frame_batch_size = (
-            len(self.frame_batch) + self.total_frames - self.total_decoded
-        )
-        self.cvcuda_RGBtensor_batch = cvcuda.Tensor(
-            (last_frame_batch_size, self.h, self.w, 3),
-            nvcv.Type.U8,
-            nvcv.TensorLayout.NHWC,
-        )
 
         # due to the async nature, when the last packet is received, there are surface data in the pipe
         # that needs to be flushed. Data size unknown, could be multiple surfaces so need while loop.
@@ -474,52 +596,78 @@ class nvstreamingdecoder:
             if surface_nv12.Empty():
                 break
             self.total_decoded += 1
-            self.frame_batch.append(self.surface_to_tensor(surface_nv12))
+            self.surface_to_tensor(surface_nv12)
 
+        last_frame_batch_size = self.frame_batch_len
         self.logger.log_info(
             f"[Decoder] Batch {self.frame_batch_idx} of size {last_frame_batch_size} is flushed"
         )
-        # [N,H,W]
-        image_tensor_nhwc = torch.stack(self.frame_batch)
-        # [N,H,W] to [N,H,W,1] 4D torch tensor
-        image_tensor_nhwc = torch.unsqueeze(image_tensor_nhwc, -1)
-        # Make it a CVCUDA Tensor, C will be 1.
-        cvcuda_NV12tensor = cvcuda.as_tensor(image_tensor_nhwc, nvcv.TensorLayout.NHWC)
-        # Convert from NV12 to RGB. This will be NHWC.
-        cvcuda.cvtcolor_into(
-            self.cvcuda_RGBtensor_batch, cvcuda_NV12tensor, self.cvcuda_code
+        cvcuda_RGBtensor_batch = cvcuda.Tensor(
+            (last_frame_batch_size, self.h, self.w, 3),
+            nvcv.Type.U8,
+            nvcv.TensorLayout.NHWC,
         )
+        # Make the filled slots a CVCUDA Tensor, C will be 1.
+        cvcuda_NV12tensor = cvcuda.as_tensor(
+            self.torch_NV12tensor_batch[:last_frame_batch_size],
+            nvcv.TensorLayout.NHWC,
+        )
+        # Convert from NV12 to RGB. This will be NHWC.
+        cvcuda.cvtcolor_into(cvcuda_RGBtensor_batch, cvcuda_NV12tensor, self.cvcuda_code)
 
         # reset
-        self.frame_batch = []
+        self.frame_batch_len = 0
         self.frame_batch_idx += 1
-        return self.cvcuda_RGBtensor_batch
+        return cvcuda_RGBtensor_batch
 
     # docs_tag: begin_imp_nvstreamingdecoder
     def surface_to_tensor(self, surface):
         """
-        Convert a decoded surface (on vRAM) to torch.cuda.FloatTensor.
+        Copy a decoded surface (on vRAM) into the next free slot of the NV12 batch tensor.
         :param surface A NV12 surface.
         Note: must be NV12 rather than YUV420, CV-CUDA can do NV12-->YUV-->RGB directly,
         no need to use PySurfaceConverter for NV12-->YUV420 in VPF.
         CV-CUDA is also faster on batched input.
-        :return torch NV12 tensor of shape [H, W], where H is 1.5 times the raw image height.
+        :return torch NV12 tensor of shape [H, W, 1], where H is 1.5 times the raw image height.
         """
 
-        surf_plane = surface.PlanePtr()
+        # The last batch may hold more frames than the others, when the decoder is flushed.
+        if self.frame_batch_len == self.torch_NV12tensor_batch.shape[0]:
+            self.torch_NV12tensor_batch = torch.cat(
+                [
+                    self.torch_NV12tensor_batch,
+                    torch.empty_like(self.torch_NV12tensor_batch),
+                ]
+            )
+            self.cvcuda_NV12tensor_batch = cvcuda.as_tensor(
+                self.torch_NV12tensor_batch[: self.frame_batch_size],
+                nvcv.TensorLayout.NHWC,
+            )
 
-        # VPF to PyTorch tensor [W,H]
-        # Note: this VPF-->PyTorch for decoded frame is NOT zero-copy. It calls cudaMemcpy2D under the hood.
-        # Optimization could be done such that VPF-->CVCUDA is zero copy without routing via PyT
-        img_tensor = pnvc.makefromDevicePtrUint8(
-            surf_plane.GpuMem(),
-            surf_plane.Width(),
-            surf_plane.Height(),  # NV12 Height is 1.5x RGB Height
-            surf_plane.Pitch(),
-            surf_plane.ElemSize(),
+        # Wrap the pitched surface plane [H,W] as a torch tensor without copying it.
+        # Then a single strided device to device copy, on the current stream,
+        # puts it in its slot of the batch.
+        # The surface is only valid until the next decode call, see `SurfacePlaneCAI`.
+        # So the copy waits for the decoder's stream to finish writing the surface,
+        # and the decoder's stream waits for the copy before it can recycle it.
+        # PyTorch does not honour the stream of the interface, hence the explicit waits.
+        # They are no-ops when the decoder runs on the current stream.
+        copy_stream = torch.cuda.current_stream(self.device_id)
+        other_stream = copy_stream.cuda_stream != self.torch_decoder_stream.cuda_stream
+        if other_stream:
+            copy_stream.wait_stream(self.torch_decoder_stream)
+
+        surf_plane = surface.PlanePtr()
+        plane_tensor = torch.as_tensor(
+            SurfacePlaneCAI(surf_plane, self.cuda_str.handle),
+            device="cuda:%d" % self.device_id,
         )
-        if img_tensor is None:
-            raise RuntimeError("Cannot export to tensor.")
+        img_tensor = self.torch_NV12tensor_batch[self.frame_batch_len]
+        img_tensor[:, :, 0].copy_(plane_tensor)
+        self.frame_batch_len += 1
+
+        if other_stream:
+            self.torch_decoder_stream.wait_stream(copy_stream)
 
         return img_tensor
 
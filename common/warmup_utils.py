@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+warmup_utils
+
+This file hosts the helper which the inference wrappers of the samples use to warm
+themselves up on synthetic batches.
+"""
+
+import time
+import logging
+import torch
+
+
+def run_warmup_batches(
+    inference,
+    batch_sizes,
+    image_size,
+    device,
+    preprocess=None,
+    postprocess=None,
+    num_iterations=2,
+):
+    """
+    Runs synthetic batches of every batch size through the inference and, optionally,
+    the pre and post-processing around it. The first batches of a shape pay for the
+    lazy allocations, the kernel and tactic selections and any compilation or graph
+    capture, so that the real batches do not have to.
+    :param inference: The inference object, called on the pre-processed batches.
+    :param batch_sizes: The batch sizes to warm up.
+    :param image_size: The (width, height) of the synthetic frames.
+    :param device: The torch device of the synthetic batches, e.g. "cuda:0", or "cpu" for
+     an inference running on the CPU. Must be a CUDA device with preprocess.
+    :param preprocess: Optional. The `PreprocessorCvcuda` of the sample. The batches are
+     then random NHWC uint8 frames, given to it along with the image_size. Without it,
+     the inference gets random NCHW float32 batches.
+    :param postprocess: Optional. A callable which takes the outputs of the inference
+     and the outputs of the pre-processing, None if there is no pre-processing.
+    :param num_iterations: The number of times each batch size is run. The second run
+     replays the CUDA graphs captured by the first one, if any.
+    """
+    logger = logging.getLogger(__name__)
+    start_time = time.time()
+
+    for batch_size in batch_sizes:
+        if preprocess is not None:
+            frames = torch.randint(
+                0,
+                256,
+                (batch_size, image_size[1], image_size[0], 3),
+                dtype=torch.uint8,
+                device=device,
+            )
+        else:
+            tensor = torch.rand(
+                (batch_size, 3, image_size[1], image_size[0]),
+                dtype=torch.float32,
+                device=device,
+            )
+
+        for _ in range(num_iterations):
+            if preprocess is not None:
+                preprocessed = preprocess(frames, out_size=image_size)
+                # The pre-processing returns the frames, the resized and the
+                # normalized frames. The last ones go to the inference.
+                tensor = preprocessed[2]
+            else:
+                preprocessed = None
+
+            outputs = inference(tensor)
+
+            if postprocess is not None:
+                postprocess(outputs, preprocessed)
+
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    logger.info(
+        "Warmed up batch sizes %s in %.2f seconds"
+        % (str(list(batch_sizes)), time.time() - start_time)
+    )
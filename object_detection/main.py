@@ -36,10 +36,20 @@ from common.perf_utils import (  # noqa: E402
 from common.nvcodec_utils import (  # noqa: E402
     VideoBatchDecoder,
     VideoBatchEncoder,
+    MultiVideoBatchDecoder,
+    MultiVideoBatchEncoder,
     ImageBatchDecoder,
     ImageBatchEncoder,
 )
 
+from common.trt_utils import decode_calibration_batches  # noqa: E402
+
+from common.pipeline_utils import (  # noqa: E402
+    PipelineExecutor,
+    PipelineStage,
+    get_pipeline_output_buffers,
+)
+
 from pipelines import (  # noqa: E402
     PreprocessorCvcuda,
     PostprocessorCvcuda,
@@ -48,6 +58,7 @@ from pipelines import (  # noqa: E402
 from model_inference import (  # noqa: E402
     ObjectDetectionTensorflow,
     ObjectDetectionTensorRT,
+    ObjectDetectionOnnxRuntime,
 )
 
 # docs_tag: end_python_imports
@@ -64,7 +75,13 @@ def run_sample(
     confidence_threshold,
     iou_threshold,
     cvcuda_perf,
+    options,
 ):
+    """
+    Runs the sample.
+    :param options: The parsed command line arguments, for the arguments of the optional
+     features of the sample. See `get_default_arg_parser`.
+    """
     logger = logging.getLogger("object_detection")
 
     logger.debug("Using batch size of %d" % batch_size)
@@ -88,10 +105,43 @@ def run_sample(
     # Now define the object that will handle pre-processing
     preprocess = PreprocessorCvcuda(device_id, cvcuda_perf)
 
-    if os.path.splitext(input_path)[1] == ".jpg" or os.path.isdir(input_path):
+    if options.multi_video:
+        # Treat this as a directory of videos, all batched together
+        decoder = MultiVideoBatchDecoder(
+            input_path,
+            batch_size,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            output_buffers=(
+                get_pipeline_output_buffers(5, options.queue_depth)
+                if options.threaded_pipeline
+                else 1
+            ),
+        )
+
+        encoder = MultiVideoBatchEncoder(
+            output_dir,
+            decoder.fps,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            options.async_encode,
+            raw_output=options.raw_video_output,
+        )
+    elif os.path.splitext(input_path)[1] == ".jpg" or os.path.isdir(input_path):
         # Treat this as data modality of images
         decoder = ImageBatchDecoder(
-            input_path, batch_size, device_id, cuda_ctx, cvcuda_stream, cvcuda_perf
+            input_path,
+            batch_size,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            options.prefetch_batches,
+            options.decode_ahead,
         )
 
         encoder = ImageBatchEncoder(
@@ -102,12 +152,30 @@ def run_sample(
         )
     else:
         # Treat this as data modality of videos
+        # Let the decoder run ahead of the other stages when they are threaded.
         decoder = VideoBatchDecoder(
-            input_path, batch_size, device_id, cuda_ctx, cvcuda_stream, cvcuda_perf
+            input_path,
+            batch_size,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            output_buffers=(
+                get_pipeline_output_buffers(5, options.queue_depth)
+                if options.threaded_pipeline
+                else 1
+            ),
         )
 
         encoder = VideoBatchEncoder(
-            output_dir, decoder.fps, device_id, cuda_ctx, cvcuda_stream, cvcuda_perf
+            output_dir,
+            decoder.fps,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            options.async_encode,
+            raw_output=options.raw_video_output,
         )
 
     # Define the post-processor
@@ -125,12 +193,53 @@ def run_sample(
     # Setup the detection models
     if backend == "tensorflow":
         inference = ObjectDetectionTensorflow(
-            output_dir, batch_size, image_size, device_id, cvcuda_perf
+            output_dir,
+            batch_size,
+            image_size,
+            device_id,
+            cvcuda_perf,
+            jit_compile=options.tf_jit_compile,
         )
 
     elif backend == "tensorrt":
+        # int8 engines are calibrated on images pre-processed like the inputs.
+        calibration_batches = None
+        if options.trt_precision == "int8":
+            calibration_batches = decode_calibration_batches(
+                ImageBatchDecoder(
+                    options.calibration_dir,
+                    batch_size,
+                    device_id,
+                    cuda_ctx,
+                    cvcuda_stream,
+                    cvcuda_perf,
+                ),
+                lambda frames: preprocess(frames, out_size=image_size)[2],
+            )
+
         inference = ObjectDetectionTensorRT(
-            output_dir, batch_size, image_size, device_id, cvcuda_perf
+            output_dir,
+            batch_size,
+            image_size,
+            device_id,
+            cvcuda_perf,
+            profile_batch_sizes=options.trt_profile_batch_sizes,
+            cuda_graphs=options.cuda_graphs,
+            precision=options.trt_precision,
+            calibration_batches=calibration_batches,
+            num_contexts=options.trt_contexts,
+            context_policy=options.trt_context_policy,
+        )
+    elif backend == "onnxruntime":
+        inference = ObjectDetectionOnnxRuntime(
+            output_dir,
+            batch_size,
+            image_size,
+            device_id,
+            cvcuda_perf,
+            intra_op_threads=options.ort_intra_op_threads,
+            inter_op_threads=options.ort_inter_op_threads,
+            io_binding=not options.ort_no_io_binding,
         )
     else:
         raise ValueError("Unknown backend: %s" % backend)
@@ -140,50 +249,103 @@ def run_sample(
     # Define and execute the processing pipeline
     cvcuda_perf.push_range("pipeline")
 
-    # Fire up encoder/decoder
-    decoder.start()
-    encoder.start()
-
-    # Loop through all input frames
-    batch_idx = 0
-    while True:
-        cvcuda_perf.push_range("batch", batch_idx=batch_idx)
-
-        # Execute everything inside the streams.
-        with cvcuda_stream, torch.cuda.stream(torch_stream):
-            # Stage 1: decode
-            batch = decoder()
-            if batch is None:
-                cvcuda_perf.pop_range(total_items=0)  # for batch
-                break  # No more frames to decode
-            assert batch_idx == batch.batch_idx
-
-            logger.info("Processing batch %d" % batch_idx)
-
-            # docs_tag: start_preproc
-            # Stage 2: pre-processing
-            orig_tensor, resized_tensor, normalized_tensor = preprocess(
-                batch.data, image_size
+    if options.threaded_pipeline:
+        # Run every stage in its own thread and CUDA stream. The intermediate
+        # results of a batch travel along with it from one stage to the next.
+        def preprocess_stage(batch):
+            batch.orig_tensor, _, batch.data = preprocess(batch.data, image_size)
+            return batch
+
+        # With several TensorRT contexts, the batches are only submitted to them and
+        # the next stage waits for their completion events.
+        use_context_pool = getattr(inference, "context_pool", None) is not None
+
+        def inference_stage(batch):
+            if use_context_pool:
+                batch.bboxes, batch.probabilities, ready_event = inference.submit(
+                    batch.data
+                )
+                return batch, ready_event
+            batch.bboxes, batch.probabilities = inference(batch.data)
+            return batch
+
+        def postprocess_stage(batch):
+            batch.data, ready_event = postprocess(
+                batch.bboxes,
+                batch.probabilities,
+                batch.orig_tensor,
+                return_ready_event=True,
             )
+            return batch, ready_event
+
+        executor = PipelineExecutor(
+            decoder,
+            [
+                PipelineStage("preprocess", preprocess_stage),
+                PipelineStage(
+                    "inference",
+                    inference_stage,
+                    getattr(inference, "output_buffers", None),
+                    returns_ready_event=use_context_pool,
+                ),
+                PipelineStage(
+                    "postprocess", postprocess_stage, returns_ready_event=True
+                ),
+            ],
+            encoder,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            options.queue_depth,
+        )
+        executor.run()
 
-            # docs_tag: start_run_infer
-            # Stage 3: inference
-            bboxes, probabilities = inference(normalized_tensor)
-
-            # docs_tag: start_postprocess
-            # Stage 4: post-processing
-            out_tensor = postprocess(bboxes, probabilities, orig_tensor)
-
-            # docs_tag: start_encode
-            # Stage 5: encode
-            batch.data = out_tensor
-            encoder(batch)
-            batch_idx += 1
-
-        cvcuda_perf.pop_range(total_items=batch.data.shape[0])  # for batch
-
-    # Make sure encoder finishes any outstanding work
-    encoder.join()
+    else:
+        # Fire up encoder/decoder
+        decoder.start()
+        encoder.start()
+
+        # Loop through all input frames
+        batch_idx = 0
+        while True:
+            cvcuda_perf.push_range("batch", batch_idx=batch_idx)
+
+            # Execute everything inside the streams.
+            with cvcuda_stream, torch.cuda.stream(torch_stream):
+                # Stage 1: decode
+                batch = decoder()
+                if batch is None:
+                    cvcuda_perf.pop_range(total_items=0)  # for batch
+                    break  # No more frames to decode
+                assert batch_idx == batch.batch_idx
+
+                logger.info("Processing batch %d" % batch_idx)
+
+                # docs_tag: start_preproc
+                # Stage 2: pre-processing
+                orig_tensor, resized_tensor, normalized_tensor = preprocess(
+                    batch.data, image_size
+                )
+
+                # docs_tag: start_run_infer
+                # Stage 3: inference
+                bboxes, probabilities = inference(normalized_tensor)
+
+                # docs_tag: start_postprocess
+                # Stage 4: post-processing
+                out_tensor = postprocess(bboxes, probabilities, orig_tensor)
+
+                # docs_tag: start_encode
+                # Stage 5: encode
+                batch.data = out_tensor
+                encoder(batch)
+                batch_idx += 1
+
+            cvcuda_perf.pop_range(total_items=batch.data.shape[0])  # for batch
+
+        # Make sure encoder finishes any outstanding work
+        encoder.join()
 
     cvcuda_perf.pop_range()  # for pipeline
 
@@ -208,7 +370,8 @@ def main():
         input_path=os.path.join(assets_dir, "images", "peoplenet.jpg"),
         target_img_height=544,
         target_img_width=960,
-        supported_backends=["tensorflow", "tensorrt"],
+        supported_backends=["tensorflow", "tensorrt", "onnxruntime"],
+        features=["pipeline", "video_output", "tensorrt", "tensorflow", "onnxruntime"],
     )
     parser.add_argument(
         "-c",
@@ -248,6 +411,7 @@ def main():
         args.confidence_threshold,
         args.iou_threshold,
         cvcuda_perf,
+        args,
     )
     # docs_tag: end_call_run_sample
 
@@ -30,7 +30,17 @@ import numpy as np
 # we can import modules from it.
 sys.path.append('../')
 
-from common.trt_utils import setup_tensort_bindings  # noqa: E402
+from common.trt_utils import (  # noqa: E402
+    EntropyCalibrator,
+    TensorRTContextPool,
+    convert_onnx_to_tensorrt,
+    get_optimization_profile_index,
+    setup_tensort_bindings,
+)
+from common.engine_cache import TensorRTEngineCache  # noqa: E402
+from common.cuda_graph_utils import CudaGraphRunner  # noqa: E402
+from common.warmup_utils import run_warmup_batches  # noqa: E402
+from common.onnxruntime_utils import OnnxRuntimeInference  # noqa: E402
 
 # docs_tag: begin_init_objectdetectiontensorflow
 class ObjectDetectionTensorflow:
@@ -41,13 +51,21 @@ class ObjectDetectionTensorflow:
         image_size,
         device_id,
         cvcuda_perf,
+        jit_compile=False,
     ):
+        """
+        Initializes a new instance of the `ObjectDetectionTensorflow` class.
+        :param jit_compile: Run the model through a `tf.function` compiled with XLA, traced
+         once per input shape, instead of running it eagerly.
+        """
         self.logger = logging.getLogger(__name__)
         self.output_dir = output_dir
         self.batch_size = batch_size
         self.image_size = image_size
         self.device_id = device_id
         self.cvcuda_perf = cvcuda_perf
+        # Set once the warmup is done.
+        self.is_ready = False
 
         physical_devices = tf.config.list_physical_devices("GPU")
         tf.config.experimental.set_memory_growth(physical_devices[self.device_id], True)
@@ -69,6 +87,10 @@ class ObjectDetectionTensorflow:
             self.model = tf.keras.models.load_model(hdf5_model_path)
             self.logger.info("TensorFlow PeopleNet model is loaded.")
 
+        self.jit_compile = jit_compile
+        # The compiled functions of the model, per input shape.
+        self.compiled_functions = {}
+
         self.logger.info("Using TensorFlow as the inference engine.")
         # docs_tag: end_init_objectdetectiontensorflow
 
@@ -76,6 +98,11 @@ class ObjectDetectionTensorflow:
     def __call__(self, frame_nchw):
         self.cvcuda_perf.push_range("inference.tensorflow")
 
+        if self.jit_compile and not isinstance(frame_nchw, np.ndarray):
+            boxes, score = self._call_compiled(frame_nchw)
+            self.cvcuda_perf.pop_range()  # inference.tensorflow
+            return boxes, score
+
         if isinstance(frame_nchw, torch.Tensor):
             # We convert torch.Tensor to tf.Tensor by:
             # torch.Tensor -> Pytorch Flat Tensor -> DlPack -> tf.Tensor -> Un-flatten
@@ -116,6 +143,62 @@ class ObjectDetectionTensorflow:
         return boxes, score
         # docs_tag: end_call_objectdetectiontensorflow
 
+    def _call_compiled(self, frame_nchw):
+        # The GPU tensor is handed over to TensorFlow through DLPack as is. Its shape
+        # and strides come along with it, nothing is flattened, reshaped or copied.
+        if isinstance(frame_nchw, torch.Tensor):
+            frame_nchw = frame_nchw.contiguous()
+        elif isinstance(frame_nchw, nvcv.Tensor):
+            frame_nchw = frame_nchw.cuda()
+        if not hasattr(frame_nchw, "__dlpack__"):
+            # Older nvcv buffers only expose the CUDA array interface.
+            frame_nchw = torch.as_tensor(frame_nchw, device="cuda:%d" % self.device_id)
+        frame_nchw_tf = tf.experimental.dlpack.from_dlpack(frame_nchw.__dlpack__())
+
+        shape = tuple(frame_nchw_tf.shape)
+        compiled_function = self.compiled_functions.get(shape)
+        if compiled_function is None:
+            # A fixed input signature per batch size, so that XLA compiles the model for
+            # exactly the shapes it gets and nothing is ever retraced.
+            compiled_function = tf.function(
+                lambda x: self.model(x, training=False),
+                input_signature=[tf.TensorSpec(shape, frame_nchw_tf.dtype)],
+                jit_compile=True,
+            )
+            self.compiled_functions[shape] = compiled_function
+            self.logger.info(
+                "Compiling the TensorFlow model with XLA for input shape %s" % str(shape)
+            )
+
+        with tf.device("/GPU:%d" % self.device_id):
+            output_tensors = compiled_function(frame_nchw_tf)
+
+        # The outputs stay where XLA wrote them, PyTorch only wraps them.
+        boxes = torch.from_dlpack(tf.experimental.dlpack.to_dlpack(output_tensors[0]))
+        score = torch.from_dlpack(tf.experimental.dlpack.to_dlpack(output_tensors[1]))
+
+        return boxes, score
+
+    def warmup(self, batch_sizes, image_size, preprocess=None, postprocess=None):
+        """
+        Runs synthetic batches through the model, so that it is traced and its GPU
+        memory is allocated before the first real batch. Sets `is_ready` once done.
+        :param batch_sizes: The batch sizes to warm up.
+        :param image_size: The (width, height) of the synthetic frames.
+        :param preprocess: Optional. The pre-processor to run the frames through.
+        :param postprocess: Optional. A callable which takes the outputs of the model and
+         of the pre-processing. See `run_warmup_batches`.
+        """
+        run_warmup_batches(
+            self,
+            batch_sizes,
+            image_size,
+            "cuda:%d" % self.device_id,
+            preprocess,
+            postprocess,
+        )
+        self.is_ready = True
+
 
 # docs_tag: begin_init_objectdetectiontensorrt
 class ObjectDetectionTensorRT:
@@ -126,73 +209,159 @@ class ObjectDetectionTensorRT:
         image_size,
         device_id,
         cvcuda_perf,
+        profile_batch_sizes=None,
+        cuda_graphs=False,
+        precision=None,
+        calibration_batches=None,
+        num_contexts=1,
+        context_policy="round_robin",
     ):
+        """
+        Initializes a new instance of the `ObjectDetectionTensorRT` class.
+        :param profile_batch_sizes: Optional. Additional batch sizes the TensorRT engine
+         gets an optimization profile for. The best one is picked for every batch, so
+         smaller batches, like the last one, run fast as well. The engine accepts batches
+         up to the largest of these and batch_size.
+        :param cuda_graphs: Capture the inference of every input shape into a CUDA graph
+         and replay it, instead of launching the engine normally on every call.
+        :param precision: Optional. The precision of the TensorRT engine, "int8", "fp16"
+         or "fp32". Defaults to "fp32".
+        :param calibration_batches: Optional. An iterable of pre-processed batches used to
+         calibrate the engine in int8 precision, e.g. the one returned by
+         `decode_calibration_batches`. Not needed once the model has a calibration cache.
+        :param num_contexts: The number of TensorRT execution contexts. With more than one,
+         batches given to `submit` run at the same time, each one on a context and a
+         stream of its own.
+        :param context_policy: Either "round_robin" or "least_busy". How the context of a
+         batch is picked, if num_contexts is more than one.
+        """
         self.logger = logging.getLogger(__name__)
         self.output_dir = output_dir
         self.batch_size = batch_size
+        self.profile_batch_sizes = sorted(set(profile_batch_sizes or []) | {batch_size})
         self.image_size = image_size
         self.device_id = device_id
+        self.precision = precision or "fp32"
         self.cvcuda_perf = cvcuda_perf
+        # Set once the warmup is done.
+        self.is_ready = False
 
         # Download and prepare the models for the first use.
         onnx_model_path = os.path.join(self.output_dir, "resnet34_peoplenet.onnx")
-        trt_engine_file_path = os.path.join(
-            self.output_dir,
-            "resnet34_peoplenet.%d.%d.%d.trtmodel"
-            % (
+
+        if not os.path.isfile(onnx_model_path):
+            # We need to download the OONX model first from NGC.
+            model_url = (
+                "https://api.ngc.nvidia.com/v2/models/"
+                "nvidia/tao/peoplenet/versions/deployable_quantized_onnx_v2.6.2/"
+                "files/resnet34_peoplenet.onnx"
+            )
+            self.logger.info(
+                "Downloading the PeopleNet model from NGC: %s" % model_url
+            )
+            urllib.request.urlretrieve(model_url, onnx_model_path)
+            self.logger.info("Download complete. Saved to: %s" % onnx_model_path)
+
+        # Convert ONNX to TensorRT model, with one optimization profile per batch size,
+        # unless the engine cache already has an engine built from the same model for
+        # this GPU.
+        engine_cache = TensorRTEngineCache(
+            os.path.join(self.output_dir, "trt_engine_cache")
+        )
+        engine_key = engine_cache.get_key(
+            onnx_model_path,
+            self.device_id,
+            precision=self.precision,
+            profile={
+                "batch_sizes": self.profile_batch_sizes,
+                "shape": [3, 544, 960],
+            },
+        )
+        if self.precision == "int8":
+            # Calibrate on the given batches, unless another engine of the same model
+            # was calibrated before, on this or on another machine.
+            calibrator = EntropyCalibrator(
+                calibration_batches,
                 batch_size,
-                image_size[1],
-                image_size[0],
+                self.device_id,
+                engine_cache.get_calibration_cache_path(onnx_model_path, [3, 544, 960]),
+            )
+        else:
+            calibrator = None
+        serialized_engine = engine_cache.get_or_build(
+            engine_key,
+            lambda trt_engine_file_path: convert_onnx_to_tensorrt(
+                onnx_model_path,
+                trt_engine_file_path,
+                max_batch_size=self.profile_batch_sizes[-1],
+                precision=self.precision,
+                profile_batch_sizes=self.profile_batch_sizes,
+                calibrator=calibrator,
+                timing_cache_path=engine_cache.get_timing_cache_path(
+                    self.device_id
+                ),
             ),
         )
 
-        # Check if we have a previously generated model.
-        if not os.path.isfile(trt_engine_file_path):
-            if not os.path.isfile(onnx_model_path):
-                # We need to download the OONX model first from NGC.
-                model_url = (
-                    "https://api.ngc.nvidia.com/v2/models/"
-                    "nvidia/tao/peoplenet/versions/deployable_quantized_onnx_v2.6.2/"
-                    "files/resnet34_peoplenet.onnx"
-                )
-                self.logger.info(
-                    "Downloading the PeopleNet model from NGC: %s" % model_url
-                )
-                urllib.request.urlretrieve(model_url, onnx_model_path)
-                self.logger.info("Download complete. Saved to: %s" % onnx_model_path)
-
-            # Convert ONNX to TensorRT model using the TAO-Converter.
-            self.logger.info("Converting the PeopleNet model to TensorRT...")
-            if os.system(
-                "/usr/src/tensorrt/bin/trtexec --onnx=%s --saveEngine=%s --minShapes='input_1:0':%dx3x544x960 --optShapes='input_1:0':%dx3x544x960 --maxShapes='input_1:0':%dx3x544x960 --skipInference"
-                % (
-                    onnx_model_path,
-                    trt_engine_file_path,
-                    batch_size,
-                    batch_size,
-                    batch_size
-                )
-            ):
-                raise Exception("Conversion failed.")
-            else:
-                self.logger.info(
-                    "Conversion complete. Saved to: %s" % trt_engine_file_path
-                )
-
         # Once the TensorRT engine generation is all done, we load it.
         trt_logger = trt.Logger(trt.Logger.ERROR)
-        with open(trt_engine_file_path, "rb") as f, trt.Runtime(trt_logger) as runtime:
-            # Keeping this as a class variable because we want to be able to
-            # allocate the output tensors either on its first use or when the
-            # batch size changes
-            self.trt_model = runtime.deserialize_cuda_engine(f.read())
-
-        # Create execution context.
-        self.model = self.trt_model.create_execution_context()
-
-        # We will allocate the output tensors and its bindings either when we
-        # use it for the first time or when the batch size changes.
-        self.output_tensors, self.output_layer_names = None, None
+        with trt.Runtime(trt_logger) as runtime:
+            # Keeping this as a class variable because we need it to pick the
+            # optimization profile of every batch
+            self.trt_model = runtime.deserialize_cuda_engine(serialized_engine)
+
+        if num_contexts > 1:
+            # Several batches run at the same time, each one on an execution
+            # context and a stream of its own.
+            self.context_pool = TensorRTContextPool(
+                self.trt_model,
+                "input_1:0",
+                num_contexts,
+                self.profile_batch_sizes[-1],
+                self.device_id,
+                policy=context_policy,
+                cuda_graphs=cuda_graphs,
+            )
+            # The batches are written to num_contexts sets of output tensors in turn.
+            self.output_buffers = num_contexts
+        else:
+            self.context_pool = None
+            # Create execution context.
+            self.model = self.trt_model.create_execution_context()
+            self.profile_idx = 0
+            # Every batch is written into the same output tensors.
+            self.output_buffers = 1
+
+            # Allocate the output bindings. They are allocated once, for the largest
+            # batch size. Smaller batches are written to the beginning of them, so their
+            # addresses never change.
+            self.output_tensors, self.output_layer_names = setup_tensort_bindings(
+                self.trt_model,
+                self.profile_batch_sizes[-1],
+                self.device_id,
+                self.logger,
+            )
+            for output_tensor, layer_name in zip(
+                self.output_tensors, self.output_layer_names
+            ):
+                self.model.set_tensor_address(layer_name, output_tensor.data_ptr())
+            # The input shape is only set again when it changes.
+            self.input_shape = None
+
+            if cuda_graphs:
+                # The outputs already have fixed addresses, only the input needs a
+                # tensor of its own per graph.
+                self.cuda_graphs = CudaGraphRunner(
+                    lambda tensor: self._execute(
+                        tensor, torch.cuda.current_stream().cuda_stream
+                    ),
+                    self.device_id,
+                    prepare_func=lambda tensor: self._prepare(
+                        tensor, torch.cuda.current_stream().cuda_stream
+                    ),
+                )
+            else:
+                self.cuda_graphs = None
 
         self.logger.info("Using TensorRT as the inference engine.")
         # docs_tag: end_init_objectdetectiontensorrt
@@ -203,32 +372,211 @@ class ObjectDetectionTensorRT:
 
         actual_batch_size = tensor.shape[0]
 
-        # Need to allocate the output tensors
-        if not self.output_tensors or actual_batch_size != self.batch_size:
-            self.output_tensors, self.output_layer_names = setup_tensort_bindings(
-                self.trt_model,
-                actual_batch_size,
-                self.device_id,
-                self.logger,
-            )
+        if self.context_pool is not None:
+            # Run on one of the contexts and wait for it on the current stream.
+            stream_handle = cvcuda.Stream.current.handle
+            outputs, done_event = self.context_pool.submit(tensor, stream_handle)
+            torch.cuda.ExternalStream(stream_handle).wait_event(done_event)
 
-        # Grab the data directly from the pre-allocated tensor.
-        self.model.set_tensor_address("input_1:0", tensor.cuda().__cuda_array_interface__["data"][0])
-        for output_tensor, layer_name in zip(self.output_tensors,self.output_layer_names):
-            self.model.set_tensor_address(layer_name, output_tensor.data_ptr())
+            self.cvcuda_perf.pop_range()  # inference.tensorrt
+            return outputs[1], outputs[0]
+
+        if self.cuda_graphs is not None:
+            # Replay the graph of this input shape. The graph is launched on the
+            # current torch stream, so make the CVCUDA stream the current one.
+            with torch.cuda.stream(
+                torch.cuda.ExternalStream(cvcuda.Stream.current.handle)
+            ):
+                self.cuda_graphs(
+                    torch.as_tensor(tensor.cuda(), device="cuda:%d" % self.device_id)
+                )
+        else:
+            self._execute(tensor, cvcuda.Stream.current.handle)
+
+        boxes = self.output_tensors[1][:actual_batch_size]
+        score = self.output_tensors[0][:actual_batch_size]
+
+        self.cvcuda_perf.pop_range()  # inference.tensorrt
+
+        return boxes, score
+        # docs_tag: end_call_objectdetectiontensorrt
+
+    def warmup(self, batch_sizes, image_size, preprocess=None, postprocess=None):
+        """
+        Runs synthetic batches through the engine, on every execution context, so that
+        the lazy allocations, the profile switches and the CUDA graph captures, if any,
+        are done before the first real batch. Sets `is_ready` once done.
+        :param batch_sizes: The batch sizes to warm up, up to the largest profile one.
+        :param image_size: The (width, height) of the synthetic frames.
+        :param preprocess: Optional. The pre-processor to run the frames through.
+        :param postprocess: Optional. A callable which takes the outputs of the engine and
+         of the pre-processing. See `run_warmup_batches`.
+        """
+        num_contexts = len(self.context_pool.slots) if self.context_pool else 1
+        run_warmup_batches(
+            self,
+            batch_sizes,
+            image_size,
+            "cuda:%d" % self.device_id,
+            preprocess,
+            postprocess,
+            num_iterations=max(2, num_contexts),
+        )
+        self.is_ready = True
+
+    def submit(self, tensor):
+        """
+        Runs the inference of a batch without making the current stream wait for it, so
+        that the next batch can start right away.
+        :param tensor: The pre-processed input batch.
+        :return: A tuple of the boxes, the scores and a `torch.cuda.Event` recorded once
+         they are ready.
+        """
+        if self.context_pool is None:
+            boxes, score = self(tensor)
+            done_event = torch.cuda.Event()
+            done_event.record(torch.cuda.ExternalStream(cvcuda.Stream.current.handle))
+            return boxes, score, done_event
+
+        self.cvcuda_perf.push_range("inference.tensorrt")
+        outputs, done_event = self.context_pool.submit(
+            tensor, cvcuda.Stream.current.handle
+        )
+        self.cvcuda_perf.pop_range()  # inference.tensorrt
+        return outputs[1], outputs[0], done_event
+
+    def _prepare(self, tensor, stream_handle):
+        # Switches the context to the optimization profile best suited to the batch size
+        # and sets its input shape, unless they did not change since the previous call.
+        # A CUDA graph replay does neither, so it is done before every replay too.
+        # Returns the index of the profile.
+        actual_batch_size = tensor.shape[0]
+
+        # Switch to the optimization profile best suited to the batch size.
+        profile_idx = get_optimization_profile_index(
+            self.trt_model, "input_1:0", actual_batch_size
+        )
+        if profile_idx != self.profile_idx:
+            self.model.set_optimization_profile_async(profile_idx, stream_handle)
+            self.profile_idx = profile_idx
+            self.input_shape = None
 
         # Must call this before inference
-        assert self.model.set_input_shape("input_1:0", tensor.shape)
+        if tuple(tensor.shape) != self.input_shape:
+            assert self.model.set_input_shape("input_1:0", tensor.shape)
+            self.input_shape = tuple(tensor.shape)
+
+        return profile_idx
+
+    def _execute(self, tensor, stream_handle):
+        # Launches the engine on a tensor. Everything but the launch itself is skipped
+        # when nothing changed since the previous call.
+        self._prepare(tensor, stream_handle)
+
+        # Grab the data directly from the pre-allocated tensor.
+        self.model.set_tensor_address("input_1:0", tensor.cuda().__cuda_array_interface__["data"][0])
 
         # Call inference for implicit batch
-        self.model.execute_async_v3(
-            stream_handle=cvcuda.Stream.current.handle,
+        self.model.execute_async_v3(stream_handle=stream_handle)
+
+
+# docs_tag: begin_init_objectdetectiononnxruntime
+class ObjectDetectionOnnxRuntime:
+    def __init__(
+        self,
+        output_dir,
+        batch_size,
+        image_size,
+        device_id,
+        cvcuda_perf,
+        intra_op_threads=0,
+        inter_op_threads=0,
+        io_binding=True,
+    ):
+        """
+        Initializes a new instance of the `ObjectDetectionOnnxRuntime` class. It runs the
+        PeopleNet ONNX model used by `ObjectDetectionTensorRT` on the CPU, downloading it
+        first if needed.
+        :param intra_op_threads: The number of threads ONNX Runtime uses to run an
+         operator. 0 uses one per physical core.
+        :param inter_op_threads: The number of threads ONNX Runtime uses to run independent
+         operators in parallel. 0 or 1 runs them one after the other.
+        :param io_binding: Bind the input and the pre-allocated outputs to the session
+         instead of passing them by name on every call.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.device_id = device_id
+        self.cvcuda_perf = cvcuda_perf
+        # Set once the warmup is done.
+        self.is_ready = False
+
+        onnx_model_path = os.path.join(self.output_dir, "resnet34_peoplenet.onnx")
+
+        if not os.path.isfile(onnx_model_path):
+            # We need to download the ONNX model first from NGC.
+            model_url = (
+                "https://api.ngc.nvidia.com/v2/models/"
+                "nvidia/tao/peoplenet/versions/deployable_quantized_onnx_v2.6.2/"
+                "files/resnet34_peoplenet.onnx"
+            )
+            self.logger.info(
+                "Downloading the PeopleNet model from NGC: %s" % model_url
+            )
+            urllib.request.urlretrieve(model_url, onnx_model_path)
+            self.logger.info("Download complete. Saved to: %s" % onnx_model_path)
+
+        self.model = OnnxRuntimeInference(
+            onnx_model_path,
+            batch_size,
+            intra_op_threads,
+            inter_op_threads,
+            io_binding,
+        )
+        # The outputs are picked by name, their order in the model is not the one
+        # the post-processing expects.
+        self.boxes_idx = next(
+            idx for idx, name in enumerate(self.model.output_names) if "bbox" in name
+        )
+        self.score_idx = next(
+            idx for idx, name in enumerate(self.model.output_names) if "cov" in name
         )
 
-        boxes = self.output_tensors[1]
-        score = self.output_tensors[0]
+        self.logger.info("Using ONNX Runtime as the inference engine.")
+        # docs_tag: end_init_objectdetectiononnxruntime
 
-        self.cvcuda_perf.pop_range()  # inference.tensorrt
+    # docs_tag: begin_call_objectdetectiononnxruntime
+    def __call__(self, tensor):
+        self.cvcuda_perf.push_range("inference.onnxruntime")
 
+        outputs = self.model(tensor)
+        boxes = outputs[self.boxes_idx]
+        score = outputs[self.score_idx]
+
+        self.cvcuda_perf.pop_range()  # inference.onnxruntime
         return boxes, score
-        # docs_tag: end_call_objectdetectiontensorrt
+        # docs_tag: end_call_objectdetectiononnxruntime
+
+    def warmup(self, batch_sizes, image_size, preprocess=None, postprocess=None):
+        """
+        Runs synthetic batches through the model, so that ONNX Runtime allocates its
+        buffers before the first real batch. Sets `is_ready` once done.
+        :param batch_sizes: The batch sizes to warm up, up to batch_size.
+        :param image_size: The (width, height) of the synthetic frames.
+        :param preprocess: Optional. The pre-processor to run the frames through.
+        :param postprocess: Optional. A callable which takes the outputs of the model and
+         of the pre-processing. See `run_warmup_batches`.
+        """
+        run_warmup_batches(
+            self,
+            batch_sizes,
+            image_size,
+            # The model runs on the CPU, only the CV-CUDA pre-processing needs the GPU.
+            "cpu" if preprocess is None else "cuda:%d" % self.device_id,
+            preprocess,
+            postprocess,
+            num_iterations=1,
+        )
+        self.is_ready = True
@@ -13,11 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
 import logging
 import numpy as np
 import cvcuda
 import torch
 
+# Bring the commons folder from the samples directory into our path so that
+# we can import modules from it.
+sys.path.append('../')
+
+from common.interop_utils import pinned_buffer_pool  # noqa: E402
+
 
 class PreprocessorCvcuda:
     # docs_tag: begin_init_preprocessorcvcuda
@@ -202,10 +209,19 @@ class PostprocessorCvcuda:
 
     # docs_tag: end_interpolate
 
-    def __call__(self, raw_boxes_pyt, raw_scores_pyt, frame_nhwc):
-
+    def __call__(
+        self, raw_boxes_pyt, raw_scores_pyt, frame_nhwc, return_ready_event=False
+    ):
+        """
+        Renders the detected bounding boxes on the frames.
+        :param return_ready_event: Return the output along with a `torch.cuda.Event`
+         recorded once it is ready, or None if it stays on the GPU, instead of waiting
+         for the copy of a CPU output to finish.
+        """
         self.cvcuda_perf.push_range("postprocess.cvcuda")
-        if self.backend == "tensorrt":
+        # TensorRT and ONNX Runtime both run the ONNX model, whose outputs have an
+        # extra dimension.
+        if self.backend in ["tensorrt", "onnxruntime"]:
             raw_boxes_pyt = torch.reshape(raw_boxes_pyt,(raw_boxes_pyt.shape[0],-1,raw_boxes_pyt.shape[3],raw_boxes_pyt.shape[4]))
             raw_scores_pyt = torch.reshape(raw_scores_pyt,(raw_scores_pyt.shape[0],-1,raw_scores_pyt.shape[3],raw_scores_pyt.shape[4]))
 
@@ -271,16 +287,24 @@ class PostprocessorCvcuda:
             assert self.output_layout == "NHWC"
             render_output = frame_nhwc
 
+        ready_event = None
         if self.gpu_output:
             render_output = torch.as_tensor(
                 render_output.cuda(), device="cuda:%d" % self.device_id
             )
         else:
-            render_output = torch.as_tensor(render_output.cuda()).cpu().numpy()
+            # Copy through a reusable pinned buffer, on the current stream.
+            render_output, ready_event = pinned_buffer_pool.copy_to_host_async(
+                torch.as_tensor(render_output.cuda(), device="cuda:%d" % self.device_id)
+            )
+            if not return_ready_event:
+                ready_event.synchronize()
 
         self.cvcuda_perf.pop_range()  # postprocess
 
         # Return the original nhwc frame with bboxes rendered and ROI's blurred
+        if return_ready_event:
+            return render_output, ready_event
         return render_output
         # docs_tag: end_outbuffer
 
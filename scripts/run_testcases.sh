@@ -81,8 +81,11 @@ cd classification
 run_test "Classification on a single image with batch size 1 with TensorRT backend" "python3 main.py --input_path ../assets/images/tabby_tiger_cat.jpg --output_dir ./output --batch_size 1 --target_img_height 224 --target_img_width 224 --device_id 0 --backend tensorrt"
 run_test "Classification on a single image with batch size 1 with Pytorch backend" "python3 main.py --input_path ../assets/images/tabby_tiger_cat.jpg --output_dir ./output --batch_size 1 --target_img_height 224 --target_img_width 224 --device_id 0 --backend pytorch"
 run_test "Classification on folder containing images with Pytorch backend" "python3 main.py --input_path ../assets/images/ --output_dir ./output --batch_size 2  --backend pytorch"
+run_test "Classification on folder containing images with prefetching and decode-ahead" "python3 main.py --input_path ../assets/images/ --output_dir ./output --batch_size 2  --backend pytorch --prefetch_batches 2 --decode_ahead"
 run_test "Classification on a video file with TensorRT backend" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4 --output_dir ./output --batch_size 4 --backend tensorrt"
+run_test "Classification on a video file with ONNX Runtime backend" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4 --output_dir ./output --batch_size 4 --backend onnxruntime"
 run_test "Classification on a video file with Pytorch backend" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4 --output_dir ./output --batch_size 4 --backend pytorch"
+run_test "Classification on a video file with TensorRT backend and threaded pipeline" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4 --output_dir ./output --batch_size 4 --backend tensorrt --threaded_pipeline"
 cd ..
 
 cd object_detection
@@ -92,6 +95,9 @@ run_test "Object-Detection on a single image with batch size 1 with TensorFlow b
 run_test "Object-Detection on folder containing images with TensorRT backend" "python3 main.py --input_path ../assets/images/ --output_dir ./output --batch_size 3  --backend tensorrt"
 run_test "Object-Detection on a video file with TensorRT backend" "python3 main.py --input_path ../assets/videos/pexels-chiel-slotman-4423925-1920x1080-25fps.mp4 --output_dir ./output --batch_size 2 --backend tensorrt"
 run_test "Object-Detection on a video file with TensorFlow backend" "python3 main.py --input_path ../assets/videos/pexels-chiel-slotman-4423925-1920x1080-25fps.mp4 --output_dir ./output --batch_size 2 --backend tensorflow"
+run_test "Object-Detection on a video file with TensorFlow backend compiled with XLA" "python3 main.py --input_path ../assets/videos/pexels-chiel-slotman-4423925-1920x1080-25fps.mp4 --output_dir ./output --batch_size 2 --backend tensorflow --tf_jit_compile"
+run_test "Object-Detection on a video file with ONNX Runtime backend" "python3 main.py --input_path ../assets/videos/pexels-chiel-slotman-4423925-1920x1080-25fps.mp4 --output_dir ./output --batch_size 2 --backend onnxruntime"
+run_test "Object-Detection on a video file with TensorRT backend and threaded pipeline" "python3 main.py --input_path ../assets/videos/pexels-chiel-slotman-4423925-1920x1080-25fps.mp4 --output_dir ./output --batch_size 2 --backend tensorrt --threaded_pipeline"
 cd ..
 
 cd segmentation
@@ -99,8 +105,19 @@ cd segmentation
 run_test "Segmentation on a single image with Pytorch backend" "python3 main.py --input_path ../assets/images/tabby_tiger_cat.jpg --output_dir ./output --batch_size 1 --backend pytorch"
 run_test "Segmentation on a single image with TensorRT backend" "python3 main.py --input_path ../assets/images/tabby_tiger_cat.jpg --output_dir ./output --batch_size 1 --backend tensorrt"
 run_test "Segmentation on folder containing images with pytorch backend" "python3 main.py --input_path ../assets/images/ --output_dir ./output --batch_size 2 --backend pytorch"
+run_test "Segmentation on folder containing images with prefetching" "python3 main.py --input_path ../assets/images/ --output_dir ./output --batch_size 2 --backend pytorch --prefetch_batches 2"
 run_test "Segmentation on a video file with TensorRT backend" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 4 --backend tensorrt"
+run_test "Segmentation on a video file with TensorRT backend and async encoding" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 4 --backend tensorrt --async_encode"
+run_test "Segmentation on a video file with TensorRT backend and several optimization profiles" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 4 --backend tensorrt --trt_profile_batch_sizes 1 2"
+run_test "Segmentation on a video file with TensorRT backend and CUDA graphs" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 1 --backend tensorrt --cuda_graphs"
+run_test "Segmentation on a video file with TensorRT backend in int8 precision" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 4 --backend tensorrt --trt_precision int8"
+run_test "Segmentation on a video file with TensorRT backend, threaded pipeline and several execution contexts" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 2 --backend tensorrt --threaded_pipeline --trt_contexts 2"
+run_test "Segmentation on a video file with TensorRT backend built in the background" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 3 --backend tensorrt --trt_background_build"
+run_test "Segmentation on a video file with Pytorch backend, channels_last, fp16 autocast and torch.compile" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 4 --backend pytorch --torch_inference_mode --torch_channels_last --torch_autocast fp16 --torch_compile default"
+run_test "Segmentation on a video file with ONNX Runtime backend and 4 intra-op threads" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 2 --backend onnxruntime --ort_intra_op_threads 4"
 run_test "Segmentation on a video file with Pytorch backend" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 4 --backend pytorch"
+run_test "Segmentation on a video file with TensorRT backend and threaded pipeline" "python3 main.py --input_path ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4  --output_dir ./output --batch_size 4 --backend tensorrt --threaded_pipeline"
+run_test "Segmentation Triton client system shared memory regions" "python3 test_triton_shared_memory.py"
 run_test "Benchmark on segmentation app" "python3 ../scripts/benchmark.py -np 1 -w 1 -o ./output main.py -b 4 -i ../assets/videos/pexels-ilimdar-avgezer-7081456.mp4"
 cd ..
 
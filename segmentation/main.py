@@ -19,6 +19,7 @@
 import pycuda.driver as cuda
 import os
 import sys
+import functools
 import logging
 import cvcuda
 import torch
@@ -36,10 +37,25 @@ from common.perf_utils import (  # noqa: E402
 from common.nvcodec_utils import (  # noqa: E402
     VideoBatchDecoder,
     VideoBatchEncoder,
+    MultiVideoBatchDecoder,
+    MultiVideoBatchEncoder,
     ImageBatchDecoder,
     ImageBatchEncoder,
 )
 
+from common.trt_utils import decode_calibration_batches  # noqa: E402
+
+from common.engine_cache import (  # noqa: E402
+    DeferredTensorRTInference,
+    build_engines_in_background,
+)
+
+from common.pipeline_utils import (  # noqa: E402
+    PipelineExecutor,
+    PipelineStage,
+    get_pipeline_output_buffers,
+)
+
 from pipelines import (  # noqa: E402
     PreprocessorCvcuda,
     PostprocessorCvcuda,
@@ -48,6 +64,8 @@ from pipelines import (  # noqa: E402
 from model_inference import (  # noqa: E402
     SegmentationPyTorch,
     SegmentationTensorRT,
+    SegmentationOnnxRuntime,
+    build_tensorrt_engine,
 )
 
 # docs_tag: end_python_imports
@@ -63,7 +81,13 @@ def run_sample(
     device_id,
     backend,
     cvcuda_perf,
+    options,
 ):
+    """
+    Runs the sample.
+    :param options: The parsed command line arguments, for the arguments of the optional
+     features of the sample. See `get_default_arg_parser`.
+    """
     logger = logging.getLogger("segmentation")
 
     logger.debug("Using batch size of %d" % batch_size)
@@ -85,10 +109,43 @@ def run_sample(
     # docs_tag: end_setup_gpu
 
     # docs_tag: begin_setup_stages
-    # Now define the object that will handle pre-processing
-    preprocess = PreprocessorCvcuda(device_id, cvcuda_perf)
+    # Now define the object that will handle pre-processing. A channels_last PyTorch
+    # model takes its NHWC output as is.
+    preprocess = PreprocessorCvcuda(
+        device_id,
+        cvcuda_perf,
+        output_layout=(
+            "NHWC" if backend == "pytorch" and options.torch_channels_last else "NCHW"
+        ),
+    )
+
+    if options.multi_video:
+        # Treat this as a directory of videos, all batched together
+        decoder = MultiVideoBatchDecoder(
+            input_path,
+            batch_size,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            output_buffers=(
+                get_pipeline_output_buffers(5, options.queue_depth)
+                if options.threaded_pipeline
+                else 1
+            ),
+        )
 
-    if os.path.splitext(input_path)[1] == ".jpg" or os.path.isdir(input_path):
+        encoder = MultiVideoBatchEncoder(
+            output_dir,
+            decoder.fps,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            options.async_encode,
+            raw_output=options.raw_video_output,
+        )
+    elif os.path.splitext(input_path)[1] == ".jpg" or os.path.isdir(input_path):
         # Treat this as data modality of images
         decoder = ImageBatchDecoder(
             input_path,
@@ -97,6 +154,8 @@ def run_sample(
             cuda_ctx,
             cvcuda_stream,
             cvcuda_perf,
+            options.prefetch_batches,
+            options.decode_ahead,
         )
 
         encoder = ImageBatchEncoder(
@@ -107,6 +166,7 @@ def run_sample(
         )
     else:
         # Treat this as data modality of videos
+        # Let the decoder run ahead of the other stages when they are threaded.
         decoder = VideoBatchDecoder(
             input_path,
             batch_size,
@@ -114,6 +174,11 @@ def run_sample(
             cuda_ctx,
             cvcuda_stream,
             cvcuda_perf,
+            output_buffers=(
+                get_pipeline_output_buffers(5, options.queue_depth)
+                if options.threaded_pipeline
+                else 1
+            ),
         )
 
         encoder = VideoBatchEncoder(
@@ -123,6 +188,8 @@ def run_sample(
             cuda_ctx,
             cvcuda_stream,
             cvcuda_perf,
+            options.async_encode,
+            raw_output=options.raw_video_output,
         )
 
     # Define the post-processor
@@ -142,15 +209,90 @@ def run_sample(
             image_size,
             device_id,
             cvcuda_perf,
+            cuda_graphs=options.cuda_graphs,
+            inference_mode=options.torch_inference_mode,
+            channels_last=options.torch_channels_last,
+            autocast=options.torch_autocast,
+            torch_compile=options.torch_compile,
         )
     elif backend == "tensorrt":
-        inference = SegmentationTensorRT(
+        # int8 engines are calibrated on images pre-processed like the inputs.
+        calibration_batches = None
+        if options.trt_precision == "int8":
+            calibration_batches = decode_calibration_batches(
+                ImageBatchDecoder(
+                    options.calibration_dir,
+                    batch_size,
+                    device_id,
+                    cuda_ctx,
+                    cvcuda_stream,
+                    cvcuda_perf,
+                ),
+                lambda frames: preprocess(frames, out_size=image_size)[2],
+            )
+
+        create_trt_inference = functools.partial(
+            SegmentationTensorRT,
+            output_dir,
+            class_name,
+            batch_size,
+            image_size,
+            device_id,
+            cvcuda_perf,
+            profile_batch_sizes=options.trt_profile_batch_sizes,
+            cuda_graphs=options.cuda_graphs,
+            precision=options.trt_precision,
+            calibration_batches=calibration_batches,
+            num_contexts=options.trt_contexts,
+            context_policy=options.trt_context_policy,
+        )
+
+        if options.trt_background_build:
+            # Start on PyTorch while the engine is built in a worker process, and
+            # switch to TensorRT once it is ready.
+            engine_executor, engine_futures = build_engines_in_background(
+                functools.partial(
+                    build_tensorrt_engine,
+                    output_dir,
+                    device_id,
+                    options.trt_profile_batch_sizes,
+                ),
+                [
+                    (
+                        batch_size,
+                        target_img_height,
+                        target_img_width,
+                        options.trt_precision,
+                    )
+                ],
+            )
+            inference = DeferredTensorRTInference(
+                SegmentationPyTorch(
+                    output_dir,
+                    class_name,
+                    batch_size,
+                    image_size,
+                    device_id,
+                    cvcuda_perf,
+                ),
+                engine_futures[0],
+                create_trt_inference,
+                output_buffers=options.trt_contexts,
+                executor=engine_executor,
+            )
+        else:
+            inference = create_trt_inference()
+    elif backend == "onnxruntime":
+        inference = SegmentationOnnxRuntime(
             output_dir,
             class_name,
             batch_size,
             image_size,
             device_id,
             cvcuda_perf,
+            intra_op_threads=options.ort_intra_op_threads,
+            inter_op_threads=options.ort_inter_op_threads,
+            io_binding=not options.ort_no_io_binding,
         )
     else:
         raise ValueError("Unknown backend: %s" % backend)
@@ -160,55 +302,114 @@ def run_sample(
     # Define and execute the processing pipeline ------------
     cvcuda_perf.push_range("pipeline")
 
-    # Fire up encoder/decoder
-    decoder.start()
-    encoder.start()
-
-    # Loop through all input frames
-    batch_idx = 0
-    while True:
-        cvcuda_perf.push_range("batch", batch_idx=batch_idx)
-        # Make sure that cvcuda and torch are using the same stream
-        with cvcuda_stream, torch.cuda.stream(torch_stream):
-            # Stage 1: decode
-            batch = decoder()
-            if batch is None:
-                cvcuda_perf.pop_range(total_items=0)  # for batch
-                break  # No more frames to decode
-            assert batch_idx == batch.batch_idx
-
-            logger.info("Processing batch %d" % batch_idx)
-
-            # Stage 2: pre-processing
-            orig_tensor, resized_tensor, normalized_tensor = preprocess(
+    if options.threaded_pipeline:
+        # Run every stage in its own thread and CUDA stream. The intermediate
+        # results of a batch travel along with it from one stage to the next.
+        def preprocess_stage(batch):
+            batch.orig_tensor, batch.resized_tensor, batch.data = preprocess(
                 batch.data,
                 out_size=image_size,
             )
+            return batch
+
+        # With several TensorRT contexts, the batches are only submitted to them and
+        # the next stage waits for their completion events.
+        use_context_pool = getattr(inference, "context_pool", None) is not None
 
-            # Stage 3: inference
-            probabilities = inference(normalized_tensor)
+        def inference_stage(batch):
+            if use_context_pool:
+                batch.data, ready_event = inference.submit(batch.data)
+                return batch, ready_event
+            batch.data = inference(batch.data)
+            return batch
 
-            # Stage 4: post-processing
-            blurred_frame = postprocess(
-                probabilities,
-                orig_tensor,
-                resized_tensor,
+        def postprocess_stage(batch):
+            batch.data, ready_event = postprocess(
+                batch.data,
+                batch.orig_tensor,
+                batch.resized_tensor,
                 inference.class_index,
+                return_ready_event=True,
             )
+            return batch, ready_event
+
+        executor = PipelineExecutor(
+            decoder,
+            [
+                PipelineStage("preprocess", preprocess_stage),
+                PipelineStage(
+                    "inference",
+                    inference_stage,
+                    getattr(inference, "output_buffers", None),
+                    returns_ready_event=use_context_pool,
+                ),
+                PipelineStage(
+                    "postprocess", postprocess_stage, returns_ready_event=True
+                ),
+            ],
+            encoder,
+            device_id,
+            cuda_ctx,
+            cvcuda_stream,
+            cvcuda_perf,
+            options.queue_depth,
+        )
+        executor.run()
 
-            # Stage 5: encode
-            batch.data = blurred_frame
-            encoder(batch)
-
-            batch_idx += 1
-
-        cvcuda_perf.pop_range(total_items=batch.data.shape[0])  # for batch
-
-    # Make sure encoder finishes any outstanding work
-    encoder.join()
+    else:
+        # Fire up encoder/decoder
+        decoder.start()
+        encoder.start()
+
+        # Loop through all input frames
+        batch_idx = 0
+        while True:
+            cvcuda_perf.push_range("batch", batch_idx=batch_idx)
+            # Make sure that cvcuda and torch are using the same stream
+            with cvcuda_stream, torch.cuda.stream(torch_stream):
+                # Stage 1: decode
+                batch = decoder()
+                if batch is None:
+                    cvcuda_perf.pop_range(total_items=0)  # for batch
+                    break  # No more frames to decode
+                assert batch_idx == batch.batch_idx
+
+                logger.info("Processing batch %d" % batch_idx)
+
+                # Stage 2: pre-processing
+                orig_tensor, resized_tensor, normalized_tensor = preprocess(
+                    batch.data,
+                    out_size=image_size,
+                )
+
+                # Stage 3: inference
+                probabilities = inference(normalized_tensor)
+
+                # Stage 4: post-processing
+                blurred_frame = postprocess(
+                    probabilities,
+                    orig_tensor,
+                    resized_tensor,
+                    inference.class_index,
+                )
+
+                # Stage 5: encode
+                batch.data = blurred_frame
+                encoder(batch)
+
+                batch_idx += 1
+
+            cvcuda_perf.pop_range(total_items=batch.data.shape[0])  # for batch
+
+        # Make sure encoder finishes any outstanding work
+        encoder.join()
 
     cvcuda_perf.pop_range()  # for pipeline
 
+    if isinstance(inference, DeferredTensorRTInference):
+        # Do not wait for an engine build which is not needed anymore.
+        inference.close()
+
     cuda_ctx.pop()
     # docs_tag: end_pipeline
 
@@ -221,7 +422,11 @@ def run_sample(
 # docs_tag: begin_main_func
 def main():
     # docs_tag: begin_parse_args
-    parser = get_default_arg_parser("Semantic segmentation sample using CV-CUDA.")
+    parser = get_default_arg_parser(
+        "Semantic segmentation sample using CV-CUDA.",
+        supported_backends=["tensorrt", "pytorch", "onnxruntime"],
+        features=["pipeline", "video_output", "tensorrt", "pytorch", "onnxruntime"],
+    )
     parser.add_argument(
         "-c",
         "--class_name",
@@ -251,6 +456,7 @@ def main():
         args.device_id,
         args.backend,
         cvcuda_perf,
+        args,
     )
     # docs_tag: end_call_run_sample
 
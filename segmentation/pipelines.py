@@ -13,18 +13,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
 import numpy as np
 import logging
 import cvcuda
 import torch
 
+# Bring the commons folder from the samples directory into our path so that
+# we can import modules from it.
+sys.path.append('../')
+
+from common.interop_utils import pinned_buffer_pool  # noqa: E402
+
 
 class PreprocessorCvcuda:
     # docs_tag: begin_init_preprocessorcvcuda
-    def __init__(self, device_id, cvcuda_perf):
+    def __init__(self, device_id, cvcuda_perf, output_layout="NCHW"):
+        """
+        Initializes a new instance of the `PreprocessorCvcuda` class.
+        :param output_layout: The layout of the normalized tensor, "NCHW" or "NHWC". Models
+         running in the channels_last memory format take the NHWC tensor as is.
+        """
         self.logger = logging.getLogger(__name__)
         self.device_id = device_id
         self.cvcuda_perf = cvcuda_perf
+        if output_layout not in ["NCHW", "NHWC"]:
+            raise ValueError("Unsupported output layout: %s" % output_layout)
+        self.output_layout = output_layout
         self.mean_tensor = torch.Tensor([0.485, 0.456, 0.406])
         self.mean_tensor = self.mean_tensor.reshape(1, 1, 1, 3).cuda(self.device_id)
         self.mean_tensor = cvcuda.as_tensor(self.mean_tensor, "NHWC")
@@ -86,8 +101,9 @@ class PreprocessorCvcuda:
             flags=cvcuda.NormalizeFlags.SCALE_IS_STDDEV,
         )
 
-        # Convert it to NCHW layout and return it.
-        normalized = cvcuda.reformat(normalized, "NCHW")
+        # Convert it to NCHW layout and return it, unless the model takes NHWC tensors.
+        if self.output_layout == "NCHW":
+            normalized = cvcuda.reformat(normalized, "NCHW")
 
         self.cvcuda_perf.pop_range()
 
@@ -121,7 +137,20 @@ class PostprocessorCvcuda:
         self.logger.info("Using CVCUDA as post-processor.")
 
     # docs_tag: begin_call_postprocessorcvcuda
-    def __call__(self, probabilities, frame_nhwc, resized_tensor, class_index):
+    def __call__(
+        self,
+        probabilities,
+        frame_nhwc,
+        resized_tensor,
+        class_index,
+        return_ready_event=False,
+    ):
+        """
+        Blurs the background of the frames.
+        :param return_ready_event: Return the output along with a `torch.cuda.Event`
+         recorded once it is ready, or None if it stays on the GPU, instead of waiting
+         for the copy of a CPU output to finish.
+        """
         self.cvcuda_perf.push_range("postprocess.cvcuda")
 
         # docs_tag: begin_proces_probs
@@ -213,18 +242,26 @@ class PostprocessorCvcuda:
             assert self.output_layout == "NHWC"
             cvcuda_composite_imgs_out = cvcuda_composite_imgs_nhwc
 
+        ready_event = None
         if self.gpu_output:
             if self.torch_output:
                 cvcuda_composite_imgs_out = torch.as_tensor(
                     cvcuda_composite_imgs_out.cuda(), device="cuda:%d" % self.device_id
                 )
         else:
-            cvcuda_composite_imgs_out = (
-                torch.as_tensor(cvcuda_composite_imgs_out.cuda()).cpu().numpy()
+            # Copy through a reusable pinned buffer, on the current stream.
+            cvcuda_composite_imgs_out, ready_event = pinned_buffer_pool.copy_to_host_async(
+                torch.as_tensor(
+                    cvcuda_composite_imgs_out.cuda(), device="cuda:%d" % self.device_id
+                )
             )
+            if not return_ready_event:
+                ready_event.synchronize()
 
         self.cvcuda_perf.pop_range()  # postprocess
 
         # docs_tag: end_postproc_pipeline
 
+        if return_ready_event:
+            return cvcuda_composite_imgs_out, ready_event
         return cvcuda_composite_imgs_out
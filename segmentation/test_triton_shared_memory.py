@@ -0,0 +1,187 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests the system shared memory regions of the Triton segmentation client against a
+local stand-in of the Triton server and of the tritonclient shared memory API.
+Run it from the segmentation folder: python3 test_triton_shared_memory.py
+"""
+
+import sys
+import types
+import unittest
+from unittest import mock
+import numpy as np
+import torch
+import tritonclient.grpc as tritongrpcclient
+import tritonclient.utils
+
+from triton_client import SharedMemoryRegions
+
+
+class StubSharedMemoryRegion:
+    """
+    A system shared memory region of `StubSharedMemory`, backed by a bytearray.
+    """
+
+    def __init__(self, name, key, byte_size):
+        self.name = name
+        self.key = key
+        self.data = bytearray(byte_size)
+        self.is_destroyed = False
+
+
+class StubSharedMemory(types.ModuleType):
+    """
+    Stands in for `tritonclient.utils.shared_memory`.
+    """
+
+    def __init__(self):
+        super().__init__("tritonclient.utils.shared_memory")
+        self.regions = {}  # key -> StubSharedMemoryRegion
+
+    def create_shared_memory_region(self, name, key, byte_size):
+        assert key not in self.regions, "Region %s already exists." % key
+        region = StubSharedMemoryRegion(name, key, byte_size)
+        self.regions[key] = region
+        return region
+
+    def set_shared_memory_region(self, handle, input_values, offset=0):
+        assert not handle.is_destroyed
+        for value in input_values:
+            data = np.ascontiguousarray(value).tobytes()
+            assert offset + len(data) <= len(handle.data), "Region is too small."
+            handle.data[offset : offset + len(data)] = data  # noqa: E203
+            offset += len(data)
+
+    def get_contents_as_numpy(self, handle, datatype, shape, offset=0):
+        assert not handle.is_destroyed
+        count = int(np.prod(shape))
+        return np.frombuffer(handle.data, datatype, count, offset).reshape(shape)
+
+    def destroy_shared_memory_region(self, handle):
+        assert not handle.is_destroyed
+        handle.is_destroyed = True
+        del self.regions[handle.key]
+
+
+class StubTritonServer:
+    """
+    Stands in for the Triton server and its GRPC client. Its model turns the uint8
+    input into float32 values divided by 255, like a pass-through network would.
+    """
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.registered = {}  # name -> (key, byte size)
+        self.num_registrations = 0
+
+    def register_system_shared_memory(self, name, key, byte_size):
+        assert name not in self.registered, "Region %s already registered." % name
+        assert self.shm.regions[key].name == name
+        self.registered[name] = (key, byte_size)
+        self.num_registrations += 1
+
+    def unregister_system_shared_memory(self, name):
+        assert name in self.registered, "Region %s is not registered." % name
+        del self.registered[name]
+
+    def infer(self, input_name, output_name, shape):
+        input_key, input_byte_size = self.registered[input_name]
+        output_key, output_byte_size = self.registered[output_name]
+        count = int(np.prod(shape))
+        assert count <= input_byte_size and count * 4 <= output_byte_size
+
+        input_region = self.shm.regions[input_key]
+        output_region = self.shm.regions[output_key]
+        output = np.frombuffer(input_region.data, np.uint8, count).astype(np.float32) / 255
+        output_region.data[: count * 4] = output.tobytes()
+
+        result = mock.Mock()
+        result.get_output.return_value = types.SimpleNamespace(shape=list(shape))
+        return result
+
+
+class TestSystemSharedMemoryRegions(unittest.TestCase):
+    def setUp(self):
+        self.shm = StubSharedMemory()
+        self.server = StubTritonServer(self.shm)
+        patches = [
+            mock.patch.dict(sys.modules, {"tritonclient.utils.shared_memory": self.shm}),
+            mock.patch.object(tritonclient.utils, "shared_memory", self.shm, create=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.regions = SharedMemoryRegions(
+            self.server, "system", num_slots=2, output_name="outputrgb", device_id=0
+        )
+
+    def run_request(self, slot, batch_size):
+        torch_arr = torch.randint(
+            0, 256, (batch_size, 8, 8, 3), dtype=torch.uint8, device="cuda:0"
+        )
+        infer_input = tritongrpcclient.InferInput(
+            "inputrgb", list(torch_arr.shape), "UINT8"
+        )
+        self.regions.set_input(slot, infer_input, torch_arr, torch_arr.numel() * 4)
+
+        input_name = self.regions.regions[slot][0][0]
+        output_name = self.regions.regions[slot][1][0]
+        result = self.server.infer(input_name, output_name, torch_arr.shape)
+        output = self.regions.get_output(slot, result)
+
+        expected = torch_arr.cpu().numpy().astype(np.float32) / 255
+        np.testing.assert_array_equal(output, expected)
+
+    def test_regions_are_reused(self):
+        self.run_request(0, 4)
+        self.run_request(1, 4)
+        self.assertEqual(self.server.num_registrations, 4)
+
+        # Same and smaller batches fit in the regions registered so far.
+        self.run_request(0, 4)
+        self.run_request(1, 2)
+        self.assertEqual(self.server.num_registrations, 4)
+        self.assertEqual(len(self.shm.regions), 4)
+
+    def test_regions_grow(self):
+        self.run_request(0, 2)
+        old_handles = [region[1] for region in self.regions.regions[0]]
+
+        # A larger batch replaces both regions of the slot with larger ones.
+        self.run_request(0, 4)
+        self.assertTrue(all(handle.is_destroyed for handle in old_handles))
+        self.assertEqual(self.server.num_registrations, 4)
+        self.assertEqual(len(self.server.registered), 2)
+        input_region, output_region = self.regions.regions[0]
+        self.assertEqual(input_region[2], 4 * 8 * 8 * 3)
+        self.assertEqual(output_region[2], 4 * 8 * 8 * 3 * 4)
+
+        # And it is re-used from then on.
+        self.run_request(0, 3)
+        self.assertEqual(self.server.num_registrations, 4)
+
+    def test_close(self):
+        self.run_request(0, 2)
+        self.run_request(1, 2)
+        self.regions.close()
+        self.assertEqual(self.server.registered, {})
+        self.assertEqual(self.shm.regions, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
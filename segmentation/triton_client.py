@@ -22,7 +22,8 @@ import sys
 import queue
 import uuid
 import logging
-import time
+import collections
+from concurrent.futures import Future
 from functools import partial
 import cvcuda
 import torch
@@ -35,6 +36,8 @@ from pathlib import Path
 # we can import modules from it.
 sys.path.append('../')
 
+from common.interop_utils import pinned_buffer_pool  # noqa: E402
+
 from common.perf_utils import (  # noqa: E402
     CvCudaPerf,
     get_default_arg_parser,
@@ -56,14 +59,131 @@ from common.vpf_utils import (  # noqa: E402
 # docs_tag: end_python_imports
 
 
-def callback(response, result, error):
+def callback(future, result, error):
     """
-    Triton Inference callback
+    Triton Inference callback, resolves the future of the request
     """
     if error:
-        response.append(error)
+        future.set_exception(error)
     else:
-        response.append(result)
+        future.set_result(result)
+
+
+class SharedMemoryRegions:
+    """
+    Input and output Triton shared memory regions of the non-streaming client.
+    There is one pair of regions per request which may be in flight at the same time,
+    they are registered with the server once and re-used for all the batches.
+    """
+
+    def __init__(self, triton_client, kind, num_slots, output_name, device_id):
+        """
+        Initializes a new instance of the `SharedMemoryRegions` class.
+        :param triton_client: The Triton GRPC client used to register the regions.
+        :param kind: Either "system" or "cuda".
+        :param num_slots: The number of input/output region pairs.
+        :param output_name: The name of the output tensor of the model.
+        :param device_id: The GPU device of the CUDA shared memory regions.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.triton_client = triton_client
+        self.kind = kind
+        self.output_name = output_name
+        self.device_id = device_id
+        if self.kind == "system":
+            import tritonclient.utils.shared_memory as shm_utils
+        elif self.kind == "cuda":
+            import tritonclient.utils.cuda_shared_memory as shm_utils
+        else:
+            raise ValueError("Unknown shared memory kind: %s" % self.kind)
+        self.shm_utils = shm_utils
+        self.prefix = "deepstream_libraries_%s" % uuid.uuid4().hex
+        # Per slot: [input (name, handle, byte size), output (name, handle, byte size)]
+        self.regions = [[None, None] for _ in range(num_slots)]
+
+        self.logger.info("Using %s shared memory for the Triton tensors." % self.kind)
+
+    def _ensure_region(self, slot, index, byte_size):
+        region = self.regions[slot][index]
+        if region is not None and region[2] >= byte_size:
+            return region
+        if region is not None:
+            # Too small for this batch, replace it.
+            self._destroy_region(region)
+
+        name = "%s_%d_%s" % (self.prefix, slot, "input" if index == 0 else "output")
+        if self.kind == "system":
+            key = "/" + name
+            handle = self.shm_utils.create_shared_memory_region(name, key, byte_size)
+            self.triton_client.register_system_shared_memory(name, key, byte_size)
+        else:
+            handle = self.shm_utils.create_shared_memory_region(
+                name, byte_size, self.device_id
+            )
+            self.triton_client.register_cuda_shared_memory(
+                name, self.shm_utils.get_raw_handle(handle), self.device_id, byte_size
+            )
+        region = (name, handle, byte_size)
+        self.regions[slot][index] = region
+        return region
+
+    def _destroy_region(self, region):
+        name, handle, _ = region
+        if self.kind == "system":
+            self.triton_client.unregister_system_shared_memory(name)
+        else:
+            self.triton_client.unregister_cuda_shared_memory(name)
+        self.shm_utils.destroy_shared_memory_region(handle)
+
+    def set_input(self, slot, infer_input, torch_arr, output_byte_size):
+        """
+        Writes the input of a request into the regions of a slot and points the request
+        to them.
+        :param slot: The slot to use. It must not be used by a request in flight.
+        :param infer_input: The `InferInput` of the request.
+        :param torch_arr: The CUDA tensor holding the input data.
+        :param output_byte_size: The size of the output of the request, in bytes.
+        :return: The `InferRequestedOutput` of the request.
+        """
+        input_byte_size = torch_arr.numel() * torch_arr.element_size()
+        input_name, input_handle, _ = self._ensure_region(slot, 0, input_byte_size)
+        output_name, _, _ = self._ensure_region(slot, 1, output_byte_size)
+
+        if self.kind == "system":
+            # Two copies: from the GPU into a reusable pinned buffer, at the full PCIe
+            # bandwidth, and from there into the region on the host.
+            self.shm_utils.set_shared_memory_region(
+                input_handle, [pinned_buffer_pool.copy_to_host(torch_arr)]
+            )
+        else:
+            # The data does not leave the GPU.
+            torch_arr = torch_arr.contiguous()
+            torch.cuda.current_stream().synchronize()
+            self.shm_utils.set_shared_memory_region_from_dlpack(input_handle, [torch_arr])
+        infer_input.set_shared_memory(input_name, input_byte_size)
+
+        infer_output = tritongrpcclient.InferRequestedOutput(self.output_name)
+        infer_output.set_shared_memory(output_name, output_byte_size)
+        return infer_output
+
+    def get_output(self, slot, result):
+        """
+        Reads the output of a request from the output region of its slot.
+        :param slot: The slot used by the request.
+        :param result: The `InferResult` of the request.
+        :return: A numpy array. It is only valid until the slot is used again.
+        """
+        output = result.get_output(self.output_name)
+        return self.shm_utils.get_contents_as_numpy(
+            self.regions[slot][1][1], np.float32, list(output.shape)
+        )
+
+    def close(self):
+        for slot_regions in self.regions:
+            for region in slot_regions:
+                if region is not None:
+                    self._destroy_region(region)
+        self.regions = [[None, None] for _ in self.regions]
 
 
 def run_sample(
@@ -74,6 +194,11 @@ def run_sample(
     device_id,
     should_stream_video,
     cvcuda_perf,
+    prefetch_batches=0,
+    decode_ahead=False,
+    max_inflight_requests=1,
+    shared_memory="none",
+    packets_per_request=1,
 ):
     """
     Runs the Sample for a given input image or video.
@@ -82,6 +207,7 @@ def run_sample(
 
     logger.debug("Using batch size of %d" % batch_size)
     logger.debug("Using CUDA device: %d" % device_id)
+    logger.debug("Using up to %d requests in flight" % max_inflight_requests)
 
     # Check if video streaming was requested and that it is possible
     if should_stream_video:
@@ -131,6 +257,8 @@ def run_sample(
             cuda_ctx,
             cvcuda_stream,
             cvcuda_perf,
+            prefetch_batches,
+            decode_ahead,
         )
 
         encoder = ImageBatchEncoder(
@@ -212,7 +340,13 @@ def run_sample(
 
                 # docs_tag: begin_streamed_decode
                 # Stage 1: Begin streaming input data to the server for decoding
-                decoder(triton_client, tritongrpcclient, video_id, batch_size)
+                decoder(
+                    triton_client,
+                    tritongrpcclient,
+                    video_id,
+                    batch_size,
+                    packets_per_request,
+                )
                 # docs_tag: end_streamed_decode
 
                 # docs_tag: begin_async_receive
@@ -266,6 +400,60 @@ def run_sample(
             # docs_tag: end_pipeline
 
         else:
+            # Exchange the tensors with the server through shared memory, if requested.
+            shm_regions = None
+            if shared_memory != "none":
+                shm_regions = SharedMemoryRegions(
+                    triton_client,
+                    shared_memory,
+                    max_inflight_requests,
+                    output_name,
+                    device_id,
+                )
+
+            # The requests sent to the server and not yet encoded, oldest first.
+            # Up to max_inflight_requests batches are on the server at any time, so
+            # the next batch is decoded and sent while the previous ones are processed.
+            inflight_requests = collections.deque()
+
+            def complete_oldest_request():
+                # docs_tag: begin_sync_output
+                # Stage 4 : Wait until the results of the oldest request are available
+                inflight_batch, future, slot = inflight_requests.popleft()
+                cvcuda_perf.push_range("wait_response")
+                try:
+                    result = future.result()
+                except InferenceServerException as error:
+                    cuda_ctx.pop()
+                    raise error
+                cvcuda_perf.pop_range()
+
+                # Stage 5 : Parse received Infer response
+                cvcuda_perf.push_range("parse_response")
+                if shm_regions is not None:
+                    seg_output = shm_regions.get_output(slot, result)
+                else:
+                    seg_output = result.as_numpy(output_name)
+                if hwcToChwConversion:
+                    seg_output = np.transpose(seg_output, (0, 2, 3, 1))
+                    # need to copy as contiguous
+                    seg_output = np.ascontiguousarray(seg_output)
+                else:
+                    seg_output = np.copy(seg_output)
+
+                cvcuda_perf.pop_range()
+                # docs_tag: end_sync_output
+
+                # docs_tag: begin_encode_output
+                # Stage 6: encode output data
+                cvcuda_perf.push_range("encode_output")
+                seg_output = torch.as_tensor(seg_output)
+                inflight_batch.data = seg_output.cuda()
+                encoder(inflight_batch)
+                cvcuda_perf.pop_range()
+
+                # docs_tag: end_encode_output
+
             while True:
                 cvcuda_perf.push_range("batch", batch_idx=batch_idx)
 
@@ -290,68 +478,62 @@ def run_sample(
                     torch_arr = torch.as_tensor(
                         batch.data.cuda(), device="cuda:%d" % device_id
                     )
-                    numpy_arr = torch_arr.cpu().numpy()
                     inputs.append(
                         tritongrpcclient.InferInput(
-                            input_name, numpy_arr.shape, "UINT8"
+                            input_name, list(torch_arr.shape), "UINT8"
                         )
                     )
-                    outputs.append(tritongrpcclient.InferRequestedOutput(output_name))
-                    inputs[0].set_data_from_numpy(numpy_arr)
+                    # Slots are only re-used once their previous request is encoded.
+                    slot = batch_idx % max_inflight_requests
+                    if shm_regions is not None:
+                        # The output has as many float32 elements as the input.
+                        outputs.append(
+                            shm_regions.set_input(
+                                slot, inputs[0], torch_arr, torch_arr.numel() * 4
+                            )
+                        )
+                    else:
+                        # Copy through a reusable pinned buffer instead of a pageable one.
+                        numpy_arr = pinned_buffer_pool.copy_to_host(torch_arr)
+                        outputs.append(tritongrpcclient.InferRequestedOutput(output_name))
+                        inputs[0].set_data_from_numpy(numpy_arr)
+                    total_items = torch_arr.shape[0]
                     cvcuda_perf.pop_range()
                     # docs_tag: end_create_triton_input
 
                     # docs_tag: begin_async_infer
                     # Stage 3 : Run async Inference
                     cvcuda_perf.push_range("async_infer")
-                    response = []
+                    future = Future()
                     triton_client.async_infer(
                         model_name=model_name,
                         inputs=inputs,
-                        callback=partial(callback, response),
+                        callback=partial(callback, future),
                         model_version=model_version,
                         outputs=outputs,
                     )
+                    # The input data has been serialized into the request, the batch
+                    # only needs to keep its file information from now on.
+                    batch.data = None
+                    inflight_requests.append((batch, future, slot))
+                    cvcuda_perf.pop_range()
                     # docs_tag: end_async_infer
 
-                    # docs_tag: begin_sync_output
-                    # Stage 4 : Wait until the results are available
-                    while len(response) == 0:
-                        time.sleep(0.001)
-                    cvcuda_perf.pop_range()
+                    # Encode the oldest batch once the window is full.
+                    if len(inflight_requests) >= max_inflight_requests:
+                        complete_oldest_request()
 
-                    # Stage 5 : Parse received Infer response
-                    cvcuda_perf.push_range("parse_response")
-                    if len(response) == 1:
-                        # Check for the errors
-                        if type(response[0]) == InferenceServerException:
-                            cuda_ctx.pop()
-                            raise response[0]
-                        else:
-                            seg_output = response[0].as_numpy(output_name)
-                            if hwcToChwConversion:
-                                seg_output = np.transpose(seg_output, (0, 2, 3, 1))
-                                # need to copy as contiguous
-                                seg_output = np.ascontiguousarray(seg_output)
-                            else:
-                                seg_output = np.copy(seg_output)
+                    batch_idx += 1
 
-                    cvcuda_perf.pop_range()
-                    # docs_tag: end_sync_output
-
-                    # docs_tag: begin_encode_output
-                    # Stage 6: encode output data
-                    cvcuda_perf.push_range("encode_output")
-                    seg_output = torch.as_tensor(seg_output)
-                    batch.data = seg_output.cuda()
-                    encoder(batch)
-                    cvcuda_perf.pop_range()
+                cvcuda_perf.pop_range(total_items=total_items)  # for batch
 
-                    # docs_tag: end_encode_output
+            # Encode the batches still on the server, in order.
+            with cvcuda_stream, torch.cuda.stream(torch_stream):
+                while inflight_requests:
+                    complete_oldest_request()
 
-                    batch_idx += 1
-
-                cvcuda_perf.pop_range(total_items=batch.data.shape[0])  # for batch
+            if shm_regions is not None:
+                shm_regions.close()
 
             # Make sure encoder finishes any outstanding work
             encoder.join()
@@ -408,7 +590,39 @@ def main():
         action="store_true",
         help="Enable Triton streaming (i.e. server-side decoding and encoding) of video data.",
     )
+    parser.add_argument(
+        "-mi",
+        "--max_inflight_requests",
+        default=1,
+        type=int,
+        help="The maximum number of batches sent to the server and waiting for their "
+        "results. With more than one, the next batches are decoded and sent while the "
+        "previous ones are being processed. Not used with --stream_video.",
+    )
+    parser.add_argument(
+        "-shm",
+        "--shared_memory",
+        type=str,
+        choices=["none", "system", "cuda"],
+        default="none",
+        help="Exchange the input and output tensors with a server running on the same "
+        "machine through system or CUDA shared memory instead of the GRPC messages. "
+        "Not used with --stream_video.",
+    )
+    parser.add_argument(
+        "-ppr",
+        "--packets_per_request",
+        default=1,
+        type=int,
+        help="The number of video packets sent to the server in a single request. "
+        "With more than one, the packets are coalesced in one buffer, which saves the "
+        "per-request overhead on low bitrate streams. Only used with --stream_video.",
+    )
     args = parse_validate_default_args(parser)
+    if args.max_inflight_requests <= 0:
+        raise ValueError("max_inflight_requests must be a value >=1.")
+    if args.packets_per_request <= 0:
+        raise ValueError("packets_per_request must be a value >=1.")
 
     # Parse the command line arguments.
     args = parser.parse_args()
@@ -430,6 +644,11 @@ def main():
         args.device_id,
         args.stream_video,
         cvcuda_perf,
+        args.prefetch_batches,
+        args.decode_ahead,
+        args.max_inflight_requests,
+        args.shared_memory,
+        args.packets_per_request,
     )
     # docs_tag: end_call_run_sample
 
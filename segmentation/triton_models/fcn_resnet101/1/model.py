@@ -101,6 +101,21 @@ class TritonPythonModel:
             cvcuda_perf=self.cvcuda_perf,
         )
 
+        # Warm the whole pipeline up on synthetic batches before taking any traffic,
+        # so that the first requests do not pay for it.
+        with self.cvcuda_stream, torch.cuda.stream(self.torch_stream):
+            self.inference.warmup(
+                sorted({1, max(self.max_batch_size, 1)}),
+                (self.network_width, self.network_height),
+                self.preprocess,
+                lambda probabilities, preprocessed: self.postprocess(
+                    probabilities,
+                    preprocessed[0],
+                    preprocessed[1],
+                    self.inference.class_index,
+                ),
+            )
+
         self.logger = pb_utils.Logger
 
         # docs_tag: end_init_model
@@ -19,13 +19,13 @@
 import pycuda.driver as cuda
 import os
 import sys
-import time
 import json
+import queue
+import time
 from types import SimpleNamespace
 import torch
 import numpy as np
 import threading
-from collections import deque
 from pathlib import Path
 
 # Import Triton modules
@@ -50,6 +50,257 @@ from common.perf_utils import CvCudaPerf  # noqa: E402
 # docs_tag: end_python_imports
 
 
+class VideoSession:
+    """
+    Holds everything that belongs to a single video being streamed through the model.
+    """
+
+    def __init__(self, video_id, response_sender, decoder, encoder):
+        """
+        Initializes a new instance of the `VideoSession` class.
+        :param video_id: The id of the video, as sent by the client in the request ids.
+        :param response_sender: The response sender of the first request of the video.
+         All the responses of the video are sent through it.
+        :param decoder: The `VideoBatchStreamingDecoderVPF` of the video.
+        :param encoder: The `VideoBatchStreamingEncoderVPF` of the video.
+        """
+        self.video_id = video_id
+        self.response_sender = response_sender
+        self.decoder = decoder
+        self.encoder = encoder
+        # Blocking queue of (packets, height, width) groups waiting to be sent.
+        # None is the terminal flag, a `pb_utils.TritonError` ends the video with an error.
+        self.output_queue = queue.Queue()
+        # Size of the last processed frames, sent back along with the packets.
+        self.width, self.height = 0, 0
+        self.thread = None
+        self.error = None
+
+    def fail(self, error):
+        """
+        Ends the video with an error. Its client gets the error instead of the remaining
+        packets, and the frames it still sends are dropped.
+        :param error: The `pb_utils.TritonError` to send to the client.
+        """
+        if self.error is None:
+            self.error = error
+            self.output_queue.put(error)
+
+
+class FrameBatchScheduler:
+    """
+    Batches the decoded frames of all the active videos together so that the
+    inference runs on as many frames as possible at once, no matter how many
+    videos they come from. The pre-processing, post-processing and encoding still
+    run per video since videos may not all have the same resolution.
+    A batch is run as soon as it is full, when a video sends its next frames or its
+    last packet, or at the latest `max_delay` seconds after its first frames arrived.
+    """
+
+    def __init__(
+        self,
+        preprocess,
+        inference,
+        postprocess,
+        network_size,
+        max_batch_size,
+        max_delay,
+        cuda_ctx,
+        cvcuda_stream,
+        torch_stream,
+        cvcuda_perf,
+        logger,
+    ):
+        self.preprocess = preprocess
+        self.inference = inference
+        self.postprocess = postprocess
+        self.network_size = network_size
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.cuda_ctx = cuda_ctx
+        self.cvcuda_stream = cvcuda_stream
+        self.torch_stream = torch_stream
+        self.cvcuda_perf = cvcuda_perf
+        self.logger = logger
+
+        # List of (session, orig_tensor, resized_tensor, normalized_tensor) waiting
+        # for inference, and the time at which the oldest of them was added.
+        self.pending = []
+        self.pending_frames = 0
+        self.pending_since = None
+        self.batch_count = 0
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.is_stopped = False
+        self.thread = threading.Thread(
+            target=self.timeout_thread,
+            args=(os.path.join(self.cvcuda_perf.stack_path, "scheduler"),),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def submit(self, session, frame_tensor, is_last_packet):
+        """
+        Adds the decoded frames of a video to the next inference batch.
+        Must be called with the CUDA context current.
+        :param session: The `VideoSession` the frames belong to.
+        :param frame_tensor: The NHWC cvcuda RGB tensor returned by the decoder of the
+         session, or None if the decoder did not return any frames.
+        :param is_last_packet: Whether this was the last packet of the video. If so, the
+         frames of the video are processed right away and its encoder is flushed.
+        """
+        with self.cond, self.cvcuda_stream, torch.cuda.stream(self.torch_stream):
+            if session.error is not None:
+                return
+
+            if frame_tensor:
+                # The decoder alternates between two output tensors, so the previous
+                # frames of this video must go through before it decodes again. Same if
+                # the new frames do not fit in the batch anymore.
+                if any(s is session for s, *_ in self.pending) or (
+                    self.pending_frames + frame_tensor.shape[0] > self.max_batch_size
+                ):
+                    self.run_batch()
+
+                # Pre-process (input is CV-CUDA tensor)
+                orig_tensor, resized_tensor, normalized_tensor = self.preprocess(
+                    frame_tensor,
+                    out_size=self.network_size,
+                )
+                self.pending.append(
+                    (session, orig_tensor, resized_tensor, normalized_tensor)
+                )
+                self.pending_frames += frame_tensor.shape[0]
+                if self.pending_since is None:
+                    self.pending_since = time.monotonic()
+                    self.cond.notify_all()
+
+                if self.pending_frames >= self.max_batch_size:
+                    self.run_batch()
+
+            # Upon receiving the last packet, flush the encoder buffer.
+            # Before that, decoder is guaranteed flushed as well.
+            if is_last_packet:
+                if any(s is session for s, *_ in self.pending):
+                    self.run_batch()
+                    if session.error is not None:
+                        return
+
+                flushed_packets = session.encoder.encoder.flush()
+                session.output_queue.put(
+                    (flushed_packets, session.height, session.width)
+                )
+                session.output_queue.put(None)  # enqueue terminal flag
+                self.logger.log_info(
+                    f"[Encoder] Last batch of {len(flushed_packets)} packets are flushed"
+                )
+
+    def run_batch(self):
+        """
+        Runs the inference on all the pending frames at once, then post-processes
+        and encodes the frames of every video. Must be called with the lock held.
+        If the batch fails, all its videos are failed instead of raising.
+        """
+        if not self.pending:
+            return
+
+        # Take the frames out first, a failed batch must not be run again.
+        pending, pending_frames = self.pending, self.pending_frames
+        self.pending = []
+        self.pending_frames = 0
+        self.pending_since = None
+
+        try:
+            self._run_pending(pending, pending_frames)
+        except Exception as e:
+            self.logger.log_error(f"[Scheduler] Batch failed: {e}")
+            # Let the clients of the videos of the batch know, they would hang otherwise.
+            error = pb_utils.TritonError(f"Failed to process the video: {e}")
+            for session, *_ in pending:
+                session.fail(error)
+
+        self.batch_count += 1
+
+    def _run_pending(self, pending, pending_frames):
+        self.cvcuda_perf.push_range("batch", batch_idx=self.batch_count)
+
+        # Concatenate the pre-processed frames of all the videos.
+        normalized_tensors = [
+            torch.as_tensor(normalized_tensor.cuda(), device="cuda")
+            for _, _, _, normalized_tensor in pending
+        ]
+        if len(normalized_tensors) == 1:
+            batch_tensor = normalized_tensors[0]
+        else:
+            batch_tensor = torch.cat(normalized_tensors)
+
+        self.cvcuda_perf.push_range("inference")
+
+        # Model inference
+        probabilities = self.inference(batch_tensor)
+
+        self.cvcuda_perf.pop_range()
+
+        # Hand the results back to each video.
+        start = 0
+        for session, orig_tensor, resized_tensor, _ in pending:
+            end = start + resized_tensor.shape[0]
+
+            # Post-process (output is made to be cvcuda tensor rather than torch tensor)
+            blurred_frame = self.postprocess(
+                probabilities[start:end],
+                orig_tensor,
+                resized_tensor,
+                self.inference.class_index,
+            )
+            start = end
+
+            session.width, session.height = (
+                blurred_frame.shape[2],
+                blurred_frame.shape[1],
+            )
+
+            self.cvcuda_perf.push_range("encoder.vpf")
+
+            # Encode cvcuda NHWC tensor, batched
+            encoded_frame = session.encoder(blurred_frame)
+
+            self.cvcuda_perf.pop_range()
+
+            # All the packets of the batch are sent together.
+            session.output_queue.put((encoded_frame, session.height, session.width))
+
+        self.cvcuda_perf.pop_range(total_items=pending_frames)  # for batch
+
+    def timeout_thread(self, perf_root_path):
+        # Runs the pending frames once they have waited for too long, so that a video
+        # does not have to wait for the others to send more frames.
+        self.cuda_ctx.push()
+        self.cvcuda_perf.attach_thread(perf_root_path)
+        try:
+            with self.cond, self.cvcuda_stream, torch.cuda.stream(self.torch_stream):
+                while not self.is_stopped:
+                    if self.pending_since is None:
+                        self.cond.wait()
+                        continue
+
+                    delay = self.pending_since + self.max_delay - time.monotonic()
+                    if delay > 0:
+                        self.cond.wait(timeout=delay)
+                        continue
+
+                    self.run_batch()
+        finally:
+            self.cuda_ctx.pop()
+
+    def stop(self):
+        with self.cond:
+            self.is_stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
 # Triton Python Model
 class TritonPythonModel:
     def initialize(self, args):
@@ -84,6 +335,11 @@ class TritonPythonModel:
         ]
         self.inference_backend = params["inference_backend"]["string_value"]
         self.max_batch_size = int(params["max_batch_size_trt_engine"]["string_value"])
+        # Replay the inference of every batch size as a CUDA graph.
+        self.cuda_graphs = (
+            params.get("cuda_graphs", {"string_value": "false"})["string_value"].lower()
+            == "true"
+        )
         # in streaming mode, Triton max batch size is always 1,
         # which is different from TRT engine profile needs a max batch size as well
 
@@ -104,6 +360,15 @@ class TritonPythonModel:
         self.cvcuda_perf = CvCudaPerf("fcn_resnet101_streaming", default_args=args)
 
         if self.inference_backend == "tensorrt":
+            # The batches mix the frames of however many videos are streaming, so their
+            # size varies. Give the engine an optimization profile for a few sizes.
+            profile_batch_sizes = [
+                int(b)
+                for b in params.get(
+                    "trt_profile_batch_sizes", {"string_value": ""}
+                )["string_value"].split(",")
+                if b.strip()
+            ]
             self.inference = SegmentationTensorRT(
                 output_dir="/tmp",
                 seg_class_name=self.visualization_class_name,
@@ -111,6 +376,8 @@ class TritonPythonModel:
                 image_size=(self.network_width, self.network_height),
                 device_id=self.device_id,
                 cvcuda_perf=self.cvcuda_perf,
+                profile_batch_sizes=profile_batch_sizes,
+                cuda_graphs=self.cuda_graphs,
             )
         else:
             self.inference = SegmentationPyTorch(
@@ -120,6 +387,7 @@ class TritonPythonModel:
                 image_size=(self.network_width, self.network_height),
                 device_id=self.device_id,
                 cvcuda_perf=self.cvcuda_perf,
+                cuda_graphs=self.cuda_graphs,
             )
 
         self.preprocess = PreprocessorCvcuda(self.device_id, self.cvcuda_perf)
@@ -131,24 +399,58 @@ class TritonPythonModel:
             torch_output=False,  # let postprocess directly return cvcuda tensor
         )
 
+        # Warm the whole pipeline up on synthetic batches of every batch size the
+        # engine has a profile for, before taking any traffic.
+        with self.cvcuda_stream, torch.cuda.stream(self.torch_stream):
+            self.inference.warmup(
+                sorted(
+                    {1, self.max_batch_size}
+                    | set(getattr(self.inference, "profile_batch_sizes", []))
+                ),
+                (self.network_width, self.network_height),
+                self.preprocess,
+                lambda probabilities, preprocessed: self.postprocess(
+                    probabilities,
+                    preprocessed[0],
+                    preprocessed[1],
+                    self.inference.class_index,
+                ),
+            )
+
         # To keep track of response threads so that we can delay
         # finalizing the model until all response threads
         # have completed.
         self.inflight_thread_count = 0
         self.inflight_thread_count_lck = threading.Lock()
+        self.inflight_thread_count_cond = threading.Condition(
+            self.inflight_thread_count_lck
+        )
         # docs_tag: end_init_model
 
-        self.batch_count = 0
-
-        # map of active [video id] to response handle
-        self.video_response_handles = dict()
-        # VPF encoder & decoder instances
-        self.video_encoders = dict()
-        self.video_decoders = dict()
-        self.output_queues = dict()
+        # map of active [video id] to its VideoSession
+        self.sessions = dict()
 
         self.logger = pb_utils.Logger
 
+        # Frames of all the videos are batched together for inference. A batch waits
+        # at most this long for more frames before it is run.
+        max_batch_delay_ms = float(
+            params.get("max_batch_delay_ms", {"string_value": "10"})["string_value"]
+        )
+        self.scheduler = FrameBatchScheduler(
+            self.preprocess,
+            self.inference,
+            self.postprocess,
+            (self.network_width, self.network_height),
+            self.max_batch_size,
+            max_batch_delay_ms / 1000,
+            self.cuda_ctx,
+            self.cvcuda_stream,
+            self.torch_stream,
+            self.cvcuda_perf,
+            self.logger,
+        )
+
     # docs_tag: begin_execute_model
     def execute(self, requests):
         """
@@ -184,8 +486,7 @@ class TritonPythonModel:
         packet_id = int(packet_id)
         if packet_id == 0:
             # Record response handle
-            self.first_response_handle = requests[0].get_response_sender()
-            self.video_response_handles[video_id] = self.first_response_handle
+            response_sender = requests[0].get_response_sender()
             self.logger.log_info(
                 f"[Video Stream] Start stream processing video ID {video_id}"
             )
@@ -208,105 +509,83 @@ class TritonPythonModel:
         is_last_packet = pb_utils.get_input_tensor_by_name(
             requests[0], "LAST_PACKET"
         ).as_numpy()[0]
-        if is_first_packet:  # optional, only sent along with first packet
+        # optional, only sent when the client coalesces several packets in one request
+        packet_offsets = pb_utils.get_input_tensor_by_name(
+            requests[0], "PACKET_OFFSETS"
+        )
+        if packet_offsets is not None:
+            packet_offsets = packet_offsets.as_numpy()
+
+        # upon recv first packet, do initialization
+        if is_first_packet:
+            # optional, only sent along with first packet
             # bs,w,h,fps,total_frames, pix_fmt, codec, cspace, crange
-            self.meta_part0 = pb_utils.get_input_tensor_by_name(
+            meta_part0 = pb_utils.get_input_tensor_by_name(
                 requests[0], "META0"
             ).as_numpy()
 
-        # upon recv first packet, do initialization
-        if is_first_packet:
             # init decoder with metadata
-            self.video_decoders[video_id] = VideoBatchStreamingDecoderVPF(
+            decoder = VideoBatchStreamingDecoderVPF(
                 "server",
                 self.logger,
                 self.cvcuda_perf,
                 self.device_id,
                 self.cuda_ctx,
                 self.cvcuda_stream,
-                self.meta_part0,
+                meta_part0,
+                2,  # the scheduler may still hold the previous batch of the video
             )
 
             # init encoder with metadata
-            self.video_encoders[video_id] = VideoBatchStreamingEncoderVPF(
+            encoder = VideoBatchStreamingEncoderVPF(
                 "server",
                 self.logger,
                 self.cvcuda_perf,
                 self.device_id,
                 self.cuda_ctx,
                 self.cvcuda_stream,
-                self.meta_part0[3],
+                meta_part0[3],
             )  # fps from metadata
 
-            self.output_queues[video_id] = deque([])
+            session = VideoSession(video_id, response_sender, decoder, encoder)
+            self.sessions[video_id] = session
 
-            self.spawn_thread(self.first_response_handle, video_id)
+            self.spawn_thread(session)
 
-        curr_encoder = self.video_encoders[video_id]
-        curr_decoder = self.video_decoders[video_id]
-        curr_queue = self.output_queues[video_id]
+        session = self.sessions.get(video_id)
+        if session is None:
+            # The video has failed and its client already got the error.
+            return None
 
         # nvtx annotation to record video id (distinguish multi-stream) and batch id
         marker_suffix = (
-            f"video{video_id[:4]}.batch{curr_decoder.decoder.frame_batch_idx}"
+            f"video{video_id[:4]}.batch{session.decoder.decoder.frame_batch_idx}"
         )
         self.cvcuda_perf.push_range(marker_suffix)
-        self.cvcuda_perf.push_range("decoder.vpf")
-
-        # decoding into CVCUDA tensor. Flush when last packet is received
-        frame_tensor = curr_decoder(packet, meta_part1, meta_part2, is_last_packet)
-
-        self.cvcuda_perf.pop_range()
-
-        # async decoding doesn't guarantee to always return frames for every request
-        # at decode success, run decode-preprocess-infer-postprocess-encode pipeline
-        if frame_tensor:
-
-            # Pre-process (input is CV-CUDA tensor)
-            orig_tensor, resized_tensor, normalized_tensor = self.preprocess(
-                frame_tensor,
-                out_size=(self.network_width, self.network_height),
-            )
-            self.cvcuda_perf.push_range("inference")
-
-            # Model inference
-            probabilities = self.inference(normalized_tensor)
-
-            self.cvcuda_perf.pop_range()
-
-            # Post-process (output is made to be cvcuda tensor rather than torch tensor)
-            blurred_frame = self.postprocess(
-                probabilities,
-                orig_tensor,
-                resized_tensor,
-                self.inference.class_index,
-            )
-
-            self.width, self.height = blurred_frame.shape[2], blurred_frame.shape[1]
-
-            self.cvcuda_perf.push_range("encoder.vpf")
-
-            # Encode cvcuda NHWC tensor, batched
-            encoded_frame = curr_encoder(blurred_frame)
 
+        # decoding into CVCUDA tensors. Flush when last packet is received
+        frame_tensors = session.decoder.decoder.server_recv_packets(
+            packet, meta_part1, meta_part2, packet_offsets, is_last_packet
+        )
+        while True:
+            self.cvcuda_perf.push_range("decoder.vpf")
+            with self.cvcuda_stream, torch.cuda.stream(self.torch_stream):
+                frame_tensor = next(frame_tensors, None)
             self.cvcuda_perf.pop_range()
 
-            self.batch_count += 1
+            # async decoding doesn't guarantee to always return frames for every packet.
+            if frame_tensor is None:
+                break
 
-            curr_queue.extend(encoded_frame)
+            # Decoded frames join the next inference batch, along with the frames of the
+            # other videos. The scheduler sends the results back to the encoder of each video.
+            self.scheduler.submit(session, frame_tensor, False)
 
-        # Upon receiving the last packet, flush the encoder buffer.
-        # Before that, decoder is guaranteed flushed as well.
         # Note: last packet is a dummy packet without real packet data
         if is_last_packet:
-            flushed_packets = curr_encoder.encoder.flush()
-            curr_queue.extend(flushed_packets)
-            curr_queue.append(None)  # enqueue terminal flag
-            self.logger.log_info(
-                f"[Encoder] Last batch of {len(flushed_packets)} packets are flushed"
-            )
+            self.scheduler.submit(session, None, True)
 
-            self.cvcuda_perf.pop_range()
+        self.cvcuda_perf.pop_range()
 
         # Unlike in non-decoupled model transaction policy, execute function
         # here returns no response. A return from this function only notifies
@@ -318,7 +597,7 @@ class TritonPythonModel:
 
         # docs_tag: end_execute_model
 
-    def spawn_thread(self, response_sender, video_id):
+    def spawn_thread(self, session):
         """
         Start a separate, persistent thread to send the responses for the request. The
         sending back of the responses is delegated to this thread.
@@ -331,45 +610,69 @@ class TritonPythonModel:
         the latency is hidden behind the model inference pipeline.
         """
 
-        self.thread = threading.Thread(
-            target=self.response_thread, args=(response_sender, video_id)
-        )
+        session.thread = threading.Thread(target=self.response_thread, args=(session,))
 
         # making the thread persistent and completely independent of main thread
-        self.thread.daemon = True
+        session.thread.daemon = True
 
         with self.inflight_thread_count_lck:
             self.inflight_thread_count += 1
 
-        self.thread.start()
+        session.thread.start()
 
-    def response_thread(self, response_sender, video_id):
+    def response_thread(self, session):
         # The response_sender is used to send response(s) associated with the
         # corresponding request.
 
         # all python backend utils (pb_utils) call should stay in server code
         # rather than vpf_utils.py, because client code depends on it too thus
         # cannot import pb_utils
-        while True:
-            # skip if queue is empty, exit if terminal flag is in queue
-            if self.output_queues[video_id]:
-                packet = self.output_queues[video_id].popleft()
-                if packet is not None:
-                    # regular packet item
-                    response = pb_utils.InferenceResponse(
-                        output_tensors=[
-                            pb_utils.Tensor("PACKET_OUT", packet),
-                            pb_utils.Tensor(
-                                "FRAME_SIZE",
-                                np.array([self.height, self.width], dtype=np.uint64),
-                            ),
-                            pb_utils.Tensor(
-                                "LAST_PACKET", np.array([False], dtype=bool)
-                            ),
-                        ]
-                    )
-                    response_sender.send(response)
-                else:
+        response_sender = session.response_sender
+        output_queue = session.output_queue
+        try:
+            is_done = False
+            while not is_done:
+                # Sleep until a group of packets is ready, then also take all the other
+                # groups which became ready in the meantime and send them in one go.
+                groups = [output_queue.get()]
+                while groups[-1] is not None:
+                    try:
+                        groups.append(output_queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                for group in groups:
+                    if group is None:
+                        is_done = True
+                        break
+                    if isinstance(group, pb_utils.TritonError):
+                        # The video has failed, end its stream with the error.
+                        response_sender.send(
+                            pb_utils.InferenceResponse(output_tensors=[], error=group),
+                            flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL,
+                        )
+                        self.sessions.pop(session.video_id, None)
+                        self.logger.log_error(
+                            f"[Video Stream] Failed stream processing video ID "
+                            f"{session.video_id}: {group.message()}"
+                        )
+                        return
+                    packets, height, width = group
+                    frame_size = np.array([height, width], dtype=np.uint64)
+                    for packet in packets:
+                        # regular packet item
+                        response = pb_utils.InferenceResponse(
+                            output_tensors=[
+                                pb_utils.Tensor("PACKET_OUT", packet),
+                                pb_utils.Tensor("FRAME_SIZE", frame_size),
+                                pb_utils.Tensor(
+                                    "LAST_PACKET", np.array([False], dtype=bool)
+                                ),
+                            ]
+                        )
+                        response_sender.send(response)
+
+                if is_done and session.video_id in self.sessions:
                     # terminal flag as a None item in the queue
                     # unfortunately, Triton doesn't support signaling client of the terminal response, so
                     # we have to manually send a dummy packet:
@@ -396,21 +699,34 @@ class TritonPythonModel:
                         flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL
                     )
                     # remove finished video from active map
-                    self.video_response_handles.pop(video_id)
+                    self.sessions.pop(session.video_id, None)
                     self.logger.log_info(
-                        f"[Video Stream] Finish stream processing video ID {video_id}"
+                        f"[Video Stream] Finish stream processing video ID {session.video_id}"
                     )
-                    break
-
-            # this is very important! if thread is just busy waiting without sleep, the main thread
-            # could be blocked due to Python's GIL global lock. Add minimal sleep can mitigate this
-            time.sleep(0.001)
-
-        with self.inflight_thread_count_lck:
-            self.inflight_thread_count -= 1
+        finally:
+            with self.inflight_thread_count_cond:
+                self.inflight_thread_count -= 1
+                self.inflight_thread_count_cond.notify_all()
 
     # docs_tag: begin_finalize_model
     def finalize(self):
+        self.scheduler.stop()
+
+        # End the streams of the videos which are still streaming with an error, so
+        # that their clients do not wait forever. Their response threads send it and
+        # remove them from the sessions, wait for all of them before tearing down.
+        error = pb_utils.TritonError("The model is being unloaded.")
+        for session in list(self.sessions.values()):
+            session.fail(error)
+
+        with self.inflight_thread_count_cond:
+            while self.inflight_thread_count != 0:
+                if not self.inflight_thread_count_cond.wait(timeout=5):
+                    self.logger.log_info(
+                        "Waiting for %d response threads to complete"
+                        % self.inflight_thread_count
+                    )
+
         self.cuda_ctx.pop()
 
     # docs_tag: end_finalize_model